@@ -7,6 +7,7 @@ from discord.ext import commands
 from modules.DiscordBot import Gemini
 from modules.ManagedMessages import ManagedMessages
 from modules.CommonCalls import CommonCalls
+from modules.Scheduler import JobDropped, Priority, scheduler
 from typing import List, Any
 
 allowed_mentions = AllowedMentions(everyone=False, users=False, roles=False)
@@ -41,25 +42,27 @@ class Freewill(commands.Cog):
             if self.bot.user.mentioned_in(message) or self.is_activated(ctx.channel.id):
                 return
 
-            text_frequency = float(CommonCalls.config().get("textFrequency", 0)) * 0.01
-            reaction_frequency = (
-                float(CommonCalls.config().get("reactionFrequency", 0)) * 0.01
-            )
-            keywords = CommonCalls.config().get("keywords", [])
+            settings = CommonCalls.settings()
+            text_frequency = settings.text_frequency * 0.01
+            reaction_frequency = settings.reaction_frequency * 0.01
+            keywords = settings.keywords
             keyword_added_chance = 0
 
             for i in keywords:
                 if i.lower() in message.content.lower():
-                    keyword_added_chance = (
-                        float(CommonCalls.config().get("keywordChance")) * 0.01
-                    )
+                    keyword_added_chance = settings.keyword_chance * 0.01
 
             if random.random() < min(text_frequency + keyword_added_chance, 1.0):
                 try:
-                    response = await Gemini.generate_response(
-                        message, await self.bot.get_context(message)
+                    response = await scheduler.run(
+                        Priority.FREEWILL,
+                        lambda: Gemini.generate_response(message, ctx),
                     )
 
+                except JobDropped:
+                    # Busy with mentions and activated channels, freewill can sit this one out
+                    return
+
                 except Exception as E:
                     debug_mode = CommonCalls.config().get("debugMode")
                     if debug_mode == "on":
@@ -98,7 +101,6 @@ class Freewill(commands.Cog):
                             chunk,
                             mention_author=False,
                             allowed_mentions=allowed_mentions,
-                            mention_author=False,
                         )
                         await ManagedMessages.add_to_message_list(
                             channel_id=ctx.channel.id,
@@ -110,10 +112,15 @@ class Freewill(commands.Cog):
 
             if random.random() < min(reaction_frequency + keyword_added_chance, 1.0):
                 try:
-                    response = await Gemini.generate_response(
-                        message, await self.bot.get_context(message)
+                    response = await scheduler.run(
+                        Priority.FREEWILL,
+                        lambda: Gemini.generate_response(message, ctx),
                     )
 
+                except JobDropped:
+                    # Busy with mentions and activated channels, freewill can sit this one out
+                    return
+
                 except Exception as E:
                     debug_mode = CommonCalls.config().get("debugMode")
                     if debug_mode == "on":
@@ -140,7 +147,6 @@ class Freewill(commands.Cog):
                             chunk,
                             mention_author=False,
                             allowed_mentions=allowed_mentions,
-                            mention_author=False,
                         )
                         await ManagedMessages.add_to_message_list(
                             channel_id=ctx.channel.id,
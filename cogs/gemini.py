@@ -1,8 +1,10 @@
 import json
-import asyncio
 
 from discord.ext import commands
 from modules.DiscordBot import Gemini
+from modules.ReplyStream import ReplyStream
+from modules.Scheduler import Priority, scheduler
+from modules.Coalescer import coalescer
 from modules.CommonCalls import CommonCalls
 from modules.ManagedMessages import ManagedMessages
 from discord import Message, AllowedMentions, Reaction, Member
@@ -31,6 +33,14 @@ class GeminiCog(commands.Cog):
                 E.write("{}")
                 E.close()
 
+    def replies_to_bot(self, message: Message) -> bool:
+        reference = message.reference
+        return (
+            reference is not None
+            and isinstance(reference.resolved, Message)
+            and reference.resolved.author.id == self.bot.user.id
+        )
+
     @commands.Cog.listener("on_message")
     async def listen(self, message: Message):
         channel_id = message.channel.id
@@ -42,18 +52,51 @@ class GeminiCog(commands.Cog):
         if ctx.valid:
             return
 
-        if self.bot.user.mentioned_in(message) or self.is_activated(channel_id):
-            pass
+        # Direct mentions (and replies to the bot) go ahead of activated channel chatter
+        if self.bot.user.mentioned_in(message):
+            priority = Priority.MENTION
+        elif self.is_activated(channel_id):
+            priority = (
+                Priority.MENTION if self.replies_to_bot(message) else Priority.ACTIVATED
+            )
         else:
             return
 
-        async with message.channel.typing():
-            await asyncio.sleep(2)
+        if priority == Priority.MENTION:
+            return await self.respond(message, ctx, priority)
 
+        # Activated channel chatter is answered once per burst of messages
+        async with coalescer.turn(channel_id, message) as earlier:
+            if earlier is None:
+                # Folded into the reply to a newer message
+                return
+            return await self.respond(message, ctx, priority, earlier)
+
+    async def respond(
+        self,
+        message: Message,
+        ctx: commands.Context,
+        priority: Priority,
+        earlier: list[Message] = None,
+    ):
+        channel_id = message.channel.id
         try:
-            response = await Gemini.generate_response(
-                message, await self.bot.get_context(message)
-            )
+            stream = ReplyStream(message, allowed_mentions)
+            # Typing shows while the reply is generated, a streamed reply shows up as soon as it starts
+            async with message.channel.typing():
+                response = await scheduler.run(
+                    priority,
+                    lambda: Gemini.generate_response(message, ctx, stream, earlier),
+                )
+
+            if stream.messages:
+                for text, content in zip(stream.messages, stream.shown):
+                    await ManagedMessages.add_to_message_list(
+                        channel_id=channel_id,
+                        message_id=text.id,
+                        message=f"{CommonCalls.load_character_details()['name']}: {content}",
+                    )
+                return
 
             if type(response) == tuple:
                 print("Voice mode on!")
@@ -62,7 +105,6 @@ class GeminiCog(commands.Cog):
                     channel_id=channel_id,
                     message_id=text.id,
                     message=f"{CommonCalls.load_character_details()['name']}: {response[0]}",
-                    mention_author=False,
                 )
                 return
 
@@ -82,7 +124,6 @@ class GeminiCog(commands.Cog):
                         channel_id=channel_id,
                         message_id=text.id,
                         message=f"{CommonCalls.load_character_details()['name']}: {text.content}",
-                        mention_author=False,
                     )
                 except Exception as E:
                     print(f"Error replying response: {E}")
@@ -121,10 +162,6 @@ class GeminiCog(commands.Cog):
                 ):
                     return
 
-                if channel_id not in ManagedMessages.context_window:
-                    ManagedMessages.context_window[channel_id] = []
-                    print(reaction.emoji)
-
                 await ManagedMessages.add_to_message_list(
                     channel_id,
                     reaction.message.id,
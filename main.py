@@ -6,6 +6,8 @@ import uvicorn
 from spine_server import create_app  # as we defined it
 from modules.CommonCalls import CommonCalls
 from modules.ManagedMessages import ManagedMessages
+from modules.ContextJournal import context_journal
+from modules.MemoryStore import memory_store
 
 intents = Intents.default()
 intents.members = True
@@ -18,7 +20,6 @@ def get_prefix(bot, message):
 
 bot = commands.Bot(command_prefix=get_prefix, intents=intents)
 
-mem_path = f"""data/{CommonCalls.config().get('alias')}-memories.json"""
 act_path = f"""data/{CommonCalls.config().get('alias')}-activation.json"""
 
 
@@ -27,13 +28,6 @@ async def load_cogs():
     for ext in os.listdir("cogs"):
         if ext.endswith(".py"):
             bot.load_extension(f"cogs.{ext[:-3]}")
-    try:
-        with open(mem_path, "r") as file:
-            file.close()
-    except FileNotFoundError:
-        with open(mem_path, "w") as file:
-            file.write("{}")
-            file.close()
     try:
         with open(act_path, "r") as file:
             file.close()
@@ -54,5 +48,12 @@ if __name__ == "__main__":
     t = threading.Thread(target=start_api, daemon=True)
     t.start()
 
-    # 2) start your Discord bot (blocks, uses its own loop)
-    bot.run(CommonCalls.config().get("discord_token"))
+    # 2) bring back the context windows from before the restart
+    ManagedMessages.restore()
+
+    # 3) start your Discord bot (blocks, uses its own loop)
+    try:
+        bot.run(CommonCalls.config().get("discord_token"))
+    finally:
+        context_journal.close()
+        memory_store.close()
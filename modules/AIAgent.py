@@ -6,19 +6,11 @@ import json
 import datetime
 
 from discord.ext import commands
-from google import genai
-from google.genai.types import (
-    GenerateContentConfig,
-    SafetySetting,
-    GenerateContentResponse,
-)
+from google.genai.types import GenerateContentResponse
 from modules.ManagedMessages import ManagedMessages
 from modules.Voice import VoiceCalls
 from modules.CommonCalls import CommonCalls
-
-context_window = ManagedMessages.context_window
-
-client = genai.Client(api_key=CommonCalls.config()["gemini_api_key"])
+from modules.GeminiClient import generate, GenerationConfigs
 
 
 class AIAgent:
@@ -54,31 +46,9 @@ class AIAgent:
         {json_format}
         """
 
-        response: GenerateContentResponse = await client.aio.models.generate_content(
+        response: GenerateContentResponse = await generate(
             contents=text,
-            model=CommonCalls.config()["aiModel"],
-            config=GenerateContentConfig(
-                safety_settings=[
-                    SafetySetting(
-                        category="HARM_CATEGORY_HATE_SPEECH",
-                        threshold=CommonCalls.config().get("filterHateSpeech"),
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_HARASSMENT",
-                        threshold=CommonCalls.config()["filterHarassment"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        threshold=CommonCalls.config()["filterSexuallyExplicit"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                        threshold=CommonCalls.config()["filterDangerous"],
-                    ),
-                ],
-                system_instruction=system_instruction,
-                response_mime_type="application/json",
-            ),
+            config=GenerationConfigs.json(system_instruction),
         )
 
         if CommonCalls.clean_json(response.text.lower())["category"] in [
@@ -0,0 +1,266 @@
+"""
+Admission control for Gemini calls.
+
+Every generation waits for admission from its model's `ModelGate` before it is sent:
+
+- At most `geminiConcurrency` calls per model are in flight at once.
+- A request bucket (`geminiRPM`) and a token bucket (`geminiTPM`, estimated from the prompt) keep us under
+  the API quota. Work that doesn't fit waits in line instead of being sent off to fail with a 429.
+- Waiting calls are queued per guild and the guilds take turns, so one busy activated channel can't
+  starve every other server. The guild is taken from `current_guild`, set where a message is handled.
+
+Limits of 0, or left out of the config, turn that particular limit off. The time calls spent waiting is reported by `/health`.
+"""
+
+import asyncio
+import time
+
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from modules.CommonCalls import CommonCalls
+
+# The guild (as a string) the current task works for, calls made without one share the None queue
+current_guild: ContextVar = ContextVar("current_guild", default=None)
+
+# Rough prompt size, Gemini averages about 4 characters per token
+CHARS_PER_TOKEN = 4
+# Flat estimates for uploaded files and the reply, the real usage is settled once the response arrives
+FILE_TOKEN_ESTIMATE = 1000
+OUTPUT_TOKEN_ESTIMATE = 500
+
+
+def estimate_tokens(contents) -> int:
+    """Estimated prompt + reply tokens of a generate_content call"""
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+
+    tokens = OUTPUT_TOKEN_ESTIMATE
+    for part in contents:
+        if isinstance(part, str):
+            tokens += len(part) // CHARS_PER_TOKEN
+        else:
+            tokens += FILE_TOKEN_ESTIMATE
+    return tokens
+
+
+class TokenBucket:
+    """Holds up to `per_minute` tokens, refilled continuously. A rate of 0 is unlimited"""
+
+    def __init__(self, per_minute: float = 0):
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.per_minute,
+            self.tokens + (now - self.updated_at) * self.per_minute / 60,
+        )
+        self.updated_at = now
+
+    def set_rate(self, per_minute: float) -> None:
+        if per_minute == self.per_minute:
+            return
+        self._refill()
+        # Coming from unlimited the bucket starts full
+        self.tokens = (
+            float(per_minute) if self.per_minute <= 0 else min(self.tokens, per_minute)
+        )
+        self.per_minute = per_minute
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available, 0 if they are now"""
+        if self.per_minute <= 0:
+            return 0.0
+        self._refill()
+        # Anything bigger than the whole bucket goes through once the bucket is full
+        amount = min(amount, self.per_minute)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60 / self.per_minute
+
+    def take(self, amount: float) -> None:
+        if self.per_minute > 0:
+            self.tokens -= min(amount, self.per_minute)
+
+    def settle(self, amount: float) -> None:
+        """Corrects an earlier estimate by `amount` tokens, the bucket may go into debt"""
+        if self.per_minute > 0:
+            self.tokens = min(self.per_minute, self.tokens + amount)
+
+
+class _Waiter:
+    __slots__ = ("future", "tokens", "queued_at")
+
+    def __init__(self, future: asyncio.Future, tokens: int):
+        self.future = future
+        self.tokens = tokens
+        self.queued_at = time.monotonic()
+
+
+class ModelGate:
+
+    def __init__(self, model: str):
+        self.model = model
+        self.concurrency = 0
+        self.requests = TokenBucket()
+        self.tokens = TokenBucket()
+        self.in_flight = 0
+        # guild -> waiters in arrival order, the front guild is served next
+        self._waiting: OrderedDict = OrderedDict()
+        self._wakeup: asyncio.TimerHandle | None = None
+        self.counters = {"admitted": 0, "queued": 0, "cancelled": 0}
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.last_wait = 0.0
+
+    def configure(self, concurrency: int, rpm: float, tpm: float) -> None:
+        self.concurrency = concurrency
+        self.requests.set_rate(rpm)
+        self.tokens.set_rate(tpm)
+
+    @property
+    def depth(self) -> int:
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    async def acquire(self, guild, tokens: int) -> None:
+        """Waits until the call may be sent, in turn with the other guilds"""
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), tokens)
+        self._waiting.setdefault(guild, deque()).append(waiter)
+        self._pump()
+
+        if not waiter.future.done():
+            self.counters["queued"] += 1
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted just as it was cancelled, give the slot back
+                self.release()
+            else:
+                self._forget(guild, waiter)
+                self.counters["cancelled"] += 1
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._pump()
+
+    def _forget(self, guild, waiter: _Waiter) -> None:
+        waiters = self._waiting.get(guild)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiting[guild]
+
+    def _pump(self) -> None:
+        """Admits waiting calls round robin across guilds for as long as the limits allow"""
+        while self._waiting:
+            if self.concurrency > 0 and self.in_flight >= self.concurrency:
+                # release() pumps again
+                return
+
+            guild, waiters = next(iter(self._waiting.items()))
+            waiter: _Waiter = waiters[0]
+            if waiter.future.done():
+                self._forget(guild, waiter)
+                continue
+            delay = max(
+                self.requests.wait_time(1), self.tokens.wait_time(waiter.tokens)
+            )
+            if delay > 0:
+                self._wake_in(delay)
+                return
+
+            waiters.popleft()
+            # The guild goes to the back of the line, or leaves it when it has nothing else waiting
+            del self._waiting[guild]
+            if waiters:
+                self._waiting[guild] = waiters
+
+            self.requests.take(1)
+            self.tokens.take(waiter.tokens)
+            self.in_flight += 1
+            waited = time.monotonic() - waiter.queued_at
+            self.counters["admitted"] += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.last_wait = waited
+            waiter.future.set_result(None)
+
+    def _wake_in(self, delay: float) -> None:
+        if self._wakeup is not None and not self._wakeup.cancelled():
+            self._wakeup.cancel()
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._pump)
+
+    def stats(self) -> dict:
+        oldest = min(
+            (waiters[0].queued_at for waiters in self._waiting.values()),
+            default=None,
+        )
+        return {
+            "in_flight": self.in_flight,
+            "depth": self.depth,
+            "guilds_waiting": len(self._waiting),
+            **self.counters,
+            "last_wait_seconds": round(self.last_wait, 3),
+            "max_wait_seconds": round(self.wait_max, 3),
+            "avg_wait_seconds": round(
+                self.wait_total / max(self.counters["admitted"], 1), 3
+            ),
+            "oldest_waiting_seconds": (
+                round(time.monotonic() - oldest, 3) if oldest is not None else 0.0
+            ),
+            "request_tokens": round(self.requests.tokens, 1),
+            "quota_tokens": round(self.tokens.tokens),
+        }
+
+
+class Admission:
+
+    def __init__(self):
+        self.gates: dict[str, ModelGate] = {}
+
+    def gate(self, model: str) -> ModelGate:
+        gate = self.gates.get(model)
+        if gate is None:
+            gate = self.gates[model] = ModelGate(model)
+
+        settings = CommonCalls.settings()
+        gate.configure(
+            settings.gemini_concurrency, settings.gemini_rpm, settings.gemini_tpm
+        )
+        return gate
+
+    @asynccontextmanager
+    async def admit(self, model: str, tokens: int):
+        """
+        Description:
+        Holds a slot of `model` for the duration of the block. Yields a function that settles the
+        token estimate with the real usage, call it with the total token count once it is known
+
+        Arguments:
+        model : str
+        tokens : int
+            estimated tokens, see `estimate_tokens`
+        """
+        gate = self.gate(model)
+        await gate.acquire(current_guild.get(), tokens)
+
+        def settle(used: int | None) -> None:
+            if used:
+                gate.tokens.settle(tokens - used)
+
+        try:
+            yield settle
+        finally:
+            gate.release()
+
+    def stats(self) -> dict:
+        return {model: gate.stats() for model, gate in self.gates.items()}
+
+
+admission = Admission()
@@ -1,57 +1,92 @@
 import json
 import asyncio
+import mimetypes
+import os
 
 from modules.ManagedMessages import ManagedMessages, headless_ManagedMessages
 from modules.CommonCalls import CommonCalls
-from discord import Message
+from modules.PromptTemplate import PromptTemplate
+from modules.UploadCache import upload_cache
+from modules.MediaPrep import MediaPrep, over_budget
+from modules.GeminiClient import (
+    client,
+    gemini_calls,
+    generate,
+    generate_stream,
+    GenerationConfigs,
+    STT_INSTRUCTION,
+)
+from discord import Attachment, Message
 
 from google.genai.types import (
     File,
     GenerateContentResponse,
-    SafetySetting,
-    GenerateContentConfig,
+    Part,
 )
-from google import genai
 
+# Inline media one request may carry in total, base64 adds a third and Gemini rejects inline requests over 20MB
+INLINE_REQUEST_BYTES = 12_000_000
 
-context_window = ManagedMessages().context_window
+# Polling of uploaded files while Gemini processes them, seconds
+UPLOAD_POLL_START = 0.5
+UPLOAD_POLL_GROWTH = 1.5
+UPLOAD_POLL_MAX = 5.0
+UPLOAD_TIMEOUT = 120.0
 
-client = genai.Client(api_key=CommonCalls.config()["gemini_api_key"])
 
+def _mime_type(filename: str, content_type: str = None) -> str:
+    mime_type = content_type or mimetypes.guess_type(filename)[0]
+    # Discord adds parameters, e.g. "audio/ogg; codecs=opus"
+    return (mime_type or "application/octet-stream").split(";")[0]
 
-def read_prompt(message: Message = None, memory: str = None, author_name: str = None):
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+# Remote deletions still running
+_deletions: set[asyncio.Task] = set()
+
+# Persona templates, rebuilt only when the personality file changes (see `CommonCalls.personality_version()`)
+_prompt_templates: dict = {"version": None, "memory": None, "no_memory": None}
+
+
+def _build_prompt_templates() -> dict:
     """
     Description:
-    This function reads the prompt from `prompt.json` and formats the values correctly
-
-    Arguments:
-    message : discord.Message = None
-    memory : str = None
-    author_name : str = None
+    Renders the static persona part of the prompt once per personality version,
+    leaving placeholders for the per-message fields (author name, memory)
 
     Returns:
-    prompt : str | prompt_with_memory : str
+    Dict[str, PromptTemplate | int]
     """
-
-    personality_traits: dict = CommonCalls.load_character_details().get(
-        "personality_traits"
+    version = CommonCalls.personality_version()
+    if _prompt_templates["version"] == version:
+        return _prompt_templates
+
+    details = CommonCalls.load_character_details()
+    escape = PromptTemplate.escape
+
+    system_note = escape(details["system_note"])
+    bot_name = escape(details["name"])
+    role = escape(details["role"])
+    age = escape(details["age"])
+    description = escape(details["description"])
+    likes = escape(details["likes"])
+    dislikes = escape(details["dislikes"])
+
+    author_name = PromptTemplate.field("author_name")
+    memory = PromptTemplate.field("memory")
+
+    conversation_examples = "\n".join(
+        [
+            f"{author_name}: {escape(example['user'])}\n{bot_name}: {escape(example['bot'])}"
+            for example in details["conversation_examples"]
+        ]
     )
-    system_note: dict = CommonCalls.load_character_details().get(
-        "system_note", "No system note extension given. DO NOT MAKE ONE UP."
-    )
-    conversation_examples: dict = CommonCalls.load_character_details().get(
-        "conversation_examples", []
-    )
-    bot_name = personality_traits.get("name", "unknown_bot")
-    role = personality_traits.get("role", "unknown_role")
-    age = personality_traits.get("age", "unknown_age")
-    description = personality_traits.get("description", "no description provided")
-    likes = personality_traits.get("likes", "N/A")
-    dislikes = personality_traits.get("dislikes", "N/A")
 
-    # If memory is present, append to the prompt | TODO : append to prompt for context window
-    if memory:
-        return f"""
+    _prompt_templates["memory"] = PromptTemplate(f"""
         {system_note}
 
         You are {bot_name}, a {role}, who is {age} years old, described as {description}.
@@ -60,7 +95,7 @@ def read_prompt(message: Message = None, memory: str = None, author_name: str =
 
         Conversation examples:
 
-        {"\n".join([f"{author_name}: {example['user']}\n{bot_name}: {example['bot']}" for example in conversation_examples])}
+        {conversation_examples}
 
         Your likes : {likes}
         
@@ -74,10 +109,9 @@ def read_prompt(message: Message = None, memory: str = None, author_name: str =
         
         From here on out, this is the conversation you will be responding to.
         ---- CONVERSATION ----
-"""
+""")
 
-    # If not
-    return f"""
+    _prompt_templates["no_memory"] = PromptTemplate(f"""
         {system_note}
 
         You are {bot_name}, a {role}, who is {age} years old, described as {description}.
@@ -90,11 +124,51 @@ def read_prompt(message: Message = None, memory: str = None, author_name: str =
         
         Conversation examples:
 
-        {"\n".join([f"{author_name}: {example['user']}\n{bot_name}: {example['bot']}" for example in conversation_examples])}
+        {conversation_examples}
 
         From here on out, this is the conversation you will be responding to.
         ---- CONVERSATION ----
-        """
+        """)
+
+    _prompt_templates["version"] = version
+    return _prompt_templates
+
+
+def read_prompt(message: Message = None, memory: str = None, author_name: str = None):
+    """
+    Description:
+    This function renders the persona prompt from `prompt.json`, only the per-message values are formatted on each call
+
+    Arguments:
+    message : discord.Message = None
+    memory : str = None
+    author_name : str = None
+
+    Returns:
+    prompt : str | prompt_with_memory : str
+    """
+
+    templates = _build_prompt_templates()
+
+    # If memory is present, append to the prompt | TODO : append to prompt for context window
+    if memory:
+        return templates["memory"].render(author_name=author_name, memory=memory)
+
+    # If not
+    return templates["no_memory"].render(author_name=author_name)
+
+
+class InlineBudget:
+    """Inline bytes a request can still take, attachments past it go through FileAPI"""
+
+    def __init__(self, total=INLINE_REQUEST_BYTES):
+        self.left = total
+
+    def take(self, size: int) -> bool:
+        if size > self.left:
+            return False
+        self.left -= size
+        return True
 
 
 class BotModel:
@@ -105,7 +179,10 @@ class BotModel:
 
     # Generate content
     async def generate_content(
-        prompt, channel_id=None, attachment: File = None, retry=3
+        prompt,
+        channel_id=None,
+        attachment: File | Part | list[File | Part] = None,
+        retry=3,
     ):
         """
         Description:
@@ -114,50 +191,21 @@ class BotModel:
         Arguments:
         prompt : str
         channel_id : int | str = None
-        attachment : genai.types.File = None
+        attachment : genai.types.File | genai.types.Part | list = None
+            one piece of media or a list of them
         retry : int = 3
+            attempts for transient API errors
 
         Returns:
         response : str
         """
 
-        context = "\n".join(context_window[channel_id])
-        prompt_with_context = prompt + "\n" + context
-
-        if attachment:
-            media_addon = "Describe this piece of media to yourself in a way that if referenced again, you will be able to answer any potential question asked."
-
-            full_prompt = [prompt_with_context, "\n", media_addon, "\n", attachment]
-
-        else:
-            full_prompt = prompt_with_context
+        full_prompt = BotModel.build_contents(prompt, channel_id, attachment)
 
-        response: GenerateContentResponse = await client.aio.models.generate_content(
+        response: GenerateContentResponse = await generate(
             contents=full_prompt,
-            model=CommonCalls.config()["aiModel"],
-            config=GenerateContentConfig(
-                safety_settings=[
-                    SafetySetting(
-                        category="HARM_CATEGORY_HATE_SPEECH",
-                        threshold=CommonCalls.config()["filterHateSpeech"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_HARASSMENT",
-                        threshold=CommonCalls.config()["filterHarassment"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        threshold=CommonCalls.config()["filterSexuallyExplicit"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                        threshold=CommonCalls.config()["filterDangerous"],
-                    ),
-                ],
-                temperature=float(CommonCalls.config().get("temperature", 0)),
-                top_p=float(CommonCalls.config().get("topP", 0)),
-                top_k=float(CommonCalls.config().get("topK", 0)),
-            ),
+            config=GenerationConfigs.chat(),
+            attempts=retry,
         )
 
         try:
@@ -171,14 +219,12 @@ class BotModel:
             )
             print(response.candidates)
 
-        retry_count = 0
-        while retry_count < retry:
-            try:
-                fall_back_response = response.candidates[0].content.parts[0].text
-                return str(fall_back_response).strip()
-            except Exception as E:
-                print(f"Error generating response (retry {retry_count}): {E}")
-                retry_count += 1
+        # Retrying the request itself happens in `generate`, this only reads what came back another way
+        try:
+            fall_back_response = response.candidates[0].content.parts[0].text
+            return str(fall_back_response).strip()
+        except Exception as E:
+            print(f"Error generating response: {E}")
 
         try:
             await ManagedMessages.remove_message_from_index(channel_id, 0)
@@ -189,13 +235,123 @@ class BotModel:
             or "Sorry, could you please repeat that?"
         )
 
-    async def upload_attachment(attachment):
+    async def generate_content_stream(prompt, channel_id=None):
         """
         Description:
-        This function allows for asynchronous attachment uploading via FileAPI
+        Streaming version of `BotModel.generate_content` for text replies, yields the reply as it is generated
+
+        Arguments:
+        prompt : str
+        channel_id : int | str = None
+
+        Returns:
+        AsyncIterator[str] : text deltas
+        """
+        stream = generate_stream(
+            contents=BotModel.build_contents(prompt, channel_id),
+            config=GenerationConfigs.chat(),
+        )
+        async for chunk in stream:
+            try:
+                text = chunk.text
+            except Exception:
+                # Chunks without text (e.g. only safety ratings) are skipped
+                continue
+            if text:
+                yield text
+
+    def build_contents(
+        prompt, channel_id=None, attachment: File | Part | list[File | Part] = None
+    ):
+        """Persona prompt + as much of the context window as fits the `contextWindow` budget (+ attachments)"""
+        media_addon = "Describe this piece of media to yourself in a way that if referenced again, you will be able to answer any potential question asked."
+
+        # Only the newest messages that fit in the `contextWindow` token budget are sent
+        context_budget = ManagedMessages.context_budget(
+            prompt, media_addon if attachment else ""
+        )
+        context = ManagedMessages.render(channel_id, context_budget)
+        prompt_with_context = prompt + "\n" + context
+
+        if attachment:
+            media = attachment if isinstance(attachment, list) else [attachment]
+            return [prompt_with_context, "\n", media_addon, "\n", *media]
+        return prompt_with_context
+
+    async def attachment_media(
+        attachment: Attachment, budget: "InlineBudget" = None
+    ) -> File | Part | None:
+        """
+        Description:
+        Turns a discord attachment into something Gemini can read. Attachments over their type's byte budget
+        are shrunk first (see modules/MediaPrep.py), then media up to inlineAttachmentBytes is sent inline with
+        the prompt and bigger media is uploaded through FileAPI.
+        Hand the result to `BotModel.release_media` once the reply is generated
+
+        Arguments:
+        attachment : discord.Attachment
+        budget : InlineBudget = None
+            inline bytes left for the request this media goes into, share one between the attachments of a request
+
+        Returns:
+        media : genai.types.Part | genai.types.File | None
+        """
+        budget = budget or InlineBudget()
+        inline_bytes = CommonCalls.settings().inline_attachment_bytes
+        # Small media that needs no shrinking is read straight into memory
+        if (
+            not over_budget(attachment.filename, attachment.size)
+            and attachment.size <= inline_bytes
+            and budget.take(attachment.size)
+        ):
+            return Part.from_bytes(
+                data=await attachment.read(),
+                mime_type=_mime_type(attachment.filename, attachment.content_type),
+            )
+
+        save_name = f"{attachment.id} {attachment.filename.lower()}"
+        await attachment.save(save_name)  # Saves attachment
+        prepared = save_name
+        try:
+            # Reposts of the same content reuse the file uploaded the first time, without shrinking it again
+            digest = await upload_cache.digest(save_name)
+            cached = await upload_cache.lookup(digest)
+            if cached is not None:
+                return cached
+
+            prepared = await MediaPrep.prepare(save_name)
+            size = os.path.getsize(prepared)
+            if size <= inline_bytes and budget.take(size):
+                return Part.from_bytes(
+                    data=await asyncio.to_thread(_read_file, prepared),
+                    mime_type=(
+                        _mime_type(attachment.filename, attachment.content_type)
+                        if prepared == save_name
+                        else _mime_type(prepared)
+                    ),
+                )
+            return await upload_cache.acquire(prepared, digest)
+        finally:
+            os.remove(save_name)
+            if prepared != save_name:
+                MediaPrep.discard(prepared)
+
+    async def release_media(media: File | Part | None):
+        """Hands uploaded media back to the `upload_cache`, which deletes it later. Inline media needs no clean up"""
+        if isinstance(media, File):
+            await upload_cache.release(media)
+
+    async def upload_attachment(attachment, prepare: bool = True):
+        """
+        Description:
+        This function allows for asynchronous attachment uploading via FileAPI, downscaling/transcoding it first if it's large.
+        Processing is polled with a growing interval (UPLOAD_POLL_START up to UPLOAD_POLL_MAX seconds),
+        files that aren't ACTIVE within UPLOAD_TIMEOUT seconds are given up on and deleted
 
         Arguments:
         attachment
+        prepare : bool = True
+            False for files that already went through `MediaPrep.prepare`
 
         Returns:
         attachment_media : genai.Types.File | None
@@ -203,36 +359,61 @@ class BotModel:
         print(
             "[INIT] Uploading Attachment function call `BotModel.upload_attachment` (Message from line 168 @ modules/BotModel.py)"
         )
-        attachment_media: File = client.files.upload(file=attachment)
+        # Files over their type's byte budget are shrunk first (see modules/MediaPrep.py)
+        prepared = await MediaPrep.prepare(attachment) if prepare else attachment
+        try:
+            attachment_media: File = await client.aio.files.upload(file=prepared)
+        finally:
+            if prepared != attachment:
+                MediaPrep.discard(prepared)
 
-        while True:
-            if attachment_media.state.name == "PROCESSING":
-                print(
-                    "[PROCESSING] Uploading Attachment function call `BotModel.upload_attachment` (Message from line 173 @ modules/BotModel.py)"
-                )
-                await asyncio.sleep(2)
-                attachment_media = client.files.get(
-                    name=attachment_media.name
-                )  # Update the state
-            elif attachment_media.state.name == "ACTIVE":
-                print(
-                    "[SUCCESS] Uploading Attachment function call `BotModel.upload_attachment` (Message from line 177 @ modules/BotModel.py)"
-                )
-                return attachment_media
-            elif attachment_media.state.name == "FAILED":
-                print(
-                    "[FAILED] Uploading Attachment function call `BotModel.upload_attachment` (Message from line 180 @ modules/BotModel.py)"
-                )
-                return None
-            else:
-                print(f"Unknown state: {attachment_media.state.name}")
-                return None
+        interval = UPLOAD_POLL_START
+        try:
+            async with asyncio.timeout(UPLOAD_TIMEOUT):
+                while attachment_media.state.name == "PROCESSING":
+                    print(
+                        "[PROCESSING] Uploading Attachment function call `BotModel.upload_attachment` (Message from line 173 @ modules/BotModel.py)"
+                    )
+                    await asyncio.sleep(interval)
+                    interval = min(interval * UPLOAD_POLL_GROWTH, UPLOAD_POLL_MAX)
+                    attachment_media = await gemini_calls.call(
+                        lambda: client.aio.files.get(name=attachment_media.name)
+                    )  # Update the state
+        except TimeoutError:
+            print(
+                f"[FAILED] Attachment still processing after {UPLOAD_TIMEOUT:.0f}s, giving up (Message from line 177 @ modules/BotModel.py)"
+            )
+            await BotModel.delete_attachment(attachment_media.name)
+            return None
+
+        if attachment_media.state.name == "ACTIVE":
+            print(
+                "[SUCCESS] Uploading Attachment function call `BotModel.upload_attachment` (Message from line 177 @ modules/BotModel.py)"
+            )
+            return attachment_media
+        elif attachment_media.state.name == "FAILED":
+            print(
+                "[FAILED] Uploading Attachment function call `BotModel.upload_attachment` (Message from line 180 @ modules/BotModel.py)"
+            )
+            return None
+        else:
+            print(f"Unknown state: {attachment_media.state.name}")
+            return None
 
     async def delete_attachment(attachment):
         """
-        come on, really?
+        Deletes an uploaded file in the background, the reply doesn't wait on it
         """
-        client.files.delete(name=attachment)
+        task = asyncio.create_task(BotModel._delete_remote(attachment))
+        _deletions.add(task)
+        task.add_done_callback(_deletions.discard)
+
+    async def _delete_remote(name):
+        try:
+            await gemini_calls.call(lambda: client.aio.files.delete(name=name))
+        except Exception as E:
+            # Uploaded files expire on their own after 48 hours
+            print(f"[BOTMODEL] [WARNING] | Couldn't delete {name}: {E}")
 
     async def __generate_reaction(prompt, channel_id, attachment=None):
         """[UNUSED AND BUGGY]"""
@@ -242,20 +423,23 @@ class BotModel:
         )
 
         if attachment:
-            prompt_with_image = ["\n".join(context_window[channel_id]), attachment]
+            prompt_with_image = [
+                ManagedMessages.render(channel_id),
+                attachment,
+            ]
             emoji = await reaction_model.generate_content_async(prompt_with_image)
 
             response = emoji.text or emoji.candidates[0]
-            # context_window[channel_id].append(f"You reacted with this emoji {response}")
+            # ManagedMessages.get_window(channel_id).append(f"You reacted with this emoji {response}")
 
             return response
 
         else:
-            context = "\n".join(context_window[channel_id])
+            context = ManagedMessages.render(channel_id)
             emoji = reaction_model.generate_content(context)
 
             response = emoji.text or emoji.candidates[0]
-            # context_window[channel_id].append(f"You reacted with this emoji {response}")
+            # ManagedMessages.get_window(channel_id).append(f"You reacted with this emoji {response}")
 
     async def generate_reaction(channel_id, attachment=None):
 
@@ -266,32 +450,28 @@ class BotModel:
         prompt = f"""You are in an embedded LLM, 
         you must only respond with ONE character, 
         an emoji, using this emoji react to the conversation going on, 
-        if its good, if its bad, in one emoji. - \n\n The conversation [PARTIAL] is as follows {"\n".join(context_window[channel_id])}"""
-        response: GenerateContentResponse = await client.aio.models.generate_content(
+        if its good, if its bad, in one emoji. - \n\n The conversation [PARTIAL] is as follows {ManagedMessages.render(channel_id)}"""
+        response: GenerateContentResponse = await generate(
             model="gemini-2.0-flash", contents=prompt
         )
 
         why_prompt = f"""You are in an embedded LLM, 
         you must only respond with a concise, 
         bias free message, in this context you have just reacted to the users message 
-        ({"\n".join(context_window[channel_id])}) with {response.text.strip()}, 
+        ({ManagedMessages.render(channel_id)}) with {response.text.strip()}, 
         using the data available you must now come up with the reason why you did what you did"""
 
-        why_response: GenerateContentResponse = (
-            await client.aio.models.generate_content(
-                contents=why_prompt, model=CommonCalls.config()["aiModel"]
-            )
-        )
+        why_response: GenerateContentResponse = await generate(contents=why_prompt)
 
         # join this to the context window
 
-    async def speech_to_text(audio_file: File):
+    async def speech_to_text(audio_file: File | Part):
         """
         Description:
         This function is used for transcription of audio data provided via voice channels or .ogg files
 
         Arguments:
-        audio_file : genai.Types.File
+        audio_file : genai.Types.File | genai.types.Part
 
         Returns:
         response.text : str
@@ -299,31 +479,9 @@ class BotModel:
         print(
             "Speech To Text function call `speech_to_text` (Message from line 210 @ modules/BotModel.py)"
         )
-        system_instruction = """You are now a microphone, you will ONLY return the words in the audio file, DO NOT describe them.\n\n"""
-        response: GenerateContentResponse = await client.aio.models.generate_content(
-            contents=[system_instruction, audio_file],
-            model=CommonCalls.config()["aiModel"],
-            config=GenerateContentConfig(
-                safety_settings=[
-                    SafetySetting(
-                        category="HARM_CATEGORY_HATE_SPEECH",
-                        threshold=CommonCalls.config()["filterHateSpeech"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_HARASSMENT",
-                        threshold=CommonCalls.config()["filterHarassment"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        threshold=CommonCalls.config()["filterSexuallyExplicit"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                        threshold=CommonCalls.config()["filterDangerous"],
-                    ),
-                ],
-                system_instruction=system_instruction,
-            ),
+        response: GenerateContentResponse = await generate(
+            contents=[STT_INSTRUCTION, audio_file],
+            config=GenerationConfigs.stt(),
         )
 
         print("[RESPONSE] Response from STT Module: ", response.text)
@@ -342,32 +500,14 @@ class headless_BotModel:
 
         headless_mm = headless_ManagedMessages
 
-        context = "\n".join(headless_mm.context_window[channel_id])
+        context_budget = ManagedMessages.context_budget(prompt)
+        context = headless_mm.get_window(channel_id).render(context_budget)
         full_prompt = prompt + "\n" + context
         # TODO HERE REMOVE THIS AND OPTIMIZE BY SENDING VOICE MESSAGE DIRECTLY TO API
-        response: GenerateContentResponse = await client.aio.models.generate_content(
+        response: GenerateContentResponse = await generate(
             contents=full_prompt,
-            model=CommonCalls.config()["aiModel"],
-            config=GenerateContentConfig(
-                safety_settings=[
-                    SafetySetting(
-                        category="HARM_CATEGORY_HATE_SPEECH",
-                        threshold=CommonCalls.config()["filterHateSpeech"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_HARASSMENT",
-                        threshold=CommonCalls.config()["filterHarassment"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        threshold=CommonCalls.config()["filterSexuallyExplicit"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                        threshold=CommonCalls.config()["filterDangerous"],
-                    ),
-                ],
-            ),
+            config=GenerationConfigs.chat(),
+            attempts=retry,
         )
 
         try:
@@ -381,14 +521,11 @@ class headless_BotModel:
             )
             print(response.candidates)
 
-        retry_count = 0
-        while retry_count < retry:
-            try:
-                fall_back_response = response.candidates[0].content.parts
-                return str(fall_back_response).strip()
-            except Exception as E:
-                print(f"Error generating response (retry {retry_count}): {E}")
-                retry_count += 1
+        try:
+            fall_back_response = response.candidates[0].content.parts
+            return str(fall_back_response).strip()
+        except Exception as E:
+            print(f"Error generating response: {E}")
 
         try:
             await headless_ManagedMessages.remove_message_from_index(channel_id, 0)
@@ -400,3 +537,8 @@ class headless_BotModel:
             CommonCalls.config()["error_message"]
             or "Sorry, could you please repeat that?"
         )
+
+
+# `attachment_media` shrinks media before handing it to the cache
+upload_cache.upload = lambda path: BotModel.upload_attachment(path, prepare=False)
+upload_cache.delete = BotModel.delete_attachment
@@ -0,0 +1,144 @@
+"""
+Burst coalescing for activated channels.
+
+Every message in an activated channel used to get its own reply, so five messages posted within two seconds
+meant five generations over nearly the same context. Messages now join their channel's burst instead:
+
+- A burst closes once nobody posted for `coalesceWindow` seconds, or `coalesceMaxWait` seconds after its
+  first message, whichever comes first.
+- A channel generates one reply at a time. Messages that arrive while a reply is in flight form the next
+  burst, which closes as soon as that reply is done if they already waited long enough.
+- The newest message of a burst leads it: it is answered, with the rest of the burst added to the context
+  window before it. The other messages are folded into that reply and get no reply of their own.
+
+A `coalesceWindow` of 0 turns coalescing off.
+"""
+
+import asyncio
+import time
+
+from contextlib import asynccontextmanager
+
+from discord import Message
+
+from modules.CommonCalls import CommonCalls
+
+
+class _Channel:
+    __slots__ = ("pending", "first_at", "last_at", "busy", "closer")
+
+    def __init__(self):
+        self.pending: list[tuple[Message, asyncio.Future]] = []
+        self.first_at = 0.0
+        self.last_at = 0.0
+        self.busy = False  # a reply is being generated
+        self.closer: asyncio.Task | None = None
+
+
+class Coalescer:
+
+    def __init__(self):
+        self._channels: dict[int, _Channel] = {}
+        self.counters = {"messages": 0, "bursts": 0, "folded": 0}
+
+    @asynccontextmanager
+    async def turn(self, channel_id, message: Message):
+        """
+        Description:
+        Joins the channel's current burst and waits for it to close. Generate the reply inside the block,
+        the channel's next burst waits for it
+
+        Arguments:
+        channel_id
+        message : discord.Message
+
+        Yields:
+        list[discord.Message] : the burst's earlier messages, oldest first, when `message` leads the burst
+        None : when `message` was folded into a newer message's reply
+        """
+        settings = CommonCalls.settings()
+        if settings.coalesce_window <= 0:
+            yield []
+            return
+
+        earlier = await self._join(channel_id, message)
+        if earlier is None:
+            yield None
+            return
+
+        try:
+            yield earlier
+        finally:
+            self._release(channel_id)
+
+    async def _join(self, channel_id, message: Message) -> list[Message] | None:
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            channel = self._channels[channel_id] = _Channel()
+
+        now = time.monotonic()
+        if not channel.pending:
+            channel.first_at = now
+        channel.last_at = now
+        future = asyncio.get_running_loop().create_future()
+        channel.pending.append((message, future))
+        self.counters["messages"] += 1
+
+        if not channel.busy and channel.closer is None:
+            channel.closer = asyncio.create_task(self._close(channel_id, channel))
+        return await future
+
+    async def _close(self, channel_id, channel: _Channel) -> None:
+        """Waits out the debounce window, then hands the burst to its newest message"""
+        try:
+            while True:
+                settings = CommonCalls.settings()
+                deadline = min(
+                    channel.last_at + settings.coalesce_window,
+                    channel.first_at + settings.coalesce_max_wait,
+                )
+                delay = deadline - time.monotonic()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            channel.closer = None
+
+        burst, channel.pending = channel.pending, []
+        channel.busy = True
+        self.counters["bursts"] += 1
+        self.counters["folded"] += len(burst) - 1
+
+        messages = [message for message, _ in burst]
+        for index, (_, future) in enumerate(burst):
+            if future.done():
+                continue
+            if index == len(burst) - 1:
+                future.set_result(messages[:-1])
+            else:
+                future.set_result(None)
+
+        if burst[-1][1].cancelled():
+            # Nobody is left to generate the reply
+            self._release(channel_id)
+
+    def _release(self, channel_id) -> None:
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            return
+
+        channel.busy = False
+        if channel.pending:
+            channel.closer = asyncio.create_task(self._close(channel_id, channel))
+        else:
+            del self._channels[channel_id]
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "channels": len(self._channels),
+            "pending": sum(len(channel.pending) for channel in self._channels.values()),
+        }
+
+
+coalescer = Coalescer()
@@ -8,11 +8,16 @@ Optimization 1:
 Optimization 2:
     Reduce definitions of config
 
+Optimization 3:
+    Cache the parsed config and personality in memory, they are only re-read when the file changes on disk
+    or when the spine server tells us it was updated (see `CommonCalls.invalidate_config()`)
+
 """
 
 import json
 import os
 import re
+import time
 
 sample_config = {
     "alias": os.getenv("BOT_ID"),
@@ -30,7 +35,13 @@ sample_config = {
     "topP": "0.95",
     "topK": "40",
     "memoryWindow": "50",
+    "memoryRecallThreshold": "0.15",
+    "memoryRerank": "off",
+    "memoryRollups": "off",
+    "autoMemories": "off",
     "contextWindow": "8192",
+    "contextMaxChannels": "1000",
+    "contextIdleSeconds": "1800",
     "wack_message": "Ow! Uhh, what were we talking about?",
     "wack_error": "Sorry, can't remove what's not there. :joy:",
     "error_message": "Nuh uh, not gonna happen.",
@@ -47,6 +58,17 @@ sample_config = {
     "voiceMessageConvo": "on",
     "voiceChance": "100",
     "JustGetRidOfTheName": "on",
+    "streamReplies": "on",
+    "speculativeReplies": "off",
+    "inlineAttachmentBytes": "4194304",
+    "uploadCacheTTL": "21600",
+    "geminiConcurrency": "8",
+    "geminiRPM": "30",
+    "geminiTPM": "1000000",
+    "schedulerConcurrency": "4",
+    "schedulerMaxDepth": "32",
+    "coalesceWindow": "1.5",
+    "coalesceMaxWait": "4",
     "debugMode": "off",
 }
 
@@ -67,9 +89,171 @@ sample_personality = {
 }
 
 
+# How often (in seconds) the config file is stat'ed to look for changes made outside the spine server
+CONFIG_STAT_INTERVAL = 1.0
+
+
+class _CachedFile:
+    """Internal holder for a parsed file, along with what is needed to tell if it went stale"""
+
+    def __init__(self):
+        self.value = None
+        self.signature = None
+        self.checked_at = 0.0
+        self.stale = True
+        self.version = 0
+        self.derived = None  # anything built from `value`, rebuilt alongside it
+
+    @staticmethod
+    def file_signature(path: str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def needs_reload(self, path: str, interval: float) -> bool:
+        """Cheap check, only stats the file once every `interval` seconds"""
+        if self.stale or self.value is None:
+            return True
+
+        now = time.monotonic()
+        if now - self.checked_at < interval:
+            return False
+
+        self.checked_at = now
+        return self.file_signature(path) != self.signature
+
+    def store(self, path: str, value):
+        self.value = value
+        self.signature = self.file_signature(path)
+        self.checked_at = time.monotonic()
+        self.version += 1
+
+
+def _as_int(value, default: int) -> int:
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def _as_float(value, default: float) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class BotConfig:
+    """
+    Typed view of the config file, numbers and on/off switches are converted once per reload
+    instead of on every call site. The raw dictionary is still available as `BotConfig.raw`
+    """
+
+    def __init__(self, raw: dict):
+        self.raw = raw
+
+        self.alias: str = raw.get("alias") or os.getenv("BOT_ID")
+        self.ai_model: str = raw.get("aiModel", sample_config["aiModel"])
+
+        self.max_context = _as_int(raw.get("maxContext"), 20)
+        self.memory_window = _as_int(raw.get("memoryWindow"), 50)
+        self.memory_recall_threshold = _as_float(raw.get("memoryRecallThreshold"), 0.15)
+        self.context_window = _as_int(raw.get("contextWindow"), 8192)
+        self.context_max_channels = _as_int(raw.get("contextMaxChannels"), 1000)
+        self.context_idle_seconds = _as_float(raw.get("contextIdleSeconds"), 1800.0)
+
+        # Admission limits per model, 0 or a missing key turns a limit off so older configs keep running unthrottled
+        self.gemini_concurrency = _as_int(raw.get("geminiConcurrency"), 0)
+        self.gemini_rpm = _as_float(raw.get("geminiRPM"), 0.0)
+        self.gemini_tpm = _as_float(raw.get("geminiTPM"), 0.0)
+        # Replies generated at once and how many may wait before freewill/background work is dropped
+        self.scheduler_concurrency = _as_int(raw.get("schedulerConcurrency"), 4)
+        self.scheduler_max_depth = _as_int(raw.get("schedulerMaxDepth"), 32)
+        # Seconds of quiet that close a burst in an activated channel, and the longest a burst stays open
+        self.coalesce_window = _as_float(raw.get("coalesceWindow"), 1.5)
+        self.coalesce_max_wait = _as_float(raw.get("coalesceMaxWait"), 4.0)
+
+        self.temperature = _as_float(raw.get("temperature"), 0.0)
+        self.top_p = _as_float(raw.get("topP"), 0.0)
+        self.top_k = _as_float(raw.get("topK"), 0.0)
+
+        self.filter_hate_speech: str = raw.get("filterHateSpeech", "BLOCK_NONE")
+        self.filter_harassment: str = raw.get("filterHarassment", "BLOCK_NONE")
+        self.filter_sexually_explicit: str = raw.get(
+            "filterSexuallyExplicit", "BLOCK_NONE"
+        )
+        self.filter_dangerous: str = raw.get("filterDangerous", "BLOCK_NONE")
+
+        self.voice_chance = _as_float(raw.get("voiceChance"), 0.0)
+        self.text_frequency = _as_float(raw.get("textFrequency"), 0.0)
+        self.reaction_frequency = _as_float(raw.get("reactionFrequency"), 0.0)
+        self.keyword_chance = _as_float(raw.get("keywordChance"), 0.0)
+        self.keywords: list = raw.get("keywords", [])
+        self.recording_time = _as_float(raw.get("recording-time"), 10.0)
+
+        self.debug_mode = raw.get("debugMode") == "on"
+        self.deep_context = raw.get("deepContext") == "on"
+        self.memory_rerank = raw.get("memoryRerank") == "on"
+        self.memory_rollups = raw.get("memoryRollups") == "on"
+        # Forms memories from every full context window on its own, off leaves it to !remember
+        self.auto_memories = raw.get("autoMemories") == "on"
+        self.freewill = raw.get("freewill") == "on"
+        self.voice_messages = raw.get("voiceMessages") == "on"
+        self.voice_message_convo = raw.get("voiceMessageConvo") == "on"
+        self.just_get_rid_of_the_name = raw.get("JustGetRidOfTheName") == "on"
+        # On unless turned off, configs from before streaming have no streamReplies key
+        self.stream_replies = raw.get("streamReplies", "on") == "on"
+        self.speculative_replies = raw.get("speculativeReplies") == "on"
+        # Attachments up to this size are sent inline instead of through FileAPI, Gemini caps a request at 20MB
+        self.inline_attachment_bytes = _as_int(
+            raw.get("inlineAttachmentBytes"), 4194304
+        )
+        # Seconds an uploaded attachment is reused for reposts, Gemini keeps files for 48 hours at most
+        self.upload_cache_ttl = _as_float(raw.get("uploadCacheTTL"), 21600.0)
+
+        self.error_message: str = raw.get("error_message", "")
+
+
+_config_cache = _CachedFile()
+_personality_cache = _CachedFile()
+
+
 class CommonCalls:
 
     def load_character_details():
+        """
+        Description -
+        Returns the cached personality details, `prompt.json` is only re-read when its mtime changes
+        or after `CommonCalls.invalidate_personality()` is called.
+        Do NOT mutate the returned dictionary, it is shared by every caller.
+
+        Arguments -
+        None
+
+        Returns -
+        Dict[str, str]
+        """
+        prompt_path = f"data/{os.getenv('BOT_ID')}-prompt.json"
+
+        if _personality_cache.needs_reload(prompt_path, CONFIG_STAT_INTERVAL):
+            _personality_cache.stale = False
+            loaded = CommonCalls._read_character_details()
+            _personality_cache.store(prompt_path, loaded)
+
+        return _personality_cache.value
+
+    def personality_version() -> int:
+        """Returns a counter that goes up every time the personality is reloaded"""
+        CommonCalls.load_character_details()
+        return _personality_cache.version
+
+    def invalidate_personality() -> None:
+        """Marks the cached personality as stale, the next `CommonCalls.load_character_details()` call reloads it"""
+        _personality_cache.stale = True
+
+    def _read_character_details():
         """
         Description -
         Handles the `prompt.json` and returns the personality details.
@@ -126,6 +310,52 @@ class CommonCalls:
         }
 
     def config() -> dict:
+        """
+        Description:
+        Returns the cached config, the file is only re-read and re-parsed when its mtime changes
+        or after `CommonCalls.invalidate_config()` is called.
+        Do NOT mutate the returned dictionary, it is shared by every caller.
+
+        Returns:
+        Dict containing the configuration
+        """
+        config_path = f"data/{os.getenv('BOT_ID')}-config.json"
+
+        if _config_cache.needs_reload(config_path, CONFIG_STAT_INTERVAL):
+            # Cleared before reading so an invalidation that lands mid-read isn't lost
+            _config_cache.stale = False
+            loaded = CommonCalls._read_config()
+            _config_cache.store(config_path, loaded)
+            _config_cache.derived = BotConfig(loaded)
+
+            if _config_cache.derived.debug_mode:
+                print(
+                    f"[CONFIG] Loaded config (version {_config_cache.version}) from {config_path}"
+                )
+
+        return _config_cache.value
+
+    def settings() -> BotConfig:
+        """
+        Description:
+        Typed version of `CommonCalls.config()`, use this on hot paths so values aren't converted on every call
+
+        Returns:
+        BotConfig
+        """
+        CommonCalls.config()
+        return _config_cache.derived
+
+    def config_version() -> int:
+        """Returns a counter that goes up every time the config is reloaded, useful for invalidating derived caches"""
+        CommonCalls.config()
+        return _config_cache.version
+
+    def invalidate_config() -> None:
+        """Marks the cached config as stale, the next `CommonCalls.config()` call reloads it from disk"""
+        _config_cache.stale = True
+
+    def _read_config() -> dict:
         """
         Description:
         Loads and potentially updates the config file with environment variables
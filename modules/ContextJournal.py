@@ -0,0 +1,188 @@
+"""
+Append-only journal of context window mutations, so conversations survive restarts.
+
+`ManagedMessages` records every add/remove/wack as one JSON line. Lines are buffered and written + fsync'ed
+in batches on a single writer thread (so the event loop never waits on the disk), and the journal is
+periodically compacted down to one snapshot line per channel, encoded on the writer thread as well. On startup the journal is replayed to rebuild
+every context window.
+
+Line format:
+    ["a", channel_id, message_id, text]  message added
+    ["r", channel_id, message_id]        message removed by id
+    ["p", channel_id, index]             message removed by index
+    ["w", channel_id]                    channel wacked
+    ["s", channel_id, [[message_id, text], ...]]  snapshot of a whole window (written by compaction)
+"""
+
+import asyncio
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+
+from modules.CommonCalls import CommonCalls
+
+# Pending lines are written + fsync'ed once this many pile up, or FSYNC_INTERVAL seconds after the first one
+FSYNC_BATCH = 256
+FSYNC_INTERVAL = 1.0
+
+# The journal is rewritten as a snapshot after this many records
+COMPACT_EVERY = 50_000
+
+
+SNAPSHOT_PREFIX = '["s",'
+_decoder = json.JSONDecoder()
+
+
+def _encode(op) -> str:
+    return json.dumps(op, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+
+class ContextJournal:
+
+    def __init__(self, path: str):
+        self.path = path
+        # Returns (resident, spilled) windows, see `ManagedMessages.snapshot()`
+        self.snapshot: Callable[[], tuple[list, list]] | None = None
+        self.records_since_compaction = 0
+
+        self._pending: list[str] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._file = None  # only touched by the writer thread
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+
+    # Event loop side
+
+    def record(self, *op) -> None:
+        """Queues a mutation, it reaches the disk with the next batch"""
+        self._pending.append(_encode(op))
+        self.records_since_compaction += 1
+
+        if self.snapshot and self.records_since_compaction >= COMPACT_EVERY:
+            self.compact()
+        elif len(self._pending) >= FSYNC_BATCH:
+            self.flush()
+        elif self._flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # No event loop to flush later on, write right away
+                self.flush()
+            else:
+                self._flush_handle = loop.call_later(FSYNC_INTERVAL, self.flush)
+
+    def flush(self):
+        """Hands the pending lines to the writer thread"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._pending:
+            return None
+
+        batch, self._pending = self._pending, []
+        return self._writer.submit(self._append, batch)
+
+    def compact(self):
+        """
+        Rewrites the journal as one snapshot line per channel.
+        Pending lines are dropped as the snapshot already reflects them. Only the windows are captured here,
+        encoding them happens on the writer thread
+        """
+        if self.snapshot is None:
+            return self.flush()
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        self._pending = []
+        self.records_since_compaction = 0
+        return self._writer.submit(self._rewrite, *self.snapshot())
+
+    def close(self) -> None:
+        """Writes everything still pending and waits for the writer thread, call on shutdown"""
+        self.flush()
+        self._writer.submit(self._close).result()
+
+    def replay(self) -> Iterator[list]:
+        """
+        Description:
+        Reads every recorded mutation back, oldest first. A torn last line (crash mid-write) is skipped.
+        Snapshot entries are left json encoded, see `ContextJournal.parse()`
+
+        Returns:
+        Iterator[list]
+        """
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "r", encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    yield self.parse(line)
+                except (json.JSONDecodeError, ValueError):
+                    print(f"[JOURNAL] Skipped a corrupt line in {self.path}")
+
+    @staticmethod
+    def parse(line: str) -> list:
+        """
+        Decodes a journal line. For snapshot lines only the channel id is decoded, the entries stay a json string
+        so windows that are spilled straight back to disk never go through a decode/encode round trip
+        (snapshots are only written by `compact()` through an atomic rename, so they are never torn)
+        """
+        if line.startswith(SNAPSHOT_PREFIX):
+            channel_id, end = _decoder.raw_decode(line, len(SNAPSHOT_PREFIX))
+            return ["s", channel_id, line[end + 1 : line.rindex("]")]]
+        return json.loads(line)
+
+    @staticmethod
+    def snapshot_line(channel_key: str, entries_json: str) -> str:
+        """Builds an "s" line from an already json encoded channel id and entry list"""
+        return f"{SNAPSHOT_PREFIX}{channel_key},{entries_json}]\n"
+
+    @staticmethod
+    def encode_snapshot(channel_id, entries: list) -> str:
+        return _encode(["s", channel_id, entries])
+
+    # Writer thread side
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        return self._file
+
+    def _append(self, batch: list[str]) -> None:
+        journal = self._open()
+        journal.write("".join(batch))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def _rewrite(self, resident: list[tuple], spilled: list[tuple]) -> None:
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as snapshot:
+            snapshot.writelines(
+                self.encode_snapshot(channel_id, entries)
+                for channel_id, entries in resident
+            )
+            snapshot.writelines(
+                self.snapshot_line(channel_key, entries_json)
+                for channel_key, entries_json in spilled
+            )
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+
+        self._close()
+        os.replace(temp_path, self.path)
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+context_journal = ContextJournal(
+    f"data/{CommonCalls.config().get('alias')}-context.journal"
+)
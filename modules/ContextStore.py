@@ -0,0 +1,97 @@
+"""
+On-disk store for context windows that were evicted from memory by `ManagedMessages`.
+
+Idle channels are spilled here as one compact JSON row per channel and paged back in the next time
+the channel is used, so the resident set only holds channels that are actually active.
+"""
+
+import json
+import os
+import sqlite3
+
+from modules.CommonCalls import CommonCalls
+
+
+class ContextStore:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: sqlite3.Connection | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Opened lazily so importing the module doesn't touch the disk"""
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS windows (channel_id TEXT PRIMARY KEY, entries TEXT NOT NULL)"
+            )
+        return self._connection
+
+    @staticmethod
+    def _key(channel_id) -> str:
+        # json keeps int and str channel ids apart, discord ids are ints but the headless paths may use strings
+        return json.dumps(channel_id)
+
+    def save_many(self, windows: list[tuple]) -> None:
+        """
+        Description:
+        Spills windows to disk in a single transaction
+
+        Arguments:
+        windows : list[(channel_id, list[(message_id, text)])]
+        """
+        self.save_raw(
+            [
+                (channel_id, json.dumps(entries, separators=(",", ":")))
+                for channel_id, entries in windows
+            ]
+        )
+
+    def save_raw(self, windows: list[tuple]) -> None:
+        """Same as `save_many` but with the entries already json encoded"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO windows (channel_id, entries) VALUES (?, ?)",
+                [(self._key(channel_id), entries) for channel_id, entries in windows],
+            )
+
+    def take(self, channel_id) -> list | None:
+        """Loads a spilled window and removes it from the store, returns None if the channel was never spilled"""
+        key = self._key(channel_id)
+        row = self.connection.execute(
+            "SELECT entries FROM windows WHERE channel_id = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        with self.connection:
+            self.connection.execute("DELETE FROM windows WHERE channel_id = ?", (key,))
+        return json.loads(row[0])
+
+    def delete(self, channel_id) -> bool:
+        """Removes a spilled window, returns whether there was one"""
+        with self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM windows WHERE channel_id = ?", (self._key(channel_id),)
+            )
+        return cursor.rowcount > 0
+
+    def raw_rows(self) -> list[tuple]:
+        """Returns every spilled window as (json channel id, json entries) without decoding them"""
+        return self.connection.execute(
+            "SELECT channel_id, entries FROM windows"
+        ).fetchall()
+
+    def clear(self) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM windows")
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM windows").fetchone()[0]
+
+
+context_store = ContextStore(f"data/{CommonCalls.config().get('alias')}-context.db")
@@ -0,0 +1,168 @@
+"""
+Per-channel context window used by `ManagedMessages`.
+
+Message ids and texts are stored together so they can't drift apart, entries are kept in insertion order
+and indexed by message id, so appending, evicting the oldest message and removing a message by id are all O(1).
+A running token estimate is kept alongside so the window can also be trimmed to a token budget,
+as well as the rendered ("\n" joined) context so callers don't re-join the whole window on every read.
+"""
+
+import time
+
+from collections import OrderedDict
+from itertools import islice
+from typing import Iterator
+
+# Rough estimate used for budgeting, ~4 characters per token for english text
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate, +1 accounts for the newline joining messages together"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class ChannelWindow:
+
+    def __init__(self):
+        # seq -> (message_id, text, tokens)
+        self._entries: OrderedDict[int, tuple] = OrderedDict()
+        self._index: dict = {}  # message_id -> [seq, ...]
+        self._seq = 0
+        self.tokens = 0  # estimated tokens of every message in the window
+        # "\n" joined texts, kept up to date on append/evict, rebuilt lazily after a removal from the middle
+        self._text = ""
+        self._text_valid = True
+        self.last_used = time.monotonic()
+
+    @classmethod
+    def from_entries(cls, entries) -> "ChannelWindow":
+        """Rebuilds a window from (message_id, text) pairs, oldest first"""
+        window = cls()
+        # The joined text is built once on first read instead of on every append
+        window._text_valid = False
+        for message_id, text in entries:
+            window.append(message_id, text)
+        return window
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterates over the message texts, oldest first"""
+        return (text for _, text, _ in self._entries.values())
+
+    def __repr__(self) -> str:
+        return f"ChannelWindow({list(self)!r})"
+
+    def entries(self) -> Iterator[tuple]:
+        """Iterates over (message_id, text) pairs, oldest first"""
+        return ((message_id, text) for message_id, text, _ in self._entries.values())
+
+    def append(self, message_id, text: str) -> None:
+        """Appends a message, a message id can be added more than once"""
+        tokens = estimate_tokens(text)
+        self._seq += 1
+        self._entries[self._seq] = (message_id, text, tokens)
+        self._index.setdefault(message_id, []).append(self._seq)
+        self.tokens += tokens
+
+        if self._text_valid:
+            self._text = f"{self._text}\n{text}" if len(self._entries) > 1 else text
+
+    def evict_oldest(self) -> tuple | None:
+        """Removes and returns the oldest (message_id, text) pair"""
+        if not self._entries:
+            return None
+
+        seq, entry = self._entries.popitem(last=False)
+        self._unindex(entry, seq)
+
+        if self._text_valid:
+            self._text = self._text[len(entry[1]) + 1 :] if self._entries else ""
+        return entry[:2]
+
+    def remove(self, message_id) -> int:
+        """Removes every entry for `message_id`, returns how many were removed"""
+        seqs = self._index.pop(message_id, [])
+        for seq in seqs:
+            self.tokens -= self._entries.pop(seq)[2]
+
+        if seqs:
+            self._text_valid = False
+        return len(seqs)
+
+    def pop_index(self, index: int) -> tuple:
+        """Removes and returns the entry at `index` (negative indexes count from the newest), raises IndexError"""
+        if index < 0:
+            index += len(self._entries)
+        if not 0 <= index < len(self._entries):
+            raise IndexError("context window index out of range")
+
+        if index == 0:
+            return self.evict_oldest()
+
+        seq = next(islice(self._entries, index, None))
+        entry = self._entries.pop(seq)
+        self._unindex(entry, seq)
+        self._text_valid = False
+        return entry[:2]
+
+    @property
+    def text(self) -> str:
+        """The whole window joined with newlines, cached between mutations"""
+        if not self._text_valid:
+            self._text = "\n".join(self)
+            self._text_valid = True
+        return self._text
+
+    def render(self, token_budget: int = None) -> str:
+        """
+        Description:
+        Returns the context as it is sent to the model, the cached `text` when it fits in `token_budget`
+
+        Arguments:
+        token_budget : int = None
+
+        Returns:
+        str
+        """
+        if token_budget is None or self.tokens <= token_budget:
+            return self.text
+        return "\n".join(self.tail(token_budget))
+
+    def tail(self, token_budget: int) -> list[str]:
+        """
+        Description:
+        Returns the newest message texts that fit in `token_budget`, oldest first.
+        If not even the newest message fits, it is cut down to the budget.
+
+        Arguments:
+        token_budget : int
+
+        Returns:
+        list[str]
+        """
+        if self.tokens <= token_budget:
+            return list(self)
+
+        texts = []
+        remaining = token_budget
+        for _, text, tokens in reversed(self._entries.values()):
+            if tokens > remaining:
+                if not texts and remaining > 0:
+                    texts.append(text[: remaining * CHARS_PER_TOKEN])
+                break
+            texts.append(text)
+            remaining -= tokens
+
+        texts.reverse()
+        return texts
+
+    def _unindex(self, entry: tuple, seq: int) -> None:
+        message_id = entry[0]
+        self.tokens -= entry[2]
+        seqs = self._index[message_id]
+        seqs.remove(seq)
+        if not seqs:
+            del self._index[message_id]
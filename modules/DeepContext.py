@@ -3,15 +3,9 @@ Deep Context module for handling context-aware interactions and classifications
 """
 
 from modules.CommonCalls import CommonCalls
-from google import genai
+from modules.GeminiClient import generate, GenerationConfigs
 
-from google.genai.types import (
-    SafetySetting,
-    GenerateContentConfig,
-    GenerateContentResponse,
-)
-
-client = genai.Client(api_key=CommonCalls.config()["gemini_api_key"])
+from google.genai.types import GenerateContentResponse
 
 
 class DeepContext:
@@ -68,35 +62,9 @@ class DeepContext:
             Return as JSON: {"category": "category-name", "hidden-meaning": "identified meanings"}
             """
 
-            response: GenerateContentResponse = (
-                await client.aio.models.generate_content(
-                    contents=text,
-                    model=CommonCalls.config()["aiModel"],
-                    config=GenerateContentConfig(
-                        safety_settings=[
-                            SafetySetting(
-                                category="HARM_CATEGORY_HATE_SPEECH",
-                                threshold=CommonCalls.config()["filterHateSpeech"],
-                            ),
-                            SafetySetting(
-                                category="HARM_CATEGORY_HARASSMENT",
-                                threshold=CommonCalls.config()["filterHarassment"],
-                            ),
-                            SafetySetting(
-                                category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                                threshold=CommonCalls.config()[
-                                    "filterSexuallyExplicit"
-                                ],
-                            ),
-                            SafetySetting(
-                                category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                                threshold=CommonCalls.config()["filterDangerous"],
-                            ),
-                        ],
-                        system_instruction=system_instruction,
-                        response_mime_type="application/json",
-                    ),
-                )
+            response: GenerateContentResponse = await generate(
+                contents=text,
+                config=GenerationConfigs.json(system_instruction),
             )
 
             return CommonCalls.clean_json(response.text)
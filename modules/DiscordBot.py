@@ -2,48 +2,147 @@
 This is the API for discord interactions.
 """
 
+import asyncio
 import os
 import random
 
-from discord import Message
+from discord import Attachment, Message
 from discord.ext import commands
 from discord.file import VoiceMessage
 from modules.Memories import Memories
 from modules.Knowledge import Knowledge
-from modules.BotModel import read_prompt, BotModel, headless_BotModel
+from modules.BotModel import read_prompt, BotModel, InlineBudget, headless_BotModel
 from modules.ManagedMessages import ManagedMessages, headless_ManagedMessages
 from modules.AIAgent import AIAgent
 from modules.CommonCalls import CommonCalls
 from modules.Voice import VoiceMessages
 from modules.AudioUtils import AudioUtils
+from modules.ReplyStream import ReplyStream
+from modules.Admission import current_guild
 
-context_window = ManagedMessages().context_window
 memories = Memories()
 
+# Seconds a reply waits on memory recall and on intent classification before going on without them
+RECALL_TIMEOUT = 3.0
+CLASSIFY_TIMEOUT = 5.0
+
+# Deep context classifications still running after their reply was sent
+_agent_tasks: set[asyncio.Task] = set()
+
+# Attachments downloaded/uploaded at the same time for one message
+ATTACHMENT_CONCURRENCY = 4
+
+# Attachments Gemini can read, by extension
+MEDIA_TYPES = {
+    **dict.fromkeys((".png", ".jpg", ".webp", ".heic", ".heif"), "image"),
+    **dict.fromkeys((".mp4", ".mpeg", ".mov", ".wmv"), "video"),
+    **dict.fromkeys((".wav", ".mp3", ".aiff", ".aac", ".flac"), "audio"),
+    ".ogg": "voice",  # Discord voice notes
+}
+
+
+def media_type(filename: str) -> str | None:
+    return MEDIA_TYPES.get(os.path.splitext(filename.lower())[1])
+
+
+async def _read_media(attachment: Attachment, budget: InlineBudget):
+    """Images, videos and audio clips go into the request as they are"""
+    return await BotModel.attachment_media(attachment, budget)
+
+
+async def _transcribe(attachment: Attachment, budget: InlineBudget) -> str | None:
+    """Voice notes are transcribed and join the message as text"""
+    # Transcription is a request of its own, it doesn't use the reply's inline budget
+    media = await BotModel.attachment_media(attachment)
+    if media is None:
+        return None
+    try:
+        return await BotModel.speech_to_text(audio_file=media)
+    finally:
+        await BotModel.release_media(media)
+
+
+# What each media type turns into: a File/Part for the request, or text
+MEDIA_HANDLERS = {
+    "image": _read_media,
+    "video": _read_media,
+    "audio": _read_media,
+    "voice": _transcribe,
+}
+
+
+async def _recall(guild_id, channel_id, content: str) -> str | None:
+    """The memory recalled for a message, None if nothing matched or recall failed or timed out"""
+    try:
+        remembered_memories = await asyncio.wait_for(
+            memories.compare_memories(guild_id, channel_id, content), RECALL_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        print(
+            f"[DISCORDBOT] [WARNING] | Memory recall took over {RECALL_TIMEOUT}s, replying without memory"
+        )
+        return None
+    except Exception as E:
+        print(
+            f"[DISCORDBOT] [WARNING] | Memory recall failed, replying without memory: {E}"
+        )
+        return None
+
+    if isinstance(remembered_memories, list):
+        # compare_memories used to hand back a list from the LLM, the first entry is the answer
+        remembered_memories = remembered_memories[0]
+
+    if not remembered_memories.get("is_similar"):
+        return None
+    return memories.recall(guild_id, remembered_memories.get("similar_phrase"))
+
+
+async def _deep_context(content: str, ctx: commands.Context) -> None:
+    """Classifies the message and runs the matching agent action, never holds up the reply"""
+    try:
+        category = await asyncio.wait_for(
+            AIAgent.classify(content), CLASSIFY_TIMEOUT
+        )  # AGENT HOOK
+        await AIAgent.categorize(category, ctx)  # AGENT HOOK
+    except asyncio.TimeoutError:
+        print(
+            f"[DISCORDBOT] [WARNING] | Classification took over {CLASSIFY_TIMEOUT}s, skipped"
+        )
+    except Exception as E:
+        print(f"[DISCORDBOT] [WARNING] | Classification failed: {E}")
+
 
 class Gemini:
 
-    async def generate_response(message: Message, ctx: commands.Context):
-        """Accepts discord.Message object and auto-handles everything"""
+    async def generate_response(
+        message: Message,
+        ctx: commands.Context,
+        stream: ReplyStream = None,
+        earlier: list[Message] = None,
+    ):
+        """
+        Accepts discord.Message object and auto-handles everything.
+        With `stream` (and streamReplies on) plain text replies are posted progressively through it,
+        check `stream.messages` to know whether the reply was already sent.
+        `earlier` are messages folded into this reply (see modules/Coalescer.py), they are added to the context first
+        """
 
         message = ctx.message
         guild_id = ctx.guild.id
+        # Gemini calls made for this message queue with the guild's other calls (see modules/Admission.py)
+        current_guild.set(str(guild_id))
         channel_id = ctx.message.channel.id  # declare channel id for the context window
         message_id = ctx.message.id  # declare message id
         attachments = ctx.message.attachments  # declare message attachments
-        config = CommonCalls.config()
-        voice_mode_trigger_chance = config["voiceChance"]
+        settings = CommonCalls.settings()
         voice_response = False
-        if (
-            random.random() < float(voice_mode_trigger_chance)
-            and config["voiceMessages"] == "on"
-        ):
+        if random.random() < settings.voice_chance and settings.voice_messages:
             voice_response = True
 
-        if channel_id not in context_window:
-            context_window[channel_id] = (
-                []
-            )  # if channel id isnt present in context window, make a new key
+        for folded in earlier or ():
+            await ManagedMessages.add_to_message_list(
+                channel_id, folded.id, f"{folded.author.display_name}: {folded.content}"
+            )
 
         message_in_list = await ManagedMessages.add_to_message_list(
             channel_id,
@@ -53,156 +152,100 @@ class Gemini:
         # appends the message to the context window, "user: message"
         # auto manages context window size
 
-        remembered_memories = await memories.compare_memories(
-            guild_id, channel_id, message.content
-        )
-
-        if isinstance(remembered_memories, list):
-            _fix_memory = remembered_memories
-            debug_mode = CommonCalls.config().get("debugMode")
-            remembered_memories = _fix_memory[0]
-            if debug_mode == "on":
-                print("This is a list, DEBUG:")
-                print("remembered_memories = list")
-                print("index 0 of remembered_memories: ", remembered_memories[0])
-                print(
-                    "correcting type to dict. slashing any value after the first index"
-                )
-                print("corrected remembered:", remembered_memories)
-                print("type of: ", type(remembered_memories))
-
-                print("Remembered Memories:", remembered_memories)
-                print("Remembered Memories type:", type(remembered_memories))
-
-        if remembered_memories["is_similar"]:
-            prompt = read_prompt(
-                message,
-                memories.fetch_and_sort_entries(guild_id).get(
-                    remembered_memories.get("similar_phrase")
-                ),
-            )
-        else:
-            prompt = read_prompt(message)
-
-        if attachments and attachments[0].filename.lower().endswith(
-            (
-                ".png",
-                ".jpg",
-                ".webp",
-                ".heic",
-                ".heif",
-                ".mp4",
-                ".mpeg",
-                ".mov",
-                ".wmv",
+        if settings.auto_memories:
+            # Queues one snapshot for memory formation once the window has filled up, doesn't wait on it
+            await memories.save_to_memory(message, count=1 + len(earlier or ()))
+
+        # Every attachment Gemini can read is fetched at once, voice notes come back transcribed
+        readable = [
+            attachment
+            for attachment in attachments
+            if media_type(attachment.filename) is not None
+        ]
+        media = []
+        # Memory recall runs while attachments are downloaded and uploaded, the prompt waits on it
+        recall = asyncio.create_task(_recall(guild_id, channel_id, message.content))
+
+        try:
+            media, transcripts = (
+                await Gemini.gather_media(readable) if readable else ([], [])
             )
-        ):
-            # Checks if file type is one supported by Google Gemini
-            save_name = str(message.id) + " " + message.attachments[0].filename.lower()
-            await message.attachments[0].save(save_name)  # Saves attachment
-
-            file = await BotModel.upload_attachment(save_name)
-            response = await BotModel.generate_content(prompt, channel_id, file)
 
-            if CommonCalls.config()["JustGetRidOfTheName"] == "on":
-                response = CommonCalls.remove_multiple_name_prefixes(
-                    name=CommonCalls.load_character_details()["name"], text=response
+            content = message.content
+            if transcripts:
+                # Remove initial message appended, the voice notes join it as text
+                content = "\n".join(filter(None, [message.content, *transcripts]))
+                await ManagedMessages.remove_from_message_list(
+                    channel_id, message_in_list
                 )
-
-            if voice_response:
-                print("Voice mode triggered by random_chance")
-                file_name = await VoiceMessages.record_with_elevenlabs(
-                    text=response, save_file=f"tts_rsp_{message_id}.mp3"
+                await ManagedMessages.add_to_message_list(
+                    channel_id, message_id, f"{message.author.display_name}: {content}"
                 )
 
-                duration, waveform = AudioUtils.get_audio_metadata(file_name)
-                return (
-                    response,
-                    VoiceMessage(
-                        fp=file_name,
-                        duration_secs=duration,
-                        waveform=waveform,
-                    ),
+            if media:
+                # One multimodal request with every image, video and audio clip
+                prompt = read_prompt(message, await recall)
+                response = await BotModel.generate_content(prompt, channel_id, media)
+
+                if settings.just_get_rid_of_the_name:
+                    response = CommonCalls.remove_multiple_name_prefixes(
+                        name=CommonCalls.load_character_details()["name"], text=response
+                    )
+
+                if voice_response:
+                    print("Voice mode triggered by random_chance")
+                    file_name = await VoiceMessages.record_with_elevenlabs(
+                        text=response, save_file=f"tts_rsp_{message_id}.mp3"
+                    )
+
+                    duration, waveform = AudioUtils.get_audio_metadata(file_name)
+                    return (
+                        response,
+                        VoiceMessage(
+                            fp=file_name,
+                            duration_secs=duration,
+                            waveform=waveform,
+                        ),
+                    )
+                return response
+
+            if settings.deep_context and content:
+                # Classification only triggers agent actions, the reply doesn't need to wait for it
+                task = asyncio.create_task(_deep_context(content, ctx))
+                _agent_tasks.add(task)
+                task.add_done_callback(_agent_tasks.discard)
+
+            if not (
+                stream is not None
+                and settings.stream_replies
+                and not (settings.voice_messages and settings.voice_message_convo)
+            ):
+                stream = None
+            elif settings.just_get_rid_of_the_name:
+                name = CommonCalls.load_character_details()["name"]
+                stream.transform = (
+                    lambda text: CommonCalls.remove_multiple_name_prefixes(
+                        name=name, text=text
+                    )
                 )
 
-            # uploads using FileAPI
-
-            await ManagedMessages.add_to_message_list(
-                channel_id,
-                message_id,
-                f"{message.author.display_name}: {message.content}",
-            )
-
-            os.remove(save_name)
-            await BotModel.delete_attachment(file.name)
-            return response
-
-        # Add text file and audio support soon
-        elif attachments and attachments[0].filename.lower().endswith(
-            (".wav", ".mp3", ".aiff", ".aac", ".flac")
-        ):
-            # Audio handling
+            if settings.speculative_replies:
+                response = await Gemini.speculate(message, channel_id, recall, stream)
+            else:
+                response = await Gemini.reply(
+                    read_prompt(message, await recall), channel_id, stream
+                )  # DISCORDBOT.PY
 
-            save_name = str(message.id) + " " + message.attachments[0].filename.lower()
-            await message.attachments[0].save(save_name)
-            # Download the file
-
-            file = await BotModel.upload_attachment(save_name)
-            response = await BotModel.generate_content(
-                prompt=prompt, channel_id=channel_id, attachment=file
-            )
+            if stream is not None:
+                return response or settings.error_message
 
-            if CommonCalls.config()["JustGetRidOfTheName"] == "on":
-                response = CommonCalls.remove_multiple_name_prefixes(
-                    name=CommonCalls.load_character_details()["name"], text=response
-                )
-
-            if voice_response:
-                print("Voice mode triggered by random_chance")
-                file_name = await VoiceMessages.record_with_elevenlabs(
-                    text=response, save_file=f"tts_rsp_{message_id}.mp3"
-                )
-
-                duration, waveform = AudioUtils.get_audio_metadata(file_name)
-                return (
-                    response,
-                    VoiceMessage(
-                        fp=file_name,
-                        duration_secs=duration,
-                        waveform=waveform,
-                    ),
-                )
-
-            os.remove(save_name)
-            await BotModel.delete_attachment(file.name)
-            return response
-
-        elif attachments and attachments[0].filename.lower().endswith(".ogg"):
-
-            save_name = str(message.id) + " " + message.attachments[0].filename.lower()
-            await message.attachments[0].save(save_name)
-            file = await BotModel.upload_attachment(save_name)
-            stt_response = await BotModel.speech_to_text(audio_file=file)
-
-            # Remove initial message appended.
-            await ManagedMessages.remove_from_message_list(channel_id, message_in_list)
-
-            await ManagedMessages.add_to_message_list(
-                channel_id, message_id, f"{message.author.display_name}: {stt_response}"
-            )
-            # Add message from Voice note to list
-
-            response = await BotModel.generate_content(
-                prompt=prompt, channel_id=channel_id
-            )
-
-            if CommonCalls.config()["JustGetRidOfTheName"] == "on":
+            if settings.just_get_rid_of_the_name:
                 response = CommonCalls.remove_multiple_name_prefixes(
                     name=CommonCalls.load_character_details()["name"], text=response
                 )
 
             if (
-                config["voiceMessages"] == "on" and config["voiceMessageConvo"] == "on"
+                settings.voice_messages and settings.voice_message_convo
             ):  # TODO change the name of that
                 # this means the global setting voice messages is on and the user would like to do voice message to voice message
                 # so lets implement this now, lets first start off by generalizing voice call.py
@@ -219,58 +262,139 @@ class Gemini:
                         waveform=waveform,
                     ),
                 )
-
-            os.remove(save_name)
-            await BotModel.delete_attachment(file.name)
             return response
 
-        else:
-            if config["deepContext"] == "on":
-                category = await AIAgent.classify(message.content)  # AGENT HOOK
-                await AIAgent.categorize(category, ctx)  # AGENT HOOK
-
-            response = await BotModel.generate_content(
-                prompt, channel_id
-            )  # DISCORDBOT.PY
-
-            if CommonCalls.config()["JustGetRidOfTheName"] == "on":
-                response = CommonCalls.remove_multiple_name_prefixes(
-                    name=CommonCalls.load_character_details()["name"], text=response
-                )
-
-            if (
-                config["voiceMessages"] == "on" and config["voiceMessageConvo"] == "on"
-            ):  # TODO change the name of that
-                # this means the global setting voice messages is on and the user would like to do voice message to voice message
-                # so lets implement this now, lets first start off by generalizing voice call.py
-                file_name = await VoiceMessages.record_with_elevenlabs(
-                    text=response, save_file=f"tts_rsp_{message_id}.mp3"
-                )
-
-                duration, waveform = AudioUtils.get_audio_metadata(file_name)
-                return (
-                    response,
-                    VoiceMessage(
-                        fp=file_name,
-                        duration_secs=duration,
-                        waveform=waveform,
-                    ),
-                )
-            return response
+        finally:
+            recall.cancel()
+            for item in media:
+                await BotModel.release_media(item)
+
+    async def gather_media(attachments: list[Attachment]) -> tuple[list, list[str]]:
+        """
+        Description:
+        Runs every attachment through its `MEDIA_HANDLERS` entry, ATTACHMENT_CONCURRENCY at a time.
+        An attachment that can't be read is skipped, the rest still make it into the reply
+
+        Arguments:
+        attachments : list[discord.Attachment]
+
+        Returns:
+        (media, transcripts) : media for the request and voice note transcripts, both in attachment order
+        """
+        slots = asyncio.Semaphore(ATTACHMENT_CONCURRENCY)
+        # Shared, so all attachments together stay under Gemini's inline request limit
+        budget = InlineBudget()
+
+        async def handle(attachment: Attachment):
+            async with slots:
+                try:
+                    return await MEDIA_HANDLERS[media_type(attachment.filename)](
+                        attachment, budget
+                    )
+                except Exception as E:
+                    print(
+                        f"[DISCORDBOT] [WARNING] | Couldn't read attachment {attachment.filename}: {E}"
+                    )
+                    return None
+
+        tasks = [asyncio.create_task(handle(attachment)) for attachment in attachments]
+        try:
+            results = await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            # Release whatever was already uploaded, nobody else will
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+            for task in tasks:
+                if not task.cancelled() and not isinstance(task.result(), str):
+                    await BotModel.release_media(task.result())
+            raise
+        media = [
+            result
+            for result in results
+            if result is not None and not isinstance(result, str)
+        ]
+        transcripts = [result for result in results if isinstance(result, str)]
+        return media, transcripts
+
+    async def reply(
+        prompt, channel_id, stream: ReplyStream = None, gate: asyncio.Event = None
+    ) -> str:
+        """
+        Generates a text reply, progressively through `stream` when one is given.
+        Streamed text is held back until `gate` is set, so a speculative reply can still be thrown away unseen
+        """
+        if stream is None:
+            return await BotModel.generate_content(prompt, channel_id)
+
+        held = []
+        async for delta in BotModel.generate_content_stream(prompt, channel_id):
+            if gate is not None and not gate.is_set():
+                held.append(delta)
+                continue
+            if held:
+                delta = "".join(held) + delta
+                held.clear()
+            await stream.feed(delta)
+
+        if gate is not None:
+            await gate.wait()
+        if held:
+            await stream.feed("".join(held))
+        return await stream.finish()
+
+    async def speculate(
+        message: Message, channel_id, recall: asyncio.Task, stream: ReplyStream = None
+    ) -> str:
+        """
+        Description:
+        speculativeReplies: starts generating the reply without memory while memory recall is still running.
+        When recall finds nothing the speculative reply is used as is, it is the reply a prompt without memory gets anyway.
+        When recall finds a memory the speculative reply is discarded and generated again with the memory
+
+        Arguments:
+        message : discord.Message
+        channel_id
+        recall : asyncio.Task
+            resolves to the recalled memory or None
+        stream : ReplyStream = None
+
+        Returns:
+        response : str
+        """
+        gate = asyncio.Event()
+        speculative = asyncio.create_task(
+            Gemini.reply(read_prompt(message), channel_id, stream, gate)
+        )
+        try:
+            memory = await recall
+        except BaseException:
+            speculative.cancel()
+            raise
+
+        if memory is None:
+            gate.set()
+            return await speculative
+
+        speculative.cancel()
+        await asyncio.wait({speculative})
+        if not speculative.cancelled():
+            # Finished or failed before it could be cancelled, either way it's not used
+            speculative.exception()
+        if CommonCalls.settings().debug_mode:
+            print(
+                f"[DISCORDBOT] Recalled a memory in {channel_id}, speculative reply discarded"
+            )
+        return await Gemini.reply(read_prompt(message, memory), channel_id, stream)
 
 
 class headless_Gemini:
 
     async def generate_response(guild_id, channel_id, author_name, author_content):
-
+        current_guild.set(str(guild_id))
         if author_content in []:
             pass
 
-        if channel_id not in context_window:
-            context_window[channel_id] = (
-                []
-            )  # if channel id isnt present in context window, make a new key
-
         await headless_ManagedMessages.add_to_message_list(
             channel_id=channel_id, text=f"{author_name} : {author_content}"
         )
@@ -0,0 +1,214 @@
+"""
+Shared Google GenAI client and generation config factory.
+
+Every module used to build its own `genai.Client` at import time and rebuild the same four `SafetySetting`
+objects and a `GenerateContentConfig` on every call. This module keeps ONE client (so every call shares the
+same keep-alive connection pool) and hands out prebuilt configs per purpose, rebuilt only when the config changes.
+
+Content generation goes through `generate()` / `generate_stream()`, which wait for admission under the configured
+concurrency and quota limits (see `modules/Admission.py`), retry transient errors and fail fast while the API
+is down (see `modules/Resilience.py`).
+"""
+
+import httpx
+
+from google import genai
+from google.genai.types import (
+    GenerateContentConfig,
+    GenerateContentResponse,
+    HttpOptions,
+    SafetySetting,
+    Schema,
+)
+from modules.CommonCalls import CommonCalls
+from modules.Admission import admission, estimate_tokens
+from modules.Resilience import ResilientCaller
+from typing import AsyncIterator
+
+# Connections are kept alive between messages so we don't pay a TLS handshake on every call
+POOL_LIMITS = httpx.Limits(
+    max_connections=64, max_keepalive_connections=16, keepalive_expiry=120
+)
+
+client = genai.Client(
+    api_key=CommonCalls.config()["gemini_api_key"],
+    http_options=HttpOptions(
+        client_args={"limits": POOL_LIMITS},
+        async_client_args={"limits": POOL_LIMITS},
+    ),
+)
+
+# Shared by every generation call, so the retry budget and circuit breaker see all the traffic
+gemini_calls = ResilientCaller("gemini")
+
+STT_INSTRUCTION = """You are now a microphone, you will ONLY return the words in the audio file, DO NOT describe them.\n\n"""
+
+_configs: dict = {"version": None}
+
+
+class GenerationConfigs:
+    """
+    Prebuilt generation configs, one per purpose.
+    The returned objects are SHARED between every caller, treat them as read-only.
+    Use `GenerationConfigs.json(system_instruction)` for configs that need their own system instruction.
+    """
+
+    def _build() -> dict:
+        """Internal function, (re)builds every config when the config file changed"""
+        version = CommonCalls.config_version()
+        if _configs["version"] == version:
+            return _configs
+
+        settings = CommonCalls.settings()
+        safety_settings = [
+            SafetySetting(
+                category="HARM_CATEGORY_HATE_SPEECH",
+                threshold=settings.filter_hate_speech,
+            ),
+            SafetySetting(
+                category="HARM_CATEGORY_HARASSMENT",
+                threshold=settings.filter_harassment,
+            ),
+            SafetySetting(
+                category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                threshold=settings.filter_sexually_explicit,
+            ),
+            SafetySetting(
+                category="HARM_CATEGORY_DANGEROUS_CONTENT",
+                threshold=settings.filter_dangerous,
+            ),
+        ]
+
+        _configs["chat"] = GenerateContentConfig(
+            safety_settings=safety_settings,
+            temperature=settings.temperature,
+            top_p=settings.top_p,
+            top_k=settings.top_k,
+        )
+        _configs["json"] = GenerateContentConfig(
+            safety_settings=safety_settings,
+            response_mime_type="application/json",
+        )
+        _configs["stt"] = GenerateContentConfig(
+            safety_settings=safety_settings,
+            system_instruction=STT_INSTRUCTION,
+        )
+        _configs["summarize"] = GenerateContentConfig(
+            safety_settings=safety_settings,
+        )
+
+        _configs["version"] = version
+        if settings.debug_mode:
+            print(f"[GENAI] Rebuilt generation configs (config version {version})")
+        return _configs
+
+    def chat() -> GenerateContentConfig:
+        """Config for replies, safety settings and the sampling parameters from the config"""
+        return GenerationConfigs._build()["chat"]
+
+    def json(
+        system_instruction: str = None, response_schema: Schema = None
+    ) -> GenerateContentConfig:
+        """
+        Description:
+        Config for JSON classification calls, optionally constrained to `response_schema`
+
+        Arguments:
+        system_instruction : str = None
+        response_schema : Schema = None
+
+        Returns:
+        GenerateContentConfig
+        """
+        config: GenerateContentConfig = GenerationConfigs._build()["json"]
+        update = {}
+        if system_instruction is not None:
+            update["system_instruction"] = system_instruction
+        if response_schema is not None:
+            update["response_schema"] = response_schema
+        if not update:
+            return config
+
+        # Shallow copy, the safety settings are still shared
+        return config.model_copy(update=update)
+
+    def stt() -> GenerateContentConfig:
+        """Config for speech to text"""
+        return GenerationConfigs._build()["stt"]
+
+    def summarize() -> GenerateContentConfig:
+        """Config for summarization, safety settings only"""
+        return GenerationConfigs._build()["summarize"]
+
+
+async def generate(
+    contents, config: GenerateContentConfig = None, model: str = None, attempts=None
+) -> GenerateContentResponse:
+    """
+    Description:
+    `client.aio.models.generate_content` with retries, backoff and the circuit breaker
+
+    Arguments:
+    contents
+    config : GenerateContentConfig = None
+    model : str = None
+        defaults to aiModel
+    attempts : int = None
+        defaults to `gemini_calls.attempts`
+
+    Returns:
+    GenerateContentResponse
+    """
+    model = model or CommonCalls.settings().ai_model
+    async with admission.admit(model, estimate_tokens(contents)) as settle:
+        response: GenerateContentResponse = await gemini_calls.call(
+            lambda: client.aio.models.generate_content(
+                contents=contents, model=model, config=config
+            ),
+            attempts,
+        )
+        settle(_used_tokens(response))
+        return response
+
+
+async def generate_stream(
+    contents, config: GenerateContentConfig = None, model: str = None
+) -> AsyncIterator[GenerateContentResponse]:
+    """
+    Description:
+    Streaming `generate()`. Opening the stream and waiting for the first chunk is retried,
+    once a chunk was handed out an error is raised as is (the caller may have shown it already)
+
+    Returns:
+    AsyncIterator[GenerateContentResponse]
+    """
+    model = model or CommonCalls.settings().ai_model
+
+    async def first_chunk():
+        stream = await client.aio.models.generate_content_stream(
+            contents=contents, model=model, config=config
+        )
+        iterator = aiter(stream)
+        try:
+            return await anext(iterator), iterator
+        except StopAsyncIteration:
+            return None, iterator
+
+    # The slot is held until the stream is done
+    async with admission.admit(model, estimate_tokens(contents)) as settle:
+        first, iterator = await gemini_calls.call(first_chunk)
+        if first is None:
+            return
+
+        last = first
+        yield first
+        async for chunk in iterator:
+            last = chunk
+            yield chunk
+        # The usage totals come with the last chunk
+        settle(_used_tokens(last))
+
+
+def _used_tokens(response: GenerateContentResponse) -> int | None:
+    usage = getattr(response, "usage_metadata", None)
+    return usage.total_token_count if usage else None
@@ -1,25 +1,13 @@
 import json
-import os
-
-from google import genai
-from google.genai.types import (
-    GenerateContentConfig,
-    SafetySetting,
-    GenerateContentResponse,
-)
+
+from google.genai.types import GenerateContentResponse
 from discord import Message
 from modules.ManagedMessages import ManagedMessages
 from modules.CommonCalls import CommonCalls
+from modules.GeminiClient import generate, GenerationConfigs
+from modules.MemoryStore import memory_store
 from uuid import uuid4
 
-context_window = ManagedMessages.context_window
-
-client = genai.Client(api_key=CommonCalls.config()["gemini_api_key"])
-
-
-# JSON storage paths
-MEMORIES_FILE = f"data/{CommonCalls.config()['alias']}-memories.json"
-
 
 class Knowledge:
     def __init__(self):
@@ -30,57 +18,27 @@ class Knowledge:
         self.description = self.details["description"]
 
     async def summarize_context_window(self, channel_id, retry=3):
-        prompt = f"You're a data analyst who's only purpose is to summarize large but concise summaries on text provided to you, try to retain most of the information! Your first task is to summarize this conversation from the perspective of {self.character_name} --- Conversation Start ---\n{'\n'.join(context_window[channel_id])} --- Conversation End ---"
+        prompt = f"You're a data analyst who's only purpose is to summarize large but concise summaries on text provided to you, try to retain most of the information! Your first task is to summarize this conversation from the perspective of {self.character_name} --- Conversation Start ---\n{ManagedMessages.render(channel_id)} --- Conversation End ---"
 
-        response: GenerateContentResponse = await client.aio.models.generate_content(
+        response: GenerateContentResponse = await generate(
             contents=prompt,
-            model=CommonCalls.config()["aiModel"],
-            config=GenerateContentConfig(
-                safety_settings=[
-                    SafetySetting(
-                        category="HARM_CATEGORY_HATE_SPEECH",
-                        threshold=CommonCalls.config()["filterHateSpeech"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_HARASSMENT",
-                        threshold=CommonCalls.config()["filterHarassment"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        threshold=CommonCalls.config()["filterSexuallyExplicit"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                        threshold=CommonCalls.config()["filterDangerous"],
-                    ),
-                ],
-            ),
+            config=GenerationConfigs.summarize(),
+            attempts=retry,
         )
 
         try:
             return response.text
         except Exception as E:
             print(f"Error generating response: {E}")
-            retry_count = 0
-            while retry_count < retry:  # Adjust the retry count as needed
-                try:
-                    fall_back_response = response.candidates[0].content.parts
-                    return fall_back_response
-                except Exception as E:
-                    print(f"Error generating response (retry {retry_count}): {E}")
-                    retry_count += 1
-            else:
+            try:
+                return response.candidates[0].content.parts
+            except Exception as E:
+                print(f"Error generating response: {E}")
                 return ""
 
     def fetch_and_sort_entries(self, guild_id):
-        # Load the current memories from the JSON file
-        memories = self.load_memories()
-        print("fetch n sort pre sort: ", memories.keys())
-        key = str(guild_id)  # Ensure key consistency
-
-        # Get the memories for the specific channel, sorted by timestamp
-        sorted_memories = sorted(memories.get(key, []), key=lambda x: x["timestamp"])
-        print("fetch n sort post sort: ", memories.keys())
+        # The store returns the guild's memories already sorted by timestamp
+        sorted_memories = memory_store.entries(guild_id)
 
         # Create a dictionary with special_phrase as the key and memory as the value
         result = {entry["special_phrase"]: entry["memory"] for entry in sorted_memories}
@@ -91,7 +49,7 @@ class Knowledge:
         print(
             "Compare Memories function call `Memories.compare_memories` (Message from line 202 @ modules/Memories.py)"
         )
-        entries = self.fetch_and_sort_entries(guild_id).keys()
+        entries = memory_store.phrases(guild_id)
         print("This is entries from compare memories in modules/memories.py", entries)
         system_instruction = """
 Objective:
@@ -124,35 +82,13 @@ Provide your response in this JSON schema:
 without ANY formatting, i.e., no backticks '`', no syntax highlighting, no numbered lists.
 """
         message_list = f"""
-Context: {"\n".join(context_window[channel_id])}
+Context: {ManagedMessages.render(channel_id)}
 List of phrases: {", ".join(entries)}
 """
         try:
-            unloaded_json = await client.aio.models.generate_content(
+            unloaded_json = await generate(
                 contents=message_list,
-                model=CommonCalls.config()["aiModel"],
-                config=GenerateContentConfig(
-                    safety_settings=[
-                        SafetySetting(
-                            category="HARM_CATEGORY_HATE_SPEECH",
-                            threshold=CommonCalls.config()["filterHateSpeech"],
-                        ),
-                        SafetySetting(
-                            category="HARM_CATEGORY_HARASSMENT",
-                            threshold=CommonCalls.config()["filterHarassment"],
-                        ),
-                        SafetySetting(
-                            category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                            threshold=CommonCalls.config()["filterSexuallyExplicit"],
-                        ),
-                        SafetySetting(
-                            category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                            threshold=CommonCalls.config()["filterDangerous"],
-                        ),
-                    ],
-                    system_instruction=system_instruction,
-                    response_mime_type="application/json",
-                ),
+                config=GenerationConfigs.json(system_instruction),
             )
             clean_json = json.loads(self.clean_json(unloaded_json.text))
             # print(clean_json)
@@ -169,11 +105,8 @@ List of phrases: {", ".join(entries)}
 
     @staticmethod
     def load_memories():
-        """Load the memories from the JSON file."""
-        if not os.path.exists(MEMORIES_FILE):
-            return {}
-        with open(MEMORIES_FILE, "r") as file:
-            return json.load(file)
+        """Load every memory from the memory store, grouped by guild."""
+        return memory_store.dump()
 
     @staticmethod
     def convert_to_serializable(data):
@@ -190,9 +123,8 @@ List of phrases: {", ".join(entries)}
 
     def save_memories(self, memories):
         serializable_memories = self.convert_to_serializable(memories)
-        print(serializable_memories)
-        with open(MEMORIES_FILE, "w") as file:
-            json.dump(serializable_memories, file, indent=4)
+        saved = memory_store.replace_all(serializable_memories)
+        print(f"Saved {saved} memories for {len(serializable_memories)} guilds")
 
 
 # D:\Python\GEMINI\Gemini-AI-Bot-DONOTRELEASE\bot\spine_server.py
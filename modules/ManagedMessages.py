@@ -1,99 +1,302 @@
 import json
+import time
+
+from collections import OrderedDict
 from typing import Dict
 from modules.CommonCalls import CommonCalls
+from modules.ContextWindow import ChannelWindow, estimate_tokens
+from modules.ContextStore import context_store
+from modules.ContextJournal import context_journal
+
+# Idle channels are looked for at most this often (in seconds)
+IDLE_SWEEP_INTERVAL = 60.0
 
 
 class ManagedMessages:
 
-    context_window: Dict[str | int, list] = {}
-    managed_messages: Dict[str | int, list] = {}
+    # Resident windows in least -> most recently used order, idle ones are spilled to `context_store`
+    context_window: Dict[str | int, ChannelWindow] = OrderedDict()
+    stats: Dict[str, int] = {"hits": 0, "misses": 0, "page_ins": 0, "spills": 0}
+    _last_sweep = time.monotonic()
 
-    async def check_restrictions(message_list: list) -> bool:
-        """Internal function for checking if the context window is within 'X' items"""
-        if len(message_list) >= int(CommonCalls.config()["maxContext"]):
-            message_list.pop(0)  # removes the first element in the list
+    def get_window(channel_id: str | int, create: bool = True) -> ChannelWindow | None:
+        """
+        Description:
+        Returns the context window of a channel, paging it back in from disk if it was spilled.
+        Creates an empty one if it doesn't exist yet, unless `create` is False
+
+        Arguments:
+        channel_id : str | int
+        create : bool = True
+
+        Returns:
+        ChannelWindow | None
+        """
+        context_window = ManagedMessages.context_window
+        window = context_window.get(channel_id)
+
+        if window is not None:
+            ManagedMessages.stats["hits"] += 1
+            context_window.move_to_end(channel_id)
+        else:
+            entries = context_store.take(channel_id)
+            if entries is not None:
+                ManagedMessages.stats["page_ins"] += 1
+                window = ChannelWindow.from_entries(entries)
+            elif create:
+                ManagedMessages.stats["misses"] += 1
+                window = ChannelWindow()
+            else:
+                return None
+
+            context_window[channel_id] = window
+
+        window.last_used = time.monotonic()
+        ManagedMessages.enforce_limits()
+        return window
+
+    def enforce_limits() -> int:
+        """
+        Internal function, spills the least recently used windows to disk when there are more than `contextMaxChannels`
+        resident, and (at most every `IDLE_SWEEP_INTERVAL` seconds) every window idle for over `contextIdleSeconds`.
+        Returns the number of spilled windows
+        """
+        settings = CommonCalls.settings()
+        context_window = ManagedMessages.context_window
+        now = time.monotonic()
+
+        overflow = len(context_window) - max(settings.context_max_channels, 1)
+        sweep_idle = now - ManagedMessages._last_sweep >= IDLE_SWEEP_INTERVAL
+        if sweep_idle:
+            ManagedMessages._last_sweep = now
+        idle_before = now - settings.context_idle_seconds
+
+        # Windows are in least recently used order, so the first one we keep ends the scan
+        to_spill = []
+        for channel_id, window in context_window.items():
+            # The most recently used window is never spilled, it is the one being handed out
+            if len(to_spill) >= len(context_window) - 1:
+                break
+            if len(to_spill) < overflow or (
+                sweep_idle and window.last_used < idle_before
+            ):
+                to_spill.append(channel_id)
+            else:
+                break
+
+        if not to_spill:
+            return 0
+
+        windows = [context_window.pop(channel_id) for channel_id in to_spill]
+        context_store.save_many(
+            [
+                (channel_id, list(window.entries()))
+                for channel_id, window in zip(to_spill, windows)
+                if window
+            ]
+        )
+        ManagedMessages.stats["spills"] += len(to_spill)
+
+        if settings.debug_mode:
+            print(f"[CONTEXT] Spilled {len(to_spill)} idle context windows to disk")
+        return len(to_spill)
+
+    def restore() -> int:
+        """
+        Description:
+        Rebuilds every context window from the journal, call once at startup before any message is handled.
+        Only the `contextMaxChannels` most recently used windows are kept in memory, the rest go straight to disk
+
+        Returns:
+        int : number of restored channels
+        """
+        started = time.perf_counter()
+        # channel id -> ChannelWindow, or the json encoded entries of a snapshot nothing touched since
+        windows: Dict[str | int, ChannelWindow | str] = OrderedDict()
+        replayed = 0
+
+        for op in context_journal.replay():
+            try:
+                replayed += ManagedMessages._apply(windows, op)
+            except (IndexError, KeyError, TypeError, ValueError) as error:
+                print(f"[JOURNAL] Skipped bad record {op!r}: {error}")
+
+        # Spilled windows from the last run are superseded by the journal
+        context_store.clear()
+        context_window = ManagedMessages.context_window
+        context_window.clear()
+
+        resident = max(CommonCalls.settings().context_max_channels, 1)
+        spill = []
+        for position, (channel_id, window) in enumerate(windows.items()):
+            if position < len(windows) - resident:
+                if isinstance(window, ChannelWindow):
+                    window = json.dumps(list(window.entries()), separators=(",", ":"))
+                if window != "[]":
+                    spill.append((channel_id, window))
+            else:
+                if isinstance(window, str):
+                    window = ChannelWindow.from_entries(json.loads(window))
+                if window:
+                    context_window[channel_id] = window
+        context_store.save_raw(spill)
+
+        context_journal.snapshot = ManagedMessages.snapshot
+        if replayed:
+            # Only worth rewriting when the journal isn't a bare snapshot already
+            context_journal.compact()
+
+        print(
+            f"[JOURNAL] Restored {len(windows)} context windows ({len(spill)} spilled) in {time.perf_counter() - started:.3f}s"
+        )
+        return len(windows)
+
+    def _apply(windows: Dict[str | int, ChannelWindow | str], op: list) -> int:
+        """Internal function, replays one journal record onto `windows`. Returns 1 for mutations, 0 for snapshots"""
+        kind, channel_id = op[0], op[1]
+
+        if kind == "s":
+            windows[channel_id] = op[2]
+            windows.move_to_end(channel_id)
+            return 0
+
+        if kind == "w":
+            windows.pop(channel_id, None)
+            return 1
+
+        window = windows.get(channel_id)
+        if window is None:
+            window = windows[channel_id] = ChannelWindow()
+        elif isinstance(window, str):
+            window = windows[channel_id] = ChannelWindow.from_entries(
+                json.loads(window)
+            )
+
+        if kind == "a":
+            window.append(op[2], op[3])
+            ManagedMessages.trim(window)
+        elif kind == "r":
+            window.remove(op[2])
+        elif kind == "p":
+            window.pop_index(op[2])
+
+        # Keep the replayed windows in least -> most recently used order
+        windows.move_to_end(channel_id)
+        return 1
+
+    def snapshot() -> tuple[list, list]:
+        """
+        Description:
+        Captures every window for a journal snapshot. Only the (immutable) entries are copied,
+        the journal encodes them on its writer thread
+
+        Returns:
+        (resident, spilled) : [(channel_id, [(message_id, text), ...])], [(json channel id, json entries)]
+        """
+        resident = [
+            (channel_id, list(window.entries()))
+            for channel_id, window in ManagedMessages.context_window.items()
+            if window
+        ]
+        return resident, context_store.raw_rows()
+
+    def render(channel_id: str | int, token_budget: int = None) -> str:
+        """Returns the channel's context as one string, cached per channel and only rebuilt when the window changes"""
+        return ManagedMessages.get_window(channel_id).render(token_budget)
+
+    async def check_restrictions(window: ChannelWindow) -> bool:
+        """Internal function for checking if the context window is within 'X' items, evicts the oldest items if not"""
+        max_context = CommonCalls.settings().max_context
+        if len(window) >= max_context:
+            while window and len(window) >= max_context:
+                window.evict_oldest()
             return False
         else:
             return True
 
+    def trim(window: ChannelWindow) -> None:
+        """Internal function, evicts the oldest messages of a window until it is within `maxContext` and `contextWindow`"""
+        max_context = CommonCalls.settings().max_context
+        while window and len(window) > max_context:
+            window.evict_oldest()
+        ManagedMessages.check_token_budget(window)
+
+    def check_token_budget(window: ChannelWindow) -> int:
+        """
+        Internal function, evicts the oldest messages until the window fits in the `contextWindow` token budget.
+        The newest message is always kept, it gets cut down when the prompt is built instead (see `ChannelWindow.tail()`)
+        Returns the number of evicted messages
+        """
+        token_budget = CommonCalls.settings().context_window
+        evicted = 0
+        while window.tokens > token_budget and len(window) > 1:
+            window.evict_oldest()
+            evicted += 1
+        return evicted
+
+    def context_budget(*prompt_parts: str) -> int:
+        """Returns how many tokens of the `contextWindow` budget are left for the conversation once `prompt_parts` are sent"""
+        return CommonCalls.settings().context_window - sum(
+            estimate_tokens(part) for part in prompt_parts
+        )
+
     async def add_to_message_list(
         channel_id: str | int, message_id: str | int, message: str
     ) -> int:
         """
         Allows addition of an item to the message dictionary, has restraints called by `ManagedMessages.check_restrictions()`
-        Returns ID of message appended to list `ManagedMessages.managed_messages`
+        Returns ID of message appended to the context window
         """
 
-        context_window = ManagedMessages.context_window
-        managed_messages = ManagedMessages.managed_messages
+        window = ManagedMessages.get_window(channel_id)
 
-        if channel_id not in context_window:
-            context_window[channel_id] = []
-        if channel_id not in managed_messages:
-            managed_messages[channel_id] = []
+        await ManagedMessages.check_restrictions(window)
 
-        message_list = context_window[channel_id]
-        managed_message_list = managed_messages[channel_id]
-
-        await ManagedMessages.check_restrictions(message_list)
-        await ManagedMessages.check_restrictions(managed_message_list)
-
-        message_list.append(message)
-        managed_message_list.append(message_id)
+        window.append(message_id, message)
+        ManagedMessages.check_token_budget(window)
+        context_journal.record("a", channel_id, message_id, message)
 
         return message_id
 
     async def remove_from_message_list(
         channel_id: str | int, message_id: str | int
     ) -> None:
-        """Allows removal of an item from the message dictionary from the message id, will also update the message id list and message text list"""
+        """Allows removal of every item from the message dictionary with the message id"""
 
-        context_window = ManagedMessages.context_window
-        managed_messages = ManagedMessages.managed_messages
+        window = ManagedMessages.get_window(channel_id, create=False)
 
-        if channel_id in managed_messages and channel_id in context_window:
-            try:
-                # Filter out all occurrences of message_id in the list
-                managed_messages[channel_id] = [
-                    msg for msg in managed_messages[channel_id] if msg != message_id
-                ]
-                context_window[channel_id] = [
-                    text for text in context_window[channel_id] if text != message_id
-                ]
-            except Exception as e:
-                print(
-                    f"An error occurred while removing message ID {message_id} from channel {channel_id}: {e}"
-                )
+        if window is not None:
+            window.remove(message_id)
+            context_journal.record("r", channel_id, message_id)
         else:
             print(f"Channel ID {channel_id} not found.")
 
     async def remove_message_from_index(channel_id: str | int, index: int):
         """Allows removal of message from list with use of an index"""
 
-        context_window = ManagedMessages.context_window
-        managed_messages = ManagedMessages.managed_messages
+        window = ManagedMessages.get_window(channel_id, create=False)
 
         try:
-            context_window.pop(index)
-            managed_messages.pop(index)
-        except IndexError:
+            entry = window.pop_index(index)
+        except (IndexError, AttributeError):
             return None
 
+        context_journal.record("p", channel_id, index)
+        return entry
+
     async def remove_channel_from_list(channel_id: str | int):
         """Allows removal of channel ENTIRELY from the current dictionary"""
 
-        context_window = ManagedMessages.context_window
-        managed_messages = ManagedMessages.managed_messages
+        window = ManagedMessages.context_window.pop(channel_id, None)
+        spilled = context_store.delete(channel_id)
 
-        if channel_id in managed_messages and channel_id in context_window:
+        if window is not None or spilled:
+            context_journal.record("w", channel_id)
             message = (
                 CommonCalls.config()["wack_message"]
-                or f"Context window cleared! :ok_hand: [Removed {len(context_window[channel_id])}]"
+                or f"Context window cleared! :ok_hand: [Removed {len(window or ())}]"
             )
 
-            del managed_messages[channel_id]
-            del context_window[channel_id]
-
             return message
 
         else:
@@ -106,51 +309,50 @@ class ManagedMessages:
 class headless_ManagedMessages:
     """This class deals with instances of managed messages without... without something im not sure what"""
 
-    context_window: Dict[str | int, list] = {}
-    managed_messages: Dict[str | int, list] = {}
+    context_window: Dict[str | int, ChannelWindow] = {}
+
+    def get_window(channel_id: str | int) -> ChannelWindow:
+        """Returns the headless context window of a channel, creating an empty one if it doesn't exist yet"""
+        window = headless_ManagedMessages.context_window.get(channel_id)
+        if window is None:
+            window = headless_ManagedMessages.context_window[channel_id] = (
+                ChannelWindow()
+            )
+        return window
 
-    async def check_restrictions(message_list: list) -> bool:
+    async def check_restrictions(window: ChannelWindow) -> bool:
         """Internal function for checking if the context window is within 'X' items"""
-        if len(message_list) >= int(CommonCalls.config()["maxContext"]):
-            message_list.pop(0)  # removes the first element in the list
-            return False
-        else:
-            return True
+        return await ManagedMessages.check_restrictions(window)
 
     async def add_to_message_list(channel_id, text, check_restrictions=True):
         """
         Adds messages loosely to the headless message list
         """
 
-        context_window = headless_ManagedMessages.context_window
-
-        if channel_id not in context_window:
-            context_window[channel_id] = []
-
-        message_list: list = context_window[channel_id]
+        window = headless_ManagedMessages.get_window(channel_id)
 
         if check_restrictions:
-            await headless_ManagedMessages.check_restrictions(message_list)
+            await headless_ManagedMessages.check_restrictions(window)
 
         # pre apend
         print(
             "[PRE] Add to window function call `add_to_message_list` (Message from line 149 @ modules/ManagedMessages.py)"
         )
-        message_list.append(text)  # author : text
+        window.append(None, text)  # author : text
+        if check_restrictions:
+            ManagedMessages.check_token_budget(window)
         # post append
         print(
             "[POST] Add to window function call `add_to_message_list` (Message from line 152 @ modules/ManagedMessages.py)"
         )
-        print(message_list)
+        print(window)
 
     async def remove_message_from_index(channel_id: str | int, index: int):
         """Allows removal of message from list with use of an index"""
 
-        context_window = headless_ManagedMessages.context_window
-        managed_messages = headless_ManagedMessages.managed_messages
+        window = headless_ManagedMessages.context_window.get(channel_id)
 
         try:
-            context_window.pop(index)
-            managed_messages.pop(index)
-        except IndexError:
+            return window.pop_index(index)
+        except (IndexError, AttributeError):
             return None
@@ -0,0 +1,252 @@
+"""
+Shrinks media before it is sent to Gemini, inline or through FileAPI.
+
+Phone videos, huge PNGs and WAV captures used to be uploaded as they were, upload time and processing
+dominated those replies. Files over their type's byte budget are re-encoded with ffmpeg first:
+
+- images are scaled down (longest side IMAGE_MAX_SIDE and below) and saved as JPEG
+- videos become a low resolution 1 fps proxy, Gemini only samples 1 frame per second anyway
+- audio is re-encoded to mono Opus
+
+Bitrates are derived from the duration so the result fits the budget, media too long for the lowest
+bitrate is cut. ffmpeg runs as an async subprocess, at most PREP_CONCURRENCY at once. If anything goes
+wrong the original file is uploaded instead.
+"""
+
+import asyncio
+import json
+import mimetypes
+import os
+
+# Bytes per type, files at or under their budget are uploaded untouched
+BUDGETS = {
+    "image": 1_500_000,
+    "video": 8_000_000,
+    "audio": 2_000_000,
+}
+
+IMAGE_MAX_SIDE = 1536
+# (longest side, JPEG quality scale 2-31 lower is better), tried in order until the image fits
+IMAGE_LADDER = [(IMAGE_MAX_SIDE, 3), (1024, 5), (768, 8)]
+
+VIDEO_HEIGHT = 360
+VIDEO_MAX_KBPS = 600
+VIDEO_MIN_KBPS = 50
+VIDEO_AUDIO_KBPS = 32
+
+AUDIO_MAX_KBPS = 48
+AUDIO_MIN_KBPS = 8
+
+# Share of the budget left to the media streams, the rest is container overhead
+BUDGET_HEADROOM = 0.9
+
+PREP_CONCURRENCY = 2
+PREP_TIMEOUT = 120.0
+
+_slots = asyncio.Semaphore(PREP_CONCURRENCY)
+# Killed processes still being waited on
+_reaping: set[asyncio.Task] = set()
+
+
+def media_kind(path: str) -> str | None:
+    mime_type = mimetypes.guess_type(path)[0] or ""
+    kind = mime_type.split("/")[0]
+    return kind if kind in BUDGETS else None
+
+
+def over_budget(path: str, size: int) -> bool:
+    """Whether `MediaPrep.prepare` would re-encode a file of `size` bytes"""
+    kind = media_kind(path)
+    return kind is not None and size > BUDGETS[kind]
+
+
+async def _run(*args: str) -> tuple[int, bytes]:
+    """Runs a command, returns its exit code and stdout. Killed after PREP_TIMEOUT seconds or when cancelled"""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), PREP_TIMEOUT)
+    finally:
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            # Reaped in the background, a cancelled caller can't wait on it
+            _reap(process)
+    if process.returncode != 0:
+        print(
+            f"[MEDIAPREP] [WARNING] | {args[0]} exited with {process.returncode}: {stderr.decode(errors='replace')[-300:]}"
+        )
+    return process.returncode, stdout
+
+
+def _reap(process: asyncio.subprocess.Process) -> None:
+    task = asyncio.create_task(process.wait())
+    _reaping.add(task)
+    task.add_done_callback(_reaping.discard)
+
+
+async def _ffmpeg(*args: str) -> bool:
+    code, _ = await _run("ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args)
+    return code == 0
+
+
+async def _encode(target: str, *args: str) -> bool:
+    """Runs ffmpeg writing to `target`, which is removed unless the run succeeds (also on timeout or cancellation)"""
+    try:
+        ok = await _ffmpeg(*args, target)
+    except BaseException:
+        MediaPrep.discard(target)
+        raise
+    if not ok:
+        MediaPrep.discard(target)
+    return ok
+
+
+async def _duration(path: str) -> float | None:
+    code, stdout = await _run(
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration",
+        "-of",
+        "json",
+        path,
+    )
+    if code != 0:
+        return None
+    try:
+        return float(json.loads(stdout)["format"]["duration"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _fit(budget: int, duration: float, min_kbps: float, max_kbps: float):
+    """Total kbps that fits `budget` over `duration`, and the seconds to keep if even `min_kbps` doesn't fit"""
+    kbps = budget * 8 * BUDGET_HEADROOM / duration / 1000
+    if kbps >= min_kbps:
+        return min(kbps, max_kbps), None
+    return min_kbps, budget * 8 * BUDGET_HEADROOM / (min_kbps * 1000)
+
+
+class MediaPrep:
+
+    async def prepare(path: str) -> str:
+        """
+        Description:
+        Re-encodes `path` if it is over its type's budget
+
+        Arguments:
+        path : str
+
+        Returns:
+        str : the file to upload, a new file next to `path` or `path` itself. The caller removes a new file
+        """
+        if not over_budget(path, os.path.getsize(path)):
+            return path
+        kind = media_kind(path)
+
+        async with _slots:
+            try:
+                match kind:
+                    case "image":
+                        prepared = await MediaPrep.image(path)
+                    case "video":
+                        prepared = await MediaPrep.video(path)
+                    case "audio":
+                        prepared = await MediaPrep.audio(path)
+            except (OSError, asyncio.TimeoutError) as E:
+                print(f"[MEDIAPREP] [WARNING] | Couldn't prepare {path}: {E}")
+                prepared = None
+
+        if prepared is None:
+            return path
+        print(
+            f"[MEDIAPREP] {kind} {os.path.getsize(path) / 1e6:.1f}MB -> {os.path.getsize(prepared) / 1e6:.1f}MB"
+        )
+        return prepared
+
+    async def image(path: str) -> str | None:
+        target = f"{path}.prep.jpg"
+        for side, quality in IMAGE_LADDER:
+            scale = f"scale=w='min({side},iw)':h='min({side},ih)':force_original_aspect_ratio=decrease"
+            if not await _encode(
+                target, "-i", path, "-vf", scale, "-frames:v", "1", "-q:v", str(quality)
+            ):
+                break
+            if os.path.getsize(target) <= BUDGETS["image"]:
+                return target
+
+        # Still too big (or ffmpeg failed), whatever fits best is the smallest of the two
+        if os.path.exists(target) and os.path.getsize(target) < os.path.getsize(path):
+            return target
+        MediaPrep.discard(target)
+        return None
+
+    async def video(path: str) -> str | None:
+        duration = await _duration(path)
+        if not duration:
+            return None
+
+        total_kbps, keep = _fit(
+            BUDGETS["video"],
+            duration,
+            VIDEO_MIN_KBPS + VIDEO_AUDIO_KBPS,
+            VIDEO_MAX_KBPS + VIDEO_AUDIO_KBPS,
+        )
+        video_kbps = int(total_kbps - VIDEO_AUDIO_KBPS)
+        target = f"{path}.prep.mp4"
+        args = ["-i", path]
+        if keep is not None:
+            args += ["-t", f"{keep:.1f}"]
+        args += [
+            "-vf",
+            f"fps=1,scale=-2:'min({VIDEO_HEIGHT},ih)'",
+            "-c:v",
+            "libx264",
+            "-preset",
+            "veryfast",
+            "-b:v",
+            f"{video_kbps}k",
+            "-maxrate",
+            f"{video_kbps}k",
+            "-bufsize",
+            f"{video_kbps * 2}k",
+            "-c:a",
+            "aac",
+            "-b:a",
+            f"{VIDEO_AUDIO_KBPS}k",
+            "-ac",
+            "1",
+            "-movflags",
+            "+faststart",
+        ]
+        if not await _encode(target, *args):
+            return None
+        return target
+
+    async def audio(path: str) -> str | None:
+        duration = await _duration(path)
+        if not duration:
+            return None
+
+        kbps, keep = _fit(BUDGETS["audio"], duration, AUDIO_MIN_KBPS, AUDIO_MAX_KBPS)
+        target = f"{path}.prep.ogg"
+        args = ["-i", path]
+        if keep is not None:
+            args += ["-t", f"{keep:.1f}"]
+        args += ["-vn", "-c:a", "libopus", "-b:a", f"{int(kbps)}k", "-ac", "1"]
+        if not await _encode(target, *args):
+            return None
+        return target
+
+    def discard(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,27 +1,42 @@
+import asyncio
 import json
-import os
 
-from google import genai
-from google.genai.types import (
-    GenerateContentConfig,
-    SafetySetting,
-    GenerateContentResponse,
-)
+from google.genai.types import GenerateContentResponse, Schema
 from discord import Message
 from modules.ManagedMessages import ManagedMessages
 from modules.CommonCalls import CommonCalls
+from modules.GeminiClient import generate, GenerationConfigs
+from modules.Admission import current_guild
+from modules.MemoryStore import memory_store
+from modules.MemoryIndex import memory_index
+from modules.MemoryQueue import MemoryQueue, MemoryJob
+from modules.MemoryCompactor import memory_compactor
+from modules.Scheduler import Priority, scheduler
+from datetime import datetime, timezone
 from uuid import uuid4
 
-context_window = ManagedMessages.context_window
-
-client = genai.Client(api_key=CommonCalls.config()["gemini_api_key"])
-
-
-# JSON storage paths
-MEMORIES_FILE = f"data/{CommonCalls.config()['alias']}-memories.json"
+# How much of the recent conversation is used as the recall query
+RECALL_QUERY_TOKENS = 256
+# How many of the best scoring phrases are handed to the LLM when re-ranking (memoryRerank)
+RECALL_CANDIDATES = 5
+
+# Memory formation is one schema constrained call, see `Memories.remember_context`
+MEMORY_SCHEMA = Schema(
+    type="OBJECT",
+    properties={
+        "summary": Schema(type="STRING"),
+        "is_worth": Schema(type="BOOLEAN"),
+        "special_phrase": Schema(type="STRING", nullable=True),
+    },
+    required=["summary", "is_worth", "special_phrase"],
+    property_ordering=["summary", "is_worth", "special_phrase"],
+)
 
 
 class Memories:
+    # channel_id -> messages seen since the channel's last snapshot, shared by every instance
+    messages_since_memory: dict = {}
+
     def __init__(self):
         self.details = CommonCalls.load_character_details()
         self.character_name = self.details["name"]
@@ -29,117 +44,89 @@ class Memories:
         self.age = self.details["age"]
         self.description = self.details["description"]
 
-    async def summarize_context_window(self, channel_id, retry=3):
-        prompt = f"You're a data analyst who's only purpose is to summarize large but concise summaries on text provided to you, try to retain most of the information! Your first task is to summarize this conversation from the perspective of {self.character_name} --- Conversation Start ---\n{'\n'.join(context_window[channel_id])} --- Conversation End ---"
-
-        response: GenerateContentResponse = await client.aio.models.generate_content(
-            contents=prompt,
-            model=CommonCalls.config()["aiModel"],
-            config=GenerateContentConfig(
-                safety_settings=[
-                    SafetySetting(
-                        category="HARM_CATEGORY_HATE_SPEECH",
-                        threshold=CommonCalls.config()["filterHateSpeech"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_HARASSMENT",
-                        threshold=CommonCalls.config()["filterHarassment"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        threshold=CommonCalls.config()["filterSexuallyExplicit"],
-                    ),
-                    SafetySetting(
-                        category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                        threshold=CommonCalls.config()["filterDangerous"],
-                    ),
-                ],
-            ),
-        )
-
-        try:
-            return response.text
-        except Exception as E:
-            print(f"Error generating response: {E}")
-            retry_count = 0
-            while retry_count < retry:  # Adjust the retry count as needed
-                try:
-                    fall_back_response = response.candidates[0].content.parts
-                    return fall_back_response
-                except Exception as E:
-                    print(f"Error generating response (retry {retry_count}): {E}")
-                    retry_count += 1
-            else:
-                return ""
-
-    async def save_to_memory(self, message: Message, force=False):
+    async def save_to_memory(self, message: Message, force=False, count=1):
+        """
+        Description:
+        Hands a snapshot of the channel's context window to the background `memory_queue`, once every
+        maxContext messages (a full window of new messages) or right away with `force`.
+        Never waits on the model, the memory itself is formed by `Memories.form_memory`
+
+        Arguments:
+        message : discord.Message
+            the newest message in the window
+        force : bool = False
+        count : int = 1
+            messages added to the window since the last call, a coalesced burst counts every message
+
+        Returns:
+        bool : whether a snapshot was queued
+        """
         debug_mode = CommonCalls.config().get("debugMode")
         if debug_mode == "on":
             print(
                 "Save to memory function call `Memories.save_to_memory` (Message from line 98 @ modules/Memories.py)"
             )
         _channel_id = message.channel.id
-        guild_id = message.guild.id
-        key = str(guild_id)  # Ensure key consistency
 
-        # Load the current memories from the JSON file
-        memories = self.load_memories()
+        seen = self.messages_since_memory.get(_channel_id, 0) + count
+        if not force and seen < CommonCalls.settings().max_context:
+            self.messages_since_memory[_channel_id] = seen
+            return False
+
+        self.messages_since_memory[_channel_id] = 0
+        return memory_queue.submit(
+            MemoryJob(
+                guild_id=message.guild.id,
+                channel_id=_channel_id,
+                context=ManagedMessages.render(_channel_id),
+                timestamp=message.created_at.isoformat(),
+                force=force,
+            )
+        )
 
-        if force or len(context_window[_channel_id]) == int(
-            CommonCalls.config()["maxContext"]
-        ):
-            summary_of_context_window = await self.summarize_context_window(
-                _channel_id
-            )  # for its contextwindow call
-            special_phrase = (
-                await self.is_worth_remembering(
-                    context="\n".join(context_window[_channel_id])
+    async def form_memory(self, job: MemoryJob):
+        """Summarizes a queued context window snapshot and saves it, runs on the `memory_queue` workers"""
+        guild_id = job.guild_id
+        current_guild.set(str(guild_id))
+        remembered = await self.remember_context(job.context)
+        special_phrase = remembered["special_phrase"]
+
+        if not remembered["is_worth"] and not job.force:
+            debug_mode = CommonCalls.config().get("debugMode")
+            if debug_mode == "on":
+                print(
+                    f"[MEMORIES] Conversation in {job.channel_id} isn't worth remembering, skipped"
                 )
-            )["special_phrase"]
-            if special_phrase == None or special_phrase == "":
-                debug_mode = CommonCalls.config().get("debugMode")
-                if debug_mode == "on":
-                    print(
-                        f"[Warning] modules/Memories.py `save_to_memory` force_level = {force}. Special phrase is none. a uuid is being assigned."
-                    )
-
-                memory_entry = {
-                    "memory_id": str(uuid4()),
-                    "special_phrase": str(uuid4()),
-                    "memory": summary_of_context_window,
-                    "timestamp": message.created_at.isoformat(),
-                }
-            else:
-                memory_entry = {
-                    "memory_id": str(uuid4()),
-                    "special_phrase": special_phrase,
-                    "memory": summary_of_context_window,
-                    "timestamp": message.created_at.isoformat(),
-                }
-
-            # Append to the existing memories
-            memories[key] = memories.get(key, []) + [memory_entry]
-
-            # Save the updated memories back to the JSON file
-            self.save_memories(memories)
+            return None
 
-            print(
-                f"Saved message: {special_phrase}\nTo memory: {summary_of_context_window}\nFor: {guild_id}"
-            )
+        if special_phrase == None or special_phrase == "":
+            debug_mode = CommonCalls.config().get("debugMode")
+            if debug_mode == "on":
+                print(
+                    f"[Warning] modules/Memories.py `form_memory` force_level = {job.force}. Special phrase is none. a uuid is being assigned."
+                )
+            special_phrase = str(uuid4())
+
+        memory_entry = {
+            "memory_id": str(uuid4()),
+            "special_phrase": special_phrase,
+            "memory": remembered["summary"],
+            "timestamp": job.timestamp,
+        }
+
+        # Only this memory is written, the rest of the guild's memories aren't touched
+        memory_store.upsert(guild_id, [memory_entry])
+        # Dedup + retention (memoryWindow) for the guild, in the background
+        memory_compactor.schedule(guild_id)
+
+        print(
+            f"Saved message: {special_phrase}\nTo memory: {remembered['summary']}\nFor: {guild_id}"
+        )
+        return memory_entry
 
     def fetch_and_sort_entries(self, guild_id):
-        # Load the current memories from the JSON file
-        memories = self.load_memories()
-        debug_mode = CommonCalls.config().get("debugMode")
-        if debug_mode == "on":
-            print("fetch n sort pre sort: ", memories.keys())
-        key = str(guild_id)  # Ensure key consistency
-
-        # Get the memories for the specific channel, sorted by timestamp
-        sorted_memories = sorted(memories.get(key, []), key=lambda x: x["timestamp"])
-        debug_mode = CommonCalls.config().get("debugMode")
-        if debug_mode == "on":
-            print("fetch n sort post sort: ", memories.keys())
+        """Returns {special_phrase: memory} for a guild, oldest first. Prefer `recall()` for single lookups"""
+        sorted_memories = memory_store.entries(guild_id)
 
         # Create a dictionary with special_phrase as the key and memory as the value
         result = {entry["special_phrase"]: entry["memory"] for entry in sorted_memories}
@@ -148,15 +135,59 @@ class Memories:
             print("fetch n sort emitted result: ", result)
         return result
 
-    async def is_worth_remembering(self, context):
+    def recall(self, guild_id, special_phrase: str):
+        """Returns the newest memory saved under `special_phrase`, using the store's phrase index"""
+        memory = memory_store.lookup(guild_id, special_phrase)
+        if memory is not None:
+            # Recalled memories score higher when the compactor enforces memoryWindow
+            memory_store.record_use(
+                guild_id, special_phrase, datetime.now(timezone.utc).isoformat()
+            )
+        return memory
+
+    async def roll_up(self, entries: list[dict]) -> dict:
+        """Summarizes old memories into one higher level memory, used by the compactor with memoryRollups on"""
+        context = "\n".join(
+            f"[{entry.get('timestamp')}] {entry.get('special_phrase')}: {entry.get('memory')}"
+            for entry in entries
+        )
+        remembered = await self.remember_context(context)
+        return {
+            "memory_id": str(uuid4()),
+            "special_phrase": remembered["special_phrase"]
+            or entries[-1].get("special_phrase"),
+            "memory": remembered["summary"],
+            # Its sources were evicted for being stale, with their timestamp the rollup would be next in line
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "level": max(entry.get("level", 0) for entry in entries) + 1,
+            "rolled_up": [entry.get("memory_id") for entry in entries],
+        }
+
+    async def remember_context(self, context: str) -> dict:
+        """
+        Description:
+        Summarizes a conversation and decides whether it is worth remembering in ONE schema constrained call
+
+        Arguments:
+        context : str
+
+        Returns:
+        dict : {"summary": str, "is_worth": bool, "special_phrase": str | None}
+
+        Raises:
+        ValueError : the model's answer didn't match `MEMORY_SCHEMA` (the memory queue retries the job)
+        """
         debug_mode = CommonCalls.config().get("debugMode")
         if debug_mode == "on":
             print(
-                "Worth Remembering function call `Memories.is_worth_remembering` (Message from line 131 @ modules/Memories.py)"
+                "Remember Context function call `Memories.remember_context` (Message from line 131 @ modules/Memories.py)"
             )
-        system_instruction = """
+        system_instruction = f"""
 Objective:
-Determine whether a conversation is worth remembering based on predefined criteria and if it is, provide a highly detailed phrase summarizing the entire conversation that you'd remember.
+Summarize a conversation from the perspective of {self.character_name}, determine whether it is worth remembering based on predefined criteria and if it is, provide a highly detailed phrase summarizing the entire conversation that you'd remember.
+
+Summary:
+Write a large but concise summary of the conversation, try to retain most of the information.
 
 Guidelines:
 1. **Relevance**: The conversation should be directly relevant to ongoing or important topics.
@@ -171,57 +202,95 @@ Instructions:
     a. Provides new, useful information relevant to current tasks or goals.
     b. Leads to specific actions or decisions that can be implemented.
     c. Contains emotionally significant interactions worth preserving.
-4. If the conversation is relevant, provide a phrase that when said, you'd remember the summary of this conversation.
-
-Provide your response in a JSON format {"is_worth" : true/false, "special_phrase" : phrase_goes_here} without ANY formatting, ie.. no backticks '`' no syntax highlighting, no numbered lists.'
-    """
+4. If the conversation is relevant, provide a phrase that when said, you'd remember the summary of this conversation. Otherwise the phrase is null.
+"""
 
+        response: GenerateContentResponse = await generate(
+            contents=f"--- Conversation Start ---\n{context}\n--- Conversation End ---",
+            config=GenerationConfigs.json(system_instruction, MEMORY_SCHEMA),
+        )
         try:
-            unloaded_json: GenerateContentResponse = (
-                await client.aio.models.generate_content(
-                    contents=context,
-                    model=CommonCalls.config()["aiModel"],
-                    config=GenerateContentConfig(
-                        safety_settings=[
-                            SafetySetting(
-                                category="HARM_CATEGORY_HATE_SPEECH",
-                                threshold=CommonCalls.config()["filterHateSpeech"],
-                            ),
-                            SafetySetting(
-                                category="HARM_CATEGORY_HARASSMENT",
-                                threshold=CommonCalls.config()["filterHarassment"],
-                            ),
-                            SafetySetting(
-                                category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                                threshold=CommonCalls.config()[
-                                    "filterSexuallyExplicit"
-                                ],
-                            ),
-                            SafetySetting(
-                                category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                                threshold=CommonCalls.config()["filterDangerous"],
-                            ),
-                        ],
-                        system_instruction=system_instruction,
-                        response_mime_type="application/json",
-                    ),
-                )
-            )
-            clean_json = json.loads(self.clean_json(unloaded_json.text))
-            return clean_json
-        except Exception as E:
-            print(E)
+            remembered = json.loads(self.clean_json(response.text))
+        except (json.JSONDecodeError, TypeError) as E:
+            raise ValueError(f"memory response isn't valid JSON: {E}") from E
+
+        return self.validate_memory(remembered)
+
+    @staticmethod
+    def validate_memory(remembered) -> dict:
+        """Checks a `remember_context` answer against `MEMORY_SCHEMA`, raises ValueError"""
+        if not isinstance(remembered, dict):
+            raise ValueError(f"expected a JSON object, got {type(remembered).__name__}")
+
+        summary = remembered.get("summary")
+        if not isinstance(summary, str) or not summary.strip():
+            raise ValueError("memory response has no summary")
+
+        is_worth = remembered.get("is_worth")
+        if not isinstance(is_worth, bool):
+            raise ValueError(f"is_worth must be a boolean, got {is_worth!r}")
+
+        special_phrase = remembered.get("special_phrase")
+        if special_phrase is not None and not isinstance(special_phrase, str):
+            raise ValueError(f"special_phrase must be a string, got {special_phrase!r}")
+
+        return {
+            "summary": summary.strip(),
+            "is_worth": is_worth,
+            "special_phrase": special_phrase.strip() if special_phrase else None,
+        }
 
     async def compare_memories(self, guild_id, channel_id, message):
-        debug_mode = CommonCalls.config().get("debugMode")
-        if debug_mode == "on":
+        """
+        Description:
+        Finds the memory closest to the recent conversation using the local `memory_index`, no network call.
+        With `memoryRerank` on, the best candidates are re-ranked by the LLM (`Memories.rerank_memories`)
+
+        Returns:
+        dict : {"is_similar": bool, "similar_phrase": str | None}
+        """
+        settings = CommonCalls.settings()
+        query = f"{ManagedMessages.render(channel_id, RECALL_QUERY_TOKENS)}\n{message}"
+        # A rebuild after writes to a big guild takes a while, it runs off the event loop
+        results = await asyncio.to_thread(
+            memory_index.search, guild_id, query, RECALL_CANDIDATES
+        )
+        candidates = [
+            (phrase, score)
+            for phrase, score in results
+            if phrase and score >= settings.memory_recall_threshold
+        ]
+        if settings.debug_mode:
             print(
-                "Compare Memories function call `Memories.compare_memories` (Message from line 202 @ modules/Memories.py)"
+                "Compare Memories function call `Memories.compare_memories` candidates:",
+                candidates,
             )
-        entries = self.fetch_and_sort_entries(guild_id).keys()
+
+        if not candidates:
+            return {"is_similar": False, "similar_phrase": None}
+
+        best = {"is_similar": True, "similar_phrase": candidates[0][0]}
+        if not settings.memory_rerank or len(candidates) == 1:
+            return best
+
+        reranked = await self.rerank_memories(
+            channel_id, [phrase for phrase, _ in candidates]
+        )
+        if isinstance(reranked, list) and reranked:
+            reranked = reranked[0]
+        # Only trust the LLM's pick if it is one of the candidates, otherwise keep the local best
+        if isinstance(reranked, dict) and reranked.get("similar_phrase") in dict(
+            candidates
+        ):
+            return reranked
+        return best
+
+    async def rerank_memories(self, channel_id, entries: list[str]):
+        """Asks the LLM which of `entries` matches the conversation best, returns the same shape as `compare_memories`"""
+        debug_mode = CommonCalls.config().get("debugMode")
         if debug_mode == "on":
             print(
-                "This is entries from compare memories in modules/memories.py", entries
+                "This is entries from rerank memories in modules/memories.py", entries
             )
         system_instruction = """
 Objective:
@@ -254,35 +323,13 @@ Provide your response in this JSON schema:
 without ANY formatting, i.e., no backticks '`', no syntax highlighting, no numbered lists.
 """
         message_list = f"""
-Context: {"\n".join(context_window[channel_id])}
+Context: {ManagedMessages.render(channel_id)}
 List of phrases: {", ".join(entries)}
 """
         try:
-            unloaded_json = await client.aio.models.generate_content(
+            unloaded_json = await generate(
                 contents=message_list,
-                model=CommonCalls.config()["aiModel"],
-                config=GenerateContentConfig(
-                    safety_settings=[
-                        SafetySetting(
-                            category="HARM_CATEGORY_HATE_SPEECH",
-                            threshold=CommonCalls.config()["filterHateSpeech"],
-                        ),
-                        SafetySetting(
-                            category="HARM_CATEGORY_HARASSMENT",
-                            threshold=CommonCalls.config()["filterHarassment"],
-                        ),
-                        SafetySetting(
-                            category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                            threshold=CommonCalls.config()["filterSexuallyExplicit"],
-                        ),
-                        SafetySetting(
-                            category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                            threshold=CommonCalls.config()["filterDangerous"],
-                        ),
-                    ],
-                    system_instruction=system_instruction,
-                    response_mime_type="application/json",
-                ),
+                config=GenerationConfigs.json(system_instruction),
             )
             clean_json = json.loads(self.clean_json(unloaded_json.text))
             # print(clean_json)
@@ -299,11 +346,8 @@ List of phrases: {", ".join(entries)}
 
     @staticmethod
     def load_memories():
-        """Load the memories from the JSON file."""
-        if not os.path.exists(MEMORIES_FILE):
-            return {}
-        with open(MEMORIES_FILE, "r") as file:
-            return json.load(file)
+        """Load every memory from the memory store, grouped by guild."""
+        return memory_store.dump()
 
     @staticmethod
     def convert_to_serializable(data):
@@ -320,6 +364,14 @@ List of phrases: {", ".join(entries)}
 
     def save_memories(self, memories):
         serializable_memories = self.convert_to_serializable(memories)
-        print(serializable_memories)
-        with open(MEMORIES_FILE, "w") as file:
-            json.dump(serializable_memories, file, indent=4)
+        saved = memory_store.replace_all(serializable_memories)
+        print(f"Saved {saved} memories for {len(serializable_memories)} guilds")
+
+
+# Memory work runs as BACKGROUND jobs, behind every reply
+memory_queue = MemoryQueue(
+    lambda job: scheduler.run(Priority.BACKGROUND, lambda: Memories().form_memory(job))
+)
+memory_compactor.rollup = lambda entries: scheduler.run(
+    Priority.BACKGROUND, lambda: Memories().roll_up(entries)
+)
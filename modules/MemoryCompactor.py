@@ -0,0 +1,274 @@
+"""
+Memory retention, deduplication and rollups.
+
+After a guild gains a memory, `MemoryCompactor.schedule()` runs an incremental compaction of that guild:
+
+1. Up to `COMPACT_BATCH` memories without a simhash (new or edited) are hashed (`MemoryIndex.simhash`).
+2. Memories added since the last run (the guild's watermark, a rowid) and the memories just hashed are
+   checked against the whole guild for near duplicates (simhashes at most `SIMHASH_DISTANCE` bits apart).
+   The newest copy is kept and inherits the usage of the ones it absorbs. Candidates come from banded
+   lookups, not a pairwise scan.
+3. If the guild holds more than `memoryWindow` memories, the lowest scoring ones are evicted, at most
+   `EVICT_BATCH` per run. The score
+   mixes recency (last saved or recalled) with how often the memory was recalled. With `memoryRollups` on,
+   evicted memories are summarized into one higher level memory instead of being dropped.
+
+Every step is bounded per run, so even a guild with 100k memories compacts in bounded time and simply
+catches up over the next runs.
+"""
+
+import asyncio
+import math
+
+import numpy as np
+
+from typing import Awaitable, Callable
+
+from modules.Admission import current_guild
+from modules.CommonCalls import CommonCalls
+from modules.MemoryIndex import SIMHASH_BITS, SIMHASH_MASK, hamming, simhash
+from modules.MemoryStore import memory_store
+
+# Memories hashed, and checked for duplicates, per run
+COMPACT_BATCH = 2000
+# Memories evicted per run without rollups, a guild far over its window catches up over the next runs
+EVICT_BATCH = 2000
+# Simhashes at most this many bits apart are duplicates
+SIMHASH_DISTANCE = 6
+# With one band more than the allowed distance, duplicates always share at least one whole band
+BANDS = SIMHASH_DISTANCE + 1
+BAND_BITS = SIMHASH_BITS // BANDS
+
+# Retention score = RECENCY_WEIGHT * recency rank + USAGE_WEIGHT * log scaled recalls, both in [0, 1]
+RECENCY_WEIGHT = 0.7
+USAGE_WEIGHT = 0.3
+
+# memoryRollups: evicted memories are summarized ROLLUP_SIZE at a time, at most MAX_ROLLUPS_PER_RUN calls per run
+ROLLUP_SIZE = 10
+MAX_ROLLUPS_PER_RUN = 5
+
+
+def _bands(value: int) -> list[tuple[int, int]]:
+    return [
+        (band, (value >> (band * BAND_BITS)) & ((1 << BAND_BITS) - 1))
+        for band in range(BANDS)
+    ]
+
+
+class MemoryCompactor:
+
+    def __init__(self, store=memory_store):
+        self.store = store
+        # Summarizes a list of memory entries into one, set by `Memories`
+        self.rollup: Callable[[list[dict]], Awaitable[dict]] | None = None
+        self.counters = {
+            "runs": 0,
+            "hashed": 0,
+            "merged": 0,
+            "evicted": 0,
+            "rollups": 0,
+        }
+        self._running: dict[str, asyncio.Task] = {}
+        self._again: set[str] = set()
+
+    def schedule(self, guild_id) -> None:
+        """Compacts the guild in the background, a guild is never compacted twice at the same time"""
+        key = str(guild_id)
+        if key in self._running:
+            self._again.add(key)
+            return
+        self._running[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key: str) -> None:
+        current_guild.set(key)
+        try:
+            while True:
+                self._again.discard(key)
+                await self.compact(key)
+                if key not in self._again:
+                    break
+        except Exception as E:
+            print(f"[MEMORY COMPACTOR] [ERROR] | Compacting {key} failed: {E}")
+        finally:
+            del self._running[key]
+
+    async def compact(self, guild_id) -> None:
+        settings = CommonCalls.settings()
+        merged = await asyncio.to_thread(self.deduplicate, guild_id)
+        evicted = await asyncio.to_thread(
+            self.select_evictions,
+            guild_id,
+            settings.memory_window,
+            settings.memory_rollups and self.rollup is not None,
+        )
+
+        if evicted and settings.memory_rollups and self.rollup is not None:
+            await self.roll_up(guild_id, evicted)
+        elif evicted:
+            await asyncio.to_thread(self.store.remove, guild_id, evicted)
+            self.counters["evicted"] += len(evicted)
+
+        self.counters["runs"] += 1
+        if settings.debug_mode:
+            print(
+                f"[MEMORY COMPACTOR] {guild_id}: merged {merged} duplicates, evicted {len(evicted)}"
+            )
+
+    def deduplicate(self, guild_id) -> int:
+        """Hashes new memories and folds near duplicates into the newest copy, returns how many were absorbed"""
+        unhashed = self.store.unhashed(guild_id, COMPACT_BATCH)
+        if unhashed:
+            self.store.set_simhashes(
+                guild_id,
+                [
+                    (
+                        memory_id,
+                        simhash(
+                            f"{entry.get('special_phrase') or ''} {entry.get('memory') or ''}"
+                        ),
+                    )
+                    for memory_id, entry in unhashed
+                ],
+            )
+            self.counters["hashed"] += len(unhashed)
+
+        # Edited memories keep their rowid, they may sit below the watermark
+        rehashed = {memory_id for memory_id, _ in unhashed}
+
+        rows = self.store.simhash_rows(guild_id)
+        watermark = self.store.watermark(guild_id)
+        new_watermark = watermark
+
+        bands: dict[tuple, list[int]] = {}  # (band, value) -> row indexes
+        for i, row in enumerate(rows):
+            for key in _bands(row[2] & SIMHASH_MASK):
+                bands.setdefault(key, []).append(i)
+
+        absorbed_by: dict[int, int] = {}  # row index -> row index that absorbed it
+        # usage a row carries for itself and everything it absorbed
+        uses = [row[3] for row in rows]
+        last_used = [row[4] or "" for row in rows]
+        merges = []
+        checked = 0
+
+        for i, (rowid, memory_id, value, _, _) in enumerate(rows):
+            if rowid > watermark:
+                # Rows are in rowid order, everything past the batch is checked next run
+                if checked == COMPACT_BATCH:
+                    break
+                checked += 1
+                new_watermark = rowid
+            elif memory_id not in rehashed:
+                continue
+            if i in absorbed_by:
+                continue
+
+            value &= SIMHASH_MASK
+            copies = {i} | {
+                j
+                for key in _bands(value)
+                for j in bands.get(key, ())
+                if j not in absorbed_by
+                and hamming(rows[j][2], value) <= SIMHASH_DISTANCE
+            }
+            if len(copies) == 1:
+                continue
+
+            kept = max(copies)  # the newest copy
+            duplicates = copies - {kept}
+            for j in duplicates:
+                absorbed_by[j] = kept
+                uses[kept] += uses[j]
+                last_used[kept] = max(last_used[kept], last_used[j])
+            merges.append(
+                (
+                    rows[kept][1],
+                    [rows[j][1] for j in duplicates],
+                    sum(uses[j] for j in duplicates),
+                    max(last_used[j] for j in duplicates),
+                )
+            )
+
+        absorbed = self.store.merge(guild_id, merges) if merges else 0
+        if new_watermark != watermark:
+            self.store.set_watermark(guild_id, new_watermark)
+        self.counters["merged"] += absorbed
+        return absorbed
+
+    def select_evictions(self, guild_id, window: int, rollups=False) -> list[str]:
+        """
+        Description:
+        Picks the lowest scoring memories beyond `window`
+
+        Arguments:
+        guild_id
+        window : int
+            memories to keep, 0 or less keeps everything
+        rollups : bool = False
+            evict a bit more, so the rollups that replace them fit in the window as well
+
+        Returns:
+        list[str] : memory ids, lowest score first
+        """
+        rows = self.store.retention_rows(guild_id)
+        excess = len(rows) - window
+        if window <= 0 or excess <= 0:
+            return []
+        excess = min(excess, EVICT_BATCH)
+        if rollups:
+            excess = min(
+                math.ceil(excess * ROLLUP_SIZE / (ROLLUP_SIZE - 1)),
+                ROLLUP_SIZE * MAX_ROLLUPS_PER_RUN,
+                len(rows),
+            )
+
+        # Recency is the rank of the last time a memory was saved or recalled (ISO timestamps sort as text)
+        recency_keys = np.array(
+            [
+                max(timestamp or "", last_used or "")
+                for _, timestamp, last_used, _ in rows
+            ]
+        )
+        ranks = np.empty(len(rows), dtype=np.float64)
+        ranks[np.argsort(recency_keys, kind="stable")] = np.arange(len(rows))
+        recency = ranks / max(len(rows) - 1, 1)
+
+        recalls = np.log1p(np.array([row[3] for row in rows], dtype=np.float64))
+        usage = recalls / recalls.max() if recalls.max() > 0 else recalls
+
+        score = RECENCY_WEIGHT * recency + USAGE_WEIGHT * usage
+        victims = np.argsort(score, kind="stable")[:excess]
+        return [rows[i][0] for i in victims]
+
+    async def roll_up(self, guild_id, memory_ids: list[str]) -> None:
+        """Replaces evicted memories with rollups, ROLLUP_SIZE at a time. A failed rollup keeps its memories"""
+        entries = await asyncio.to_thread(self.store.get_many, guild_id, memory_ids)
+        entries.sort(key=lambda entry: entry.get("timestamp") or "")
+
+        for start in range(0, len(entries), ROLLUP_SIZE):
+            chunk = entries[start : start + ROLLUP_SIZE]
+            chunk_ids = [entry["memory_id"] for entry in chunk]
+            if len(chunk) == 1:
+                # Nothing to summarize it with
+                await asyncio.to_thread(self.store.remove, guild_id, chunk_ids)
+                self.counters["evicted"] += 1
+                continue
+
+            try:
+                rollup = await self.rollup(chunk)
+            except Exception as E:
+                print(
+                    f"[MEMORY COMPACTOR] [WARNING] | Rollup for {guild_id} failed, keeping its memories: {E}"
+                )
+                continue
+
+            self.store.upsert(guild_id, [rollup])
+            await asyncio.to_thread(self.store.remove, guild_id, chunk_ids)
+            self.counters["rollups"] += 1
+            self.counters["evicted"] += len(chunk)
+
+    def stats(self) -> dict:
+        return {**self.counters, "running": len(self._running)}
+
+
+memory_compactor = MemoryCompactor()
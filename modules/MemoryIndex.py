@@ -0,0 +1,194 @@
+"""
+Local retrieval index for memory recall.
+
+Every memory of a guild is turned into a hashed bag-of-words vector (word unigrams and bigrams hashed into
+`DIMENSIONS` buckets, sublinear tf, idf weighted and L2 normalized) and the guild's vectors are kept as one
+NumPy matrix. Recall is a single matrix-vector product plus a top-k, so it runs in well under a millisecond
+with no network call. A guild's matrix is rebuilt lazily after the `MemoryStore` reports a write to it,
+reusing the vectors of memories that didn't change. Callers run searches in a worker thread
+(`asyncio.to_thread`), so rebuilds don't block the event loop.
+"""
+
+import hashlib
+import re
+import threading
+import zlib
+
+from functools import lru_cache
+
+import numpy as np
+
+from modules.MemoryStore import memory_store
+
+DIMENSIONS = 1024
+
+# The special phrase is what the memory was saved under, so it counts more than the summary
+PHRASE_WEIGHT = 2.0
+
+SIMHASH_BITS = 64
+SIMHASH_MASK = (1 << SIMHASH_BITS) - 1
+
+_TOKEN = re.compile(r"[^\W_]+")
+_STOPWORDS = frozenset("""
+    a an and are as at be but by do does for from had has have he her him his i if in into is it its
+    just me my no not of on or our she so than that the their them then there they this to too up us
+    was we were what when which who will with you your im dont thats
+    """.split())
+
+
+@lru_cache(maxsize=1 << 16)
+def _bucket(feature: str) -> int:
+    # crc32 instead of hash() so buckets don't change between runs (hash() is salted per process)
+    return zlib.crc32(feature.encode("utf-8")) % DIMENSIONS
+
+
+def words(text: str) -> list[str]:
+    """Lowercased words, stopwords and single letters are dropped"""
+    return [
+        word
+        for word in _TOKEN.findall(str(text).lower())
+        if len(word) > 1 and word not in _STOPWORDS
+    ]
+
+
+def features(text: str) -> list[str]:
+    """Word unigrams and bigrams"""
+    unigrams = words(text)
+    return unigrams + [f"{a} {b}" for a, b in zip(unigrams, unigrams[1:])]
+
+
+def term_frequencies(text: str) -> np.ndarray:
+    """Sublinear (1 + log tf) hashed term frequencies of `text`"""
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    buckets = [_bucket(feature) for feature in features(text)]
+    if buckets:
+        counts = np.bincount(buckets, minlength=DIMENSIONS)
+        present = counts > 0
+        vector[present] = 1 + np.log(counts[present])
+    return vector
+
+
+@lru_cache(maxsize=1 << 16)
+def _feature_hash(feature: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def simhash(text: str) -> int:
+    """
+    Description:
+    64 bit simhash of the text's words, near-duplicate texts differ in only a few bits (see `hamming()`).
+    Bigrams are left out, they make a reworded sentence look far more different than it is.
+    Returned signed so it fits in an SQLite INTEGER
+
+    Arguments:
+    text : str
+
+    Returns:
+    int
+    """
+    hashes = np.array([_feature_hash(word) for word in words(text)], dtype=np.uint64)
+    if not len(hashes):
+        return 0
+
+    bits = np.unpackbits(
+        hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little"
+    )
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(hashes)
+    return int(np.packbits(votes > 0, bitorder="little").view(np.int64)[0])
+
+
+def hamming(a: int, b: int) -> int:
+    """Number of bits two simhashes differ in"""
+    return ((a ^ b) & SIMHASH_MASK).bit_count()
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+class GuildIndex:
+    """The vectors of one guild, row i belongs to `phrases[i]`"""
+
+    def __init__(self, entries: list[dict], previous: "GuildIndex" = None):
+        self.phrases: list[str] = [entry.get("special_phrase") for entry in entries]
+        # memory_id -> ((special_phrase, memory), tf row), lets a rebuild skip memories that didn't change
+        self.rows: dict = {}
+
+        if not entries:
+            self.idf = np.ones(DIMENSIONS, dtype=np.float32)
+            self.matrix = np.zeros((0, DIMENSIONS), dtype=np.float32)
+            return
+
+        reusable = previous.rows if previous is not None else {}
+        for entry in entries:
+            source = (entry.get("special_phrase") or "", str(entry.get("memory") or ""))
+            row = reusable.get(entry.get("memory_id"))
+            if row is None or row[0] != source:
+                row = (
+                    source,
+                    PHRASE_WEIGHT * term_frequencies(source[0])
+                    + term_frequencies(source[1]),
+                )
+            self.rows[entry.get("memory_id")] = row
+
+        tf = np.stack([self.rows[entry.get("memory_id")][1] for entry in entries])
+        document_frequency = np.count_nonzero(tf, axis=0)
+        self.idf = (np.log((1 + len(entries)) / (1 + document_frequency)) + 1).astype(
+            np.float32
+        )
+        self.matrix = _normalize(tf * self.idf)
+
+    def search(self, query: str, k: int = 5) -> list[tuple[str, float]]:
+        """
+        Description:
+        Scores every memory against `query` by cosine similarity
+
+        Arguments:
+        query : str
+        k : int = 5
+
+        Returns:
+        list[(special_phrase, score)], best first
+        """
+        if not len(self.phrases):
+            return []
+
+        scores = self.matrix @ _normalize(term_frequencies(query) * self.idf)
+        k = min(k, len(scores))
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(self.phrases[i], float(scores[i])) for i in top]
+
+
+class MemoryIndex:
+
+    def __init__(self, store=memory_store):
+        self.store = store
+        # guild_id -> (store generation, GuildIndex)
+        self._guilds: dict[str, tuple] = {}
+        # Searches run in worker threads, one rebuild per guild at a time
+        self._locks: dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def guild(self, guild_id) -> GuildIndex:
+        key = str(guild_id)
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        with lock:
+            generation = self.store.generation(key)
+            cached = self._guilds.get(key)
+            if cached is None or cached[0] != generation:
+                previous = cached[1] if cached is not None else None
+                cached = (generation, GuildIndex(self.store.entries(key), previous))
+                self._guilds[key] = cached
+            return cached[1]
+
+    def search(self, guild_id, query: str, k: int = 5) -> list[tuple[str, float]]:
+        return self.guild(guild_id).search(query, k)
+
+
+memory_index = MemoryIndex()
@@ -0,0 +1,129 @@
+"""
+Background queue for memory formation.
+
+Forming a memory takes a whole Gemini generation over the context window, far too slow to sit on the
+reply path. Callers hand over a snapshot of the context window with `MemoryQueue.submit()`, which never
+waits, and a few workers on the bot's event loop work through the queue with bounded concurrency,
+retrying failed jobs with exponential backoff. `MemoryQueue.stats()` reports depth and lag (see /health).
+"""
+
+import asyncio
+import time
+
+from collections import deque
+from typing import Awaitable, Callable
+
+from modules.Scheduler import JobDropped
+
+# Jobs formed at the same time, each one is a model call
+MEMORY_WORKERS = 2
+# Snapshots waiting past this are dropped, memory formation is best effort
+MEMORY_QUEUE_SIZE = 64
+# Attempts per job, waiting RETRY_BACKOFF * 2**attempt seconds in between
+MEMORY_RETRIES = 3
+RETRY_BACKOFF = 2.0
+
+
+class MemoryJob:
+    """A snapshot of a context window, taken when it was submitted"""
+
+    __slots__ = ("guild_id", "channel_id", "context", "timestamp", "force", "queued_at")
+
+    def __init__(self, guild_id, channel_id, context: str, timestamp: str, force=False):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.context = context
+        self.timestamp = timestamp
+        self.force = force
+        self.queued_at = time.monotonic()
+
+
+class MemoryQueue:
+
+    def __init__(
+        self, handler: Callable[[MemoryJob], Awaitable], workers=MEMORY_WORKERS
+    ):
+        self.handler = handler
+        self.workers = workers
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        # FIFO like the queue, the head is the oldest waiting job
+        self._queued_at: deque[float] = deque()
+        self.in_flight = 0
+        self.counters = {"processed": 0, "failed": 0, "retried": 0, "dropped": 0}
+        self.last_lag = 0.0  # seconds the last started job waited in the queue
+
+    def submit(self, job: MemoryJob) -> bool:
+        """Queues a job without waiting, returns False if the queue is full and the job was dropped"""
+        if self._queue is None:
+            self._start()
+
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.counters["dropped"] += 1
+            print(
+                f"[MEMORY QUEUE] [WARNING] | Queue full ({MEMORY_QUEUE_SIZE}), dropped a memory for {job.guild_id}"
+            )
+            return False
+
+        self._queued_at.append(job.queued_at)
+        return True
+
+    def stats(self) -> dict:
+        oldest = self._queued_at[0] if self._queued_at else None
+        return {
+            "depth": len(self._queued_at),
+            "in_flight": self.in_flight,
+            **self.counters,
+            "last_lag_seconds": round(self.last_lag, 3),
+            "oldest_waiting_seconds": (
+                round(time.monotonic() - oldest, 3) if oldest is not None else 0.0
+            ),
+        }
+
+    def _start(self) -> None:
+        # Workers live on the loop of the first caller, the bot's loop
+        self._queue = asyncio.Queue(maxsize=MEMORY_QUEUE_SIZE)
+        self._tasks = [
+            asyncio.create_task(self._work(), name=f"memory-worker-{i}")
+            for i in range(self.workers)
+        ]
+
+    async def _work(self) -> None:
+        while True:
+            job: MemoryJob = await self._queue.get()
+            self._queued_at.popleft()
+            self.last_lag = time.monotonic() - job.queued_at
+            self.in_flight += 1
+            try:
+                await self._run(job)
+            finally:
+                self.in_flight -= 1
+                self._queue.task_done()
+
+    async def _run(self, job: MemoryJob) -> None:
+        error = None
+        for attempt in range(MEMORY_RETRIES):
+            try:
+                await self.handler(job)
+                self.counters["processed"] += 1
+                return
+            except JobDropped:
+                # Shed under load, retrying would only add to it
+                self.counters["dropped"] += 1
+                return
+            except Exception as E:
+                error = E
+                if attempt + 1 == MEMORY_RETRIES:
+                    break
+                self.counters["retried"] += 1
+                print(
+                    f"[MEMORY QUEUE] [WARNING] | Memory for {job.guild_id} failed (attempt {attempt + 1}), retrying: {E}"
+                )
+                await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+
+        self.counters["failed"] += 1
+        print(
+            f"[MEMORY QUEUE] [ERROR] | Gave up on a memory for {job.guild_id} after {MEMORY_RETRIES} attempts: {error}"
+        )
@@ -0,0 +1,449 @@
+"""
+SQLite backed storage for long term memories.
+
+Replaces the monolithic `data/<alias>-memories.json` that was read and parsed as a whole for every lookup.
+Memories are indexed per guild on `timestamp`, `memory_id` and `special_phrase`, so recall only touches the
+rows it needs. The full entry (including any extra keys sent by the dashboard) is kept as JSON in `data`.
+
+Used from both the bot's event loop and the spine server's thread, so every access goes through one lock.
+
+Writes are write-behind: `upsert` and `delete` only mark the guild dirty, and a burst of them is coalesced
+into a single transaction `FLUSH_INTERVAL` seconds later (or right away once `FLUSH_BATCH` pile up, on
+`close()` at shutdown, or before a dirty guild is read). A transaction either lands whole or not at all,
+so a crash can lose at most the last unflushed burst, never corrupt what was already saved.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+from modules.CommonCalls import CommonCalls
+
+# Pending writes are flushed this many seconds after the first one, or once this many pile up
+FLUSH_INTERVAL = 2.0
+FLUSH_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memories (
+    guild_id TEXT NOT NULL,
+    memory_id TEXT NOT NULL,
+    special_phrase TEXT,
+    timestamp TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (guild_id, memory_id)
+);
+CREATE INDEX IF NOT EXISTS memories_by_timestamp ON memories (guild_id, timestamp);
+CREATE INDEX IF NOT EXISTS memories_by_phrase ON memories (guild_id, special_phrase);
+CREATE TABLE IF NOT EXISTS compaction (
+    guild_id TEXT PRIMARY KEY,
+    watermark INTEGER NOT NULL
+);
+"""
+
+# Added after the first release, (name, definition) added to existing databases by `_upgrade_schema`
+COLUMNS = [
+    ("uses", "INTEGER NOT NULL DEFAULT 0"),
+    ("last_used", "TEXT"),
+    ("simhash", "INTEGER"),
+]
+
+# Editing a memory keeps its rowid and usage, its simhash is recomputed by the next compaction
+UPSERT = """
+INSERT INTO memories (guild_id, memory_id, special_phrase, timestamp, data) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (guild_id, memory_id) DO UPDATE SET
+    special_phrase = excluded.special_phrase,
+    timestamp = excluded.timestamp,
+    data = excluded.data,
+    simhash = NULL
+"""
+
+
+class MemoryStore:
+
+    def __init__(self, path: str, legacy_json_path: str = None):
+        self.path = path
+        self.legacy_json_path = legacy_json_path
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.RLock()
+        # Bumped on every write so derived data (see `MemoryIndex`) knows when a guild changed
+        self._generations: dict[str, int] = {}
+        self._epoch = 0
+        # guild_id -> {memory_id: row to write, or None to delete}
+        self._dirty: dict[str, dict[str, tuple | None]] = {}
+        self._pending = 0
+        # (guild_id, special_phrase) -> [times recalled, last recalled at], written with the next flush
+        self._uses: dict[tuple, list] = {}
+        self._timer: threading.Timer | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Opened lazily, the old JSON file is migrated on first use"""
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self._upgrade_schema(connection)
+            self._connection = connection
+            self._migrate_json()
+        return self._connection
+
+    @staticmethod
+    def _row(guild_id, entry: dict) -> tuple:
+        return (
+            str(guild_id),
+            str(entry["memory_id"]),
+            entry.get("special_phrase"),
+            entry.get("timestamp"),
+            json.dumps(entry, separators=(",", ":")),
+        )
+
+    @staticmethod
+    def _upgrade_schema(connection: sqlite3.Connection) -> None:
+        existing = {row[1] for row in connection.execute("PRAGMA table_info(memories)")}
+        with connection:
+            for name, definition in COLUMNS:
+                if name not in existing:
+                    connection.execute(
+                        f"ALTER TABLE memories ADD COLUMN {name} {definition}"
+                    )
+
+    def _migrate_json(self) -> None:
+        """Imports `legacy_json_path` once, the file is renamed afterwards so it isn't imported again"""
+        path = self.legacy_json_path
+        if not path or not os.path.exists(path):
+            return
+
+        try:
+            with open(path, "r") as file:
+                legacy: dict = json.load(file)
+        except json.JSONDecodeError:
+            print(f"[MEMORY STORE] [WARNING] | {path} is not valid JSON, not migrating")
+            return
+
+        rows = [
+            self._row(guild_id, entry)
+            for guild_id, entries in legacy.items()
+            for entry in entries
+            if entry.get("memory_id")
+        ]
+        with self._connection:
+            self._connection.executemany(UPSERT, rows)
+
+        os.replace(path, f"{path}.migrated")
+        print(f"[MEMORY STORE] Migrated {len(rows)} memories from {path}")
+
+    def generation(self, guild_id) -> tuple[int, int]:
+        """Changes whenever the guild's memories are written to"""
+        return self._epoch, self._generations.get(str(guild_id), 0)
+
+    def _touch(self, guild_id) -> None:
+        key = str(guild_id)
+        self._generations[key] = self._generations.get(key, 0) + 1
+
+    def upsert(self, guild_id, entries: list[dict]) -> int:
+        """Queues memories to be added, or to replace the ones with the same `memory_id`. Returns how many were queued"""
+        rows = [
+            self._row(guild_id, entry) for entry in entries if entry.get("memory_id")
+        ]
+        with self._lock:
+            dirty = self._dirty.setdefault(str(guild_id), {})
+            for row in rows:
+                dirty[row[1]] = row
+            self._queued(guild_id, len(rows))
+        return len(rows)
+
+    def delete(self, guild_id, memory_ids: list[str]) -> int:
+        """Queues memories to be deleted by id, returns how many were queued"""
+        with self._lock:
+            dirty = self._dirty.setdefault(str(guild_id), {})
+            for memory_id in memory_ids:
+                dirty[str(memory_id)] = None
+            self._queued(guild_id, len(memory_ids))
+        return len(memory_ids)
+
+    def record_use(self, guild_id, special_phrase: str, used_at: str) -> None:
+        """Counts a recall of `special_phrase`, feeds the retention score of `MemoryCompactor`"""
+        with self._lock:
+            use = self._uses.setdefault((str(guild_id), special_phrase), [0, used_at])
+            use[0] += 1
+            use[1] = max(use[1], used_at)
+            self._schedule()
+
+    def replace_all(self, memories: dict) -> int:
+        """Replaces every memory with `memories` ({guild_id: [entry, ...]}), in one transaction"""
+        rows = [
+            self._row(guild_id, entry)
+            for guild_id, entries in memories.items()
+            for entry in entries
+            if entry.get("memory_id")
+        ]
+        with self._lock, self.connection:
+            # Anything still pending is superseded by the new contents
+            self._dirty.clear()
+            self._uses.clear()
+            self._pending = 0
+            self.connection.execute("DELETE FROM memories")
+            self.connection.executemany(UPSERT, rows)
+            self._epoch += 1
+        return len(rows)
+
+    def _queued(self, guild_id, count: int) -> None:
+        self._touch(guild_id)
+        self._pending += count
+        if self._pending >= FLUSH_BATCH:
+            self.flush()
+        else:
+            self._schedule()
+
+    def _schedule(self) -> None:
+        if self._timer is None:
+            self._timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self) -> int:
+        """Writes every pending change in one transaction, returns how many rows were touched"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            if not self._dirty and not self._uses:
+                return 0
+
+            dirty, self._dirty = self._dirty, {}
+            uses, self._uses = self._uses, {}
+            self._pending = 0
+            writes = [row for rows in dirty.values() for row in rows.values() if row]
+            deletes = [
+                (guild_id, memory_id)
+                for guild_id, rows in dirty.items()
+                for memory_id, row in rows.items()
+                if row is None
+            ]
+
+            try:
+                with self.connection:
+                    self.connection.executemany(UPSERT, writes)
+                    self.connection.executemany(
+                        "DELETE FROM memories WHERE guild_id = ? AND memory_id = ?",
+                        deletes,
+                    )
+                    self.connection.executemany(
+                        "UPDATE memories SET uses = uses + ?, last_used = max(coalesce(last_used, ''), ?) WHERE guild_id = ? AND special_phrase = ?",
+                        [
+                            (count, used_at, guild_id, phrase)
+                            for (guild_id, phrase), (count, used_at) in uses.items()
+                        ],
+                    )
+            except sqlite3.Error as E:
+                # Put the changes back (newer ones win) so the next flush retries them
+                print(f"[MEMORY STORE] [WARNING] | Flush failed, retrying later: {E}")
+                for guild_id, rows in dirty.items():
+                    self._dirty[guild_id] = {**rows, **self._dirty.get(guild_id, {})}
+                for key, (count, used_at) in uses.items():
+                    use = self._uses.setdefault(key, [0, used_at])
+                    use[0] += count
+                    use[1] = max(use[1], used_at)
+                self._schedule()
+                return 0
+
+        if CommonCalls.settings().debug_mode:
+            print(
+                f"[MEMORY STORE] Flushed {len(writes)} writes and {len(deletes)} deletions for {len(dirty)} guilds"
+            )
+        return len(writes) + len(deletes)
+
+    def close(self) -> None:
+        """Flushes pending writes, call on shutdown"""
+        self.flush()
+
+    def _sync(self, guild_id=None) -> None:
+        # Reads see their own writes, a dirty guild (or any, for whole-store reads) is flushed first
+        if self._dirty and (guild_id is None or str(guild_id) in self._dirty):
+            self.flush()
+
+    def has_guild(self, guild_id) -> bool:
+        with self._lock:
+            self._sync(guild_id)
+            return (
+                self.connection.execute(
+                    "SELECT 1 FROM memories WHERE guild_id = ? LIMIT 1",
+                    (str(guild_id),),
+                ).fetchone()
+                is not None
+            )
+
+    def phrases(self, guild_id) -> list[str]:
+        """Every distinct special phrase of a guild, oldest first"""
+        with self._lock:
+            self._sync(guild_id)
+            rows = self.connection.execute(
+                "SELECT special_phrase FROM memories WHERE guild_id = ? GROUP BY special_phrase ORDER BY MIN(timestamp)",
+                (str(guild_id),),
+            ).fetchall()
+        return [phrase for (phrase,) in rows]
+
+    def lookup(self, guild_id, special_phrase: str):
+        """Returns the newest memory saved under `special_phrase`, or None"""
+        with self._lock:
+            self._sync(guild_id)
+            row = self.connection.execute(
+                "SELECT data FROM memories WHERE guild_id = ? AND special_phrase = ? ORDER BY timestamp DESC LIMIT 1",
+                (str(guild_id), special_phrase),
+            ).fetchone()
+        return json.loads(row[0]).get("memory") if row else None
+
+    def entries(self, guild_id) -> list[dict]:
+        """Every memory of a guild, oldest first"""
+        with self._lock:
+            self._sync(guild_id)
+            rows = self.connection.execute(
+                "SELECT data FROM memories WHERE guild_id = ? ORDER BY timestamp",
+                (str(guild_id),),
+            ).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def dump(self) -> dict:
+        """Every memory grouped by guild, in the same shape the JSON file used to have"""
+        with self._lock:
+            self._sync()
+            rows = self.connection.execute(
+                "SELECT guild_id, data FROM memories ORDER BY guild_id, timestamp"
+            ).fetchall()
+
+        memories: dict = {}
+        for guild_id, data in rows:
+            memories.setdefault(guild_id, []).append(json.loads(data))
+        return memories
+
+    # Compaction, see `MemoryCompactor`
+
+    def guilds(self) -> list[str]:
+        with self._lock:
+            self._sync()
+            rows = self.connection.execute(
+                "SELECT DISTINCT guild_id FROM memories"
+            ).fetchall()
+        return [guild_id for (guild_id,) in rows]
+
+    def count(self, guild_id) -> int:
+        with self._lock:
+            self._sync(guild_id)
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM memories WHERE guild_id = ?", (str(guild_id),)
+            ).fetchone()[0]
+
+    def unhashed(self, guild_id, limit: int) -> list[tuple]:
+        """(memory_id, entry) of up to `limit` memories that have no simhash yet"""
+        with self._lock:
+            self._sync(guild_id)
+            rows = self.connection.execute(
+                "SELECT memory_id, data FROM memories WHERE guild_id = ? AND simhash IS NULL ORDER BY rowid LIMIT ?",
+                (str(guild_id), limit),
+            ).fetchall()
+        return [(memory_id, json.loads(data)) for memory_id, data in rows]
+
+    def set_simhashes(self, guild_id, simhashes: list[tuple]) -> None:
+        """simhashes : list[(memory_id, simhash)]"""
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "UPDATE memories SET simhash = ? WHERE guild_id = ? AND memory_id = ?",
+                [
+                    (simhash, str(guild_id), memory_id)
+                    for memory_id, simhash in simhashes
+                ],
+            )
+
+    def simhash_rows(self, guild_id) -> list[tuple]:
+        """(rowid, memory_id, simhash, uses, last_used) of every hashed memory, oldest insert first"""
+        with self._lock:
+            self._sync(guild_id)
+            return self.connection.execute(
+                "SELECT rowid, memory_id, simhash, uses, last_used FROM memories WHERE guild_id = ? AND simhash IS NOT NULL ORDER BY rowid",
+                (str(guild_id),),
+            ).fetchall()
+
+    def retention_rows(self, guild_id) -> list[tuple]:
+        """(memory_id, timestamp, last_used, uses) of every memory"""
+        with self._lock:
+            self._sync(guild_id)
+            return self.connection.execute(
+                "SELECT memory_id, timestamp, last_used, uses FROM memories WHERE guild_id = ?",
+                (str(guild_id),),
+            ).fetchall()
+
+    def get_many(self, guild_id, memory_ids: list[str]) -> list[dict]:
+        with self._lock:
+            self._sync(guild_id)
+            entries = []
+            for memory_id in memory_ids:
+                row = self.connection.execute(
+                    "SELECT data FROM memories WHERE guild_id = ? AND memory_id = ?",
+                    (str(guild_id), memory_id),
+                ).fetchone()
+                if row:
+                    entries.append(json.loads(row[0]))
+        return entries
+
+    def merge(self, guild_id, merges: list[tuple]) -> int:
+        """
+        Description:
+        Folds duplicates into the memory that is kept, in one transaction
+
+        Arguments:
+        merges : list[(kept memory_id, [absorbed memory_id, ...], absorbed uses, absorbed last_used)]
+
+        Returns:
+        int : how many memories were absorbed
+        """
+        key = str(guild_id)
+        with self._lock:
+            self._sync(guild_id)
+            with self.connection:
+                for kept, absorbed, uses, last_used in merges:
+                    self.connection.execute(
+                        "UPDATE memories SET uses = uses + ?, last_used = max(coalesce(last_used, ''), ?) WHERE guild_id = ? AND memory_id = ?",
+                        (uses, last_used or "", key, kept),
+                    )
+                    self.connection.executemany(
+                        "DELETE FROM memories WHERE guild_id = ? AND memory_id = ?",
+                        [(key, memory_id) for memory_id in absorbed],
+                    )
+            self._touch(guild_id)
+        return sum(len(absorbed) for _, absorbed, _, _ in merges)
+
+    def remove(self, guild_id, memory_ids: list[str]) -> None:
+        """Deletes right away, unlike the write-behind `delete`"""
+        with self._lock:
+            self._sync(guild_id)
+            with self.connection:
+                self.connection.executemany(
+                    "DELETE FROM memories WHERE guild_id = ? AND memory_id = ?",
+                    [(str(guild_id), memory_id) for memory_id in memory_ids],
+                )
+            self._touch(guild_id)
+
+    def watermark(self, guild_id) -> int:
+        """rowid up to which the guild was already checked for duplicates"""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT watermark FROM compaction WHERE guild_id = ?", (str(guild_id),)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def set_watermark(self, guild_id, watermark: int) -> None:
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO compaction (guild_id, watermark) VALUES (?, ?)",
+                (str(guild_id), watermark),
+            )
+
+
+memory_store = MemoryStore(
+    f"data/{CommonCalls.config()['alias']}-memories.db",
+    legacy_json_path=f"data/{CommonCalls.config()['alias']}-memories.json",
+)
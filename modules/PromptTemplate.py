@@ -0,0 +1,51 @@
+"""
+Small template engine used for the persona prompt.
+
+The persona block (system note, traits, likes/dislikes and the joined conversation examples) only changes
+when the personality file changes, so it is rendered once and split around the fields that change per message
+(author name, memory). Rendering a message is then a single "".join over the pre-split pieces.
+"""
+
+FIELD_MARKER = "\x00"
+
+
+class PromptTemplate:
+
+    def __init__(self, source: str):
+        """
+        Description:
+        Compiles a template, fields are written with `PromptTemplate.field(name)`
+
+        Arguments:
+        source : str
+        """
+        parts = source.split(FIELD_MARKER)
+        self.literals: list[str] = parts[0::2]
+        self.fields: list[str] = parts[1::2]
+
+    @staticmethod
+    def field(name: str) -> str:
+        """Returns the placeholder for `name`, to be embedded in the template source"""
+        return f"{FIELD_MARKER}{name}{FIELD_MARKER}"
+
+    @staticmethod
+    def escape(text) -> str:
+        """Strips the field marker from user supplied text so it can't be mistaken for a placeholder"""
+        return str(text).replace(FIELD_MARKER, "")
+
+    def render(self, **values) -> str:
+        """
+        Description:
+        Splices the per-message values into the pre-rendered template
+
+        Arguments:
+        **values : the value for each field, missing fields are rendered as `None`
+
+        Returns:
+        str
+        """
+        rendered = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            rendered.append(str(values.get(field)))
+            rendered.append(literal)
+        return "".join(rendered)
@@ -0,0 +1,79 @@
+"""
+Progressive Discord replies for streamed generations.
+
+`BotModel.generate_content_stream` yields the reply as it is generated, `ReplyStream` posts it as soon as the
+first text arrives and then edits the message in place at most once every `EDIT_INTERVAL` seconds
+(Discord allows about 5 edits per 5 seconds in a channel). Text past `MESSAGE_LIMIT` characters continues
+in another reply, the same 2000 character chunking the cog used for whole responses.
+"""
+
+import time
+
+from typing import Callable
+
+from discord import AllowedMentions, Message
+
+MESSAGE_LIMIT = 2000
+EDIT_INTERVAL = 1.0
+
+
+class ReplyStream:
+
+    def __init__(
+        self,
+        message: Message,
+        allowed_mentions: AllowedMentions = None,
+        transform: Callable[[str], str] = None,
+    ):
+        self.message = message
+        self.allowed_mentions = allowed_mentions
+        # Applied to the whole text before it's shown, e.g. stripping the bot's name prefix
+        self.transform = transform
+        self.text = ""
+        self.messages: list[Message] = []  # one per MESSAGE_LIMIT chunk, in order
+        self.shown: list[str] = []  # what each message currently shows
+        self._last_render = 0.0
+
+    @property
+    def rendered(self) -> str:
+        text = self.transform(self.text) if self.transform else self.text
+        return text.strip()
+
+    async def feed(self, delta: str) -> None:
+        """Adds generated text, the first text is posted right away and later text at the edit cadence"""
+        self.text += delta
+        if not self.messages or time.monotonic() - self._last_render >= EDIT_INTERVAL:
+            await self._render()
+
+    async def finish(self) -> str:
+        """Shows everything that is left, returns the full reply"""
+        await self._render()
+        return self.rendered
+
+    async def _render(self) -> None:
+        text = self.rendered
+        if not text:
+            return
+
+        chunks = [
+            text[i : i + MESSAGE_LIMIT] for i in range(0, len(text), MESSAGE_LIMIT)
+        ]
+        for index, chunk in enumerate(chunks):
+            if index < len(self.messages):
+                # Earlier chunks are full and don't change, only the last one is edited
+                if self.shown[index] != chunk:
+                    await self.messages[index].edit(
+                        content=chunk, allowed_mentions=self.allowed_mentions
+                    )
+                    self.shown[index] = chunk
+            else:
+                self.messages.append(
+                    await self.message.reply(
+                        chunk,
+                        mention_author=False,
+                        allowed_mentions=self.allowed_mentions,
+                    )
+                )
+                self.shown.append(chunk)
+
+        self._last_render = time.monotonic()
@@ -0,0 +1,216 @@
+"""
+Retries, retry budget and circuit breaker for upstream calls.
+
+Every Gemini request goes through `ResilientCaller.call()` (see `GeminiClient.generate`):
+
+- Transient failures (timeouts, connection errors, 408/429/5xx) are re-issued with exponential backoff and
+  full jitter, anything else (400, 401, 403, 404, ...) fails right away as retrying can't fix it.
+- Retries draw from a `RetryBudget`, so when the upstream is struggling we add at most ~`ratio` extra load
+  instead of multiplying it by the attempt count.
+- A `CircuitBreaker` opens after `threshold` consecutive attempts failed with transient errors. While open, calls
+  fail fast with `CircuitOpenError` instead of piling up coroutines waiting on a dead upstream; after
+  `cooldown` seconds one trial call is let through to probe whether it recovered.
+
+Only idempotent requests may be retried. Content generation is (it doesn't change anything upstream),
+streams are only retried until their first chunk was handed out.
+"""
+
+import asyncio
+import random
+import time
+
+import httpx
+
+from google.genai import errors
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that is known to be down"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether re-issuing the same request could succeed"""
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_STATUS
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError, TimeoutError))
+
+
+class RetryBudget:
+    """
+    Token bucket for retries. Every request adds `ratio` of a token, every retry takes a whole one,
+    `reserve` tokens are available up front (and is the most that can be saved up)
+    """
+
+    def __init__(self, ratio=0.1, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = float(reserve)
+
+    def on_request(self) -> None:
+        self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"  # closed | open | half_open
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = 0.0
+
+    def before_call(self) -> None:
+        """Raises CircuitOpenError while the circuit is open, lets a single trial call through after the cooldown"""
+        if self.state == "closed":
+            return
+
+        now = time.monotonic()
+        if (self.state == "open" and now - self.opened_at >= self.cooldown) or (
+            # A trial that never reported back (shouldn't happen, see `abandon`) doesn't block forever
+            self.state == "half_open"
+            and now - self.trial_started_at >= self.cooldown
+        ):
+            self.state = "half_open"
+            self.trial_started_at = now
+            return
+
+        retry_in = max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+        raise CircuitOpenError(
+            f"upstream unavailable, circuit {self.state.replace('_', ' ')} (next try in {retry_in:.0f}s)"
+        )
+
+    def success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                print(
+                    f"[RESILIENCE] [WARNING] | Circuit opened after {self.failures} failures, failing fast for {self.cooldown:.0f}s"
+                )
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def abandon(self) -> None:
+        """The call ended without telling whether the upstream works (cancelled, unexpected error)"""
+        if self.state == "half_open":
+            # Another trial is let through after the next cooldown
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class ResilientCaller:
+
+    def __init__(
+        self,
+        name: str,
+        attempts=3,
+        base_delay=0.5,
+        max_delay=8.0,
+        timeout=60.0,
+        budget: RetryBudget = None,
+        breaker: CircuitBreaker = None,
+    ):
+        self.name = name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.budget = budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+        self.counters = {
+            "calls": 0,
+            "retries": 0,
+            "failures": 0,
+            "budget_exhausted": 0,
+            "rejected": 0,
+        }
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter, a random delay up to base_delay * 2**attempt (capped at max_delay)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def call(
+        self, make_call: Callable[[], Awaitable[T]], attempts: int = None
+    ) -> T:
+        """
+        Description:
+        Runs `make_call()` (a fresh request every time it's called) with timeouts, retries and the circuit breaker
+
+        Arguments:
+        make_call : Callable[[], Awaitable]
+        attempts : int = None
+            overrides the default number of attempts
+
+        Returns:
+        whatever `make_call()` returns, raises the last error (or CircuitOpenError) when it gives up
+        """
+        attempts = attempts or self.attempts
+        self.counters["calls"] += 1
+        self.budget.on_request()
+
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self.counters["rejected"] += 1
+                raise
+
+            settled = False
+            try:
+                result = await asyncio.wait_for(make_call(), self.timeout)
+            except Exception as E:
+                if not is_retryable(E):
+                    if isinstance(E, errors.APIError):
+                        # The upstream answered, it just didn't like the request
+                        self.breaker.success()
+                        settled = True
+                    raise
+
+                self.breaker.failure()
+                settled = True
+                attempt += 1
+                if attempt >= attempts:
+                    self.counters["failures"] += 1
+                    raise
+                if not self.budget.try_spend():
+                    self.counters["budget_exhausted"] += 1
+                    self.counters["failures"] += 1
+                    raise
+
+                delay = self.backoff(attempt - 1)
+                self.counters["retries"] += 1
+                print(
+                    f"[RESILIENCE] [{self.name}] {type(E).__name__}: {E} - retrying in {delay:.2f}s ({attempt}/{attempts - 1})"
+                )
+                await asyncio.sleep(delay)
+                continue
+            else:
+                self.breaker.success()
+                settled = True
+                return result
+            finally:
+                if not settled:
+                    self.breaker.abandon()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "circuit": self.breaker.state,
+            "retry_tokens": round(self.budget.tokens, 2),
+        }
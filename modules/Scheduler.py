@@ -0,0 +1,168 @@
+"""
+Priority scheduling for reply generation.
+
+Mentions, activated channels, freewill and background memory work all compete for the same upstream.
+`PriorityScheduler.run()` runs at most `schedulerConcurrency` jobs at once and starts waiting jobs by class:
+
+    MENTION (direct mention or reply to the bot) > ACTIVATED > FREEWILL (replies and reactions) > BACKGROUND
+
+Waiting jobs age, a job that waited `AGING_SECONDS` counts as one class higher, so background work still
+runs during a steady stream of mentions. When more than `schedulerMaxDepth` jobs are waiting, the lowest
+ranked FREEWILL/BACKGROUND job is dropped (`JobDropped`), mentions and activated channels are never dropped.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+
+from enum import IntEnum
+from typing import Awaitable, Callable, TypeVar
+
+from modules.CommonCalls import CommonCalls
+
+T = TypeVar("T")
+
+# Seconds of waiting that count as one priority class
+AGING_SECONDS = 10.0
+
+
+class Priority(IntEnum):
+    MENTION = 0
+    ACTIVATED = 1
+    FREEWILL = 2
+    BACKGROUND = 3
+
+
+# Only speculative work may be dropped under load
+DROPPABLE = frozenset({Priority.FREEWILL, Priority.BACKGROUND})
+
+
+class JobDropped(Exception):
+    """The scheduler was too busy to run this job"""
+
+
+class _Job:
+    __slots__ = ("key", "seq", "priority", "future", "queued_at")
+
+    def __init__(self, priority: Priority, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+        # The aged rank is priority - (now - queued_at) / AGING_SECONDS, `now` is the same for every job
+        # so ordering by priority + queued_at / AGING_SECONDS gives the same order and never changes
+        self.key = priority + self.queued_at / AGING_SECONDS
+
+    def __lt__(self, other: "_Job") -> bool:
+        return (self.key, self.seq) < (other.key, other.seq)
+
+
+class PriorityScheduler:
+
+    def __init__(self):
+        self._waiting: list[_Job] = []  # heap, best ranked first
+        self._seq = itertools.count()
+        self.running = 0
+        self.counters = {
+            priority.name.lower(): {"started": 0, "dropped": 0, "wait_total": 0.0}
+            for priority in Priority
+        }
+
+    async def run(self, priority: Priority, make_call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Description:
+        Waits for a turn, then runs `make_call()`
+
+        Arguments:
+        priority : Priority
+        make_call : Callable[[], Awaitable]
+
+        Returns:
+        whatever `make_call()` returns, raises JobDropped if the job was shed before it started
+        """
+        await self._acquire(priority)
+        try:
+            return await make_call()
+        finally:
+            self.running -= 1
+            self._pump()
+
+    async def _acquire(self, priority: Priority) -> None:
+        job = _Job(priority, next(self._seq))
+        heapq.heappush(self._waiting, job)
+        self._shed()
+        self._pump()
+
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if (
+                job.future.done()
+                and not job.future.cancelled()
+                and job.future.exception() is None
+            ):
+                # Started just as it was cancelled, hand the slot on (a dropped job never held one)
+                self.running -= 1
+                self._pump()
+            elif job in self._waiting:
+                self._waiting.remove(job)
+                heapq.heapify(self._waiting)
+            raise
+
+    def _pump(self) -> None:
+        concurrency = CommonCalls.settings().scheduler_concurrency
+        while self._waiting and (concurrency <= 0 or self.running < concurrency):
+            job = heapq.heappop(self._waiting)
+            if job.future.done():
+                continue
+
+            self.running += 1
+            counters = self.counters[job.priority.name.lower()]
+            counters["started"] += 1
+            counters["wait_total"] += time.monotonic() - job.queued_at
+            job.future.set_result(None)
+
+    def _shed(self) -> None:
+        """Drops the lowest ranked droppable jobs while the queue is deeper than schedulerMaxDepth"""
+        max_depth = CommonCalls.settings().scheduler_max_depth
+        if max_depth <= 0:
+            return
+
+        while len(self._waiting) > max_depth:
+            victims = [job for job in self._waiting if job.priority in DROPPABLE]
+            if not victims:
+                return
+            victim = max(victims)
+            self._waiting.remove(victim)
+            heapq.heapify(self._waiting)
+
+            self.counters[victim.priority.name.lower()]["dropped"] += 1
+            victim.future.set_exception(
+                JobDropped(
+                    f"{len(self._waiting)} jobs waiting, dropped a {victim.priority.name.lower()} job"
+                )
+            )
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        classes = {}
+        for priority in Priority:
+            name = priority.name.lower()
+            counters = self.counters[name]
+            waiting = [job for job in self._waiting if job.priority == priority]
+            classes[name] = {
+                "waiting": len(waiting),
+                "started": counters["started"],
+                "dropped": counters["dropped"],
+                "avg_wait_seconds": round(
+                    counters["wait_total"] / max(counters["started"], 1), 3
+                ),
+                "oldest_waiting_seconds": round(
+                    max((now - job.queued_at for job in waiting), default=0.0), 3
+                ),
+            }
+        return {"running": self.running, "depth": len(self._waiting), **classes}
+
+
+scheduler = PriorityScheduler()
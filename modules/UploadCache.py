@@ -0,0 +1,211 @@
+"""
+Content addressed cache of attachments uploaded through FileAPI.
+
+The same meme or clip gets reposted across channels, each repost used to be uploaded, processed and deleted
+again. `UploadCache.acquire()` hashes the saved attachment and hands out the file already uploaded for that
+content when there is one. Concurrent requests for the same content share a single upload.
+
+Entries are keyed on the original attachment, not on what was uploaded for it. `BotModel` looks the digest
+up with `UploadCache.lookup()` before shrinking media (see modules/MediaPrep.py), so a repost skips ffmpeg too,
+and passes the same digest to `acquire()` along with the shrunk file.
+
+Cached files are deleted by the sweeper, not after each reply:
+
+- An entry expires `uploadCacheTTL` seconds after the upload, or `EXPIRY_MARGIN` seconds before Gemini
+  itself drops the file (about 48 hours after the upload), whichever comes first.
+- Past `UPLOAD_CACHE_SIZE` entries, the least recently used ones are evicted.
+- Files handed out and not released yet (a reply is still being generated with them) are never evicted.
+
+`upload` and `delete` are set by `BotModel`, which owns the FileAPI calls.
+"""
+
+import asyncio
+import hashlib
+import time
+
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from google.genai.types import File
+
+from modules.CommonCalls import CommonCalls
+
+UPLOAD_CACHE_SIZE = 256
+# Seconds between sweeps for expired entries
+SWEEP_INTERVAL = 300.0
+# Entries are dropped this many seconds before Gemini expires their file
+EXPIRY_MARGIN = 600.0
+
+
+def _digest(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+class _Entry:
+    __slots__ = ("file", "expires_at", "remote_expires_at", "refs")
+
+    def __init__(self, file: File, ttl: float):
+        self.file = file
+        now = time.time()
+        self.remote_expires_at = (
+            file.expiration_time.timestamp() if file.expiration_time else None
+        )
+        self.expires_at = now + ttl
+        if self.remote_expires_at is not None:
+            self.expires_at = min(
+                self.expires_at, self.remote_expires_at - EXPIRY_MARGIN
+            )
+        self.refs = 0
+
+
+class UploadCache:
+
+    def __init__(self):
+        self.upload: Callable[[str], Awaitable[File | None]] | None = None
+        self.delete: Callable[[str], Awaitable] | None = None
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()  # least recent first
+        self._names: dict[str, str] = {}  # file name -> digest
+        self._pending: dict[str, asyncio.Future] = {}
+        self._sweeper: asyncio.Task | None = None
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "shared_uploads": 0,
+            "expired": 0,
+            "evicted": 0,
+        }
+
+    async def digest(self, path: str) -> str:
+        """The cache key for the contents of `path`"""
+        return await asyncio.to_thread(_digest, path)
+
+    async def acquire(self, path: str, digest: str = None) -> File | None:
+        """
+        Description:
+        Returns the uploaded file for the contents of `path`, uploading it if needed.
+        Hand the file back with `UploadCache.release` once the reply is generated
+
+        Arguments:
+        path : str
+        digest : str = None
+            key to cache the upload under, defaults to the digest of `path`
+
+        Returns:
+        genai.types.File | None : None if the upload failed
+        """
+        if digest is None:
+            digest = await self.digest(path)
+
+        file = await self.lookup(digest)
+        if file is not None:
+            return file
+
+        self.counters["misses"] += 1
+        pending = self._pending[digest] = asyncio.get_running_loop().create_future()
+        try:
+            file = await self.upload(path)
+            if file is not None:
+                entry = self._entries[digest] = _Entry(
+                    file, CommonCalls.settings().upload_cache_ttl
+                )
+                self._names[file.name] = digest
+                entry.refs += 1
+        finally:
+            del self._pending[digest]
+            pending.set_result(None)
+
+        await self._trim()
+        return file
+
+    async def lookup(self, digest: str) -> File | None:
+        """
+        Description:
+        Returns the file already uploaded under `digest`, waiting for an upload of it still in flight.
+        Like `acquire`, hand a file it returns back with `UploadCache.release`
+
+        Arguments:
+        digest : str
+
+        Returns:
+        genai.types.File | None : None if nothing is cached under `digest`
+        """
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+
+        entry = self._entries.get(digest)
+        if entry is not None and entry.expires_at <= time.time() and not entry.refs:
+            await self._evict(digest)
+            self.counters["expired"] += 1
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(digest)
+            entry.refs += 1
+            self.counters["hits"] += 1
+            return entry.file
+
+        pending = self._pending.get(digest)
+        if pending is not None:
+            # Someone is uploading the same content right now
+            self.counters["shared_uploads"] += 1
+            await asyncio.shield(pending)
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            entry.refs += 1
+            return entry.file
+        return None
+
+    async def release(self, file: File) -> None:
+        """Marks a file handed out by `acquire` as no longer in use"""
+        digest = self._names.get(file.name)
+        entry = self._entries.get(digest) if digest else None
+        if entry is None:
+            # Not cached (evicted meanwhile), nothing else uses it
+            await self.delete(file.name)
+            return
+        entry.refs = max(entry.refs - 1, 0)
+        await self._trim()
+
+    async def sweep(self) -> None:
+        """Evicts expired entries that aren't in use"""
+        now = time.time()
+        for digest, entry in list(self._entries.items()):
+            if entry.expires_at <= now and not entry.refs:
+                await self._evict(digest)
+                self.counters["expired"] += 1
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as E:
+                print(f"[UPLOAD CACHE] [WARNING] | Sweep failed: {E}")
+
+    async def _trim(self) -> None:
+        """Evicts the least recently used entries that aren't in use while over UPLOAD_CACHE_SIZE"""
+        excess = len(self._entries) - UPLOAD_CACHE_SIZE
+        if excess <= 0:
+            return
+        for digest in [
+            digest for digest, entry in self._entries.items() if not entry.refs
+        ][:excess]:
+            await self._evict(digest)
+            self.counters["evicted"] += 1
+
+    async def _evict(self, digest: str) -> None:
+        entry = self._entries.pop(digest)
+        self._names.pop(entry.file.name, None)
+        if entry.remote_expires_at is None or entry.remote_expires_at > time.time():
+            await self.delete(entry.file.name)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "entries": len(self._entries),
+            "in_use": sum(1 for entry in self._entries.values() if entry.refs),
+        }
+
+
+upload_cache = UploadCache()
@@ -1,9 +1,40 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse
 from discord.ext import commands
+from modules.CommonCalls import CommonCalls
+from modules.ManagedMessages import ManagedMessages
+from modules.MemoryStore import memory_store
+from modules.Memories import memory_queue
+from modules.MemoryCompactor import memory_compactor
+from modules.GeminiClient import gemini_calls
+from modules.Admission import admission
+from modules.Scheduler import scheduler
+from modules.Coalescer import coalescer
+from modules.UploadCache import upload_cache
+import asyncio
 import json
 import os
 
+# Seconds /health waits for the bot loop to collect its stats
+HEALTH_TIMEOUT = 5.0
+
+
+async def _stats() -> dict:
+    """Runs on the bot's loop, which owns every structure read here"""
+    return {
+        "context": {
+            **ManagedMessages.stats,
+            "resident": len(ManagedMessages.context_window),
+        },
+        "memory_queue": memory_queue.stats(),
+        "memory_compaction": memory_compactor.stats(),
+        "gemini": gemini_calls.stats(),
+        "admission": admission.stats(),
+        "scheduler": scheduler.stats(),
+        "coalescer": coalescer.stats(),
+        "upload_cache": upload_cache.stats(),
+    }
+
 
 def create_app(bot: commands.Bot):
     app = FastAPI()
@@ -14,7 +45,18 @@ def create_app(bot: commands.Bot):
 
     @app.get("/health")
     async def health():
-        return {"status": "ok"}  # Make this more descriptive
+        # This server runs on its own thread, the stats are collected on the bot's loop
+        loop = getattr(bot, "loop", None)
+        if loop is None or not loop.is_running():
+            return JSONResponse({"status": "starting"}, status_code=503)
+        try:
+            stats = await asyncio.wait_for(
+                asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_stats(), loop)),
+                HEALTH_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            return JSONResponse({"status": "unresponsive"}, status_code=503)
+        return {"status": "ok", **stats}  # Make this more descriptive
 
     @app.post("/event")
     async def event_trigger(request: Request):
@@ -44,6 +86,9 @@ def create_app(bot: commands.Bot):
                 # Save updated config
                 with open(config_path, "w") as f:
                     json.dump(existing_config, f, indent=4)
+
+                # Drop the in-memory copy so the bot picks the new values up on its next message
+                CommonCalls.invalidate_config()
                 return {"status": "config updated"}
 
             case "update_personality":
@@ -71,6 +116,9 @@ def create_app(bot: commands.Bot):
                 # Save updated personality
                 with open(prompt_path, "w") as f:
                     json.dump(existing_personality, f, indent=4)
+
+                # Forces the persona prompt to be rebuilt on the next message
+                CommonCalls.invalidate_personality()
                 return {"status": "personality updated"}
 
             case "update_memory":
@@ -95,43 +143,10 @@ def create_app(bot: commands.Bot):
                 print(f"Type: {type(memory)}")
                 print(memory)
                 print("updating memory keys... please hold")
-                memories_path = f"data/{os.getenv('BOT_ID')}-memories.json"
-
-                # Read existing memories
-                existing_memories = {}
-                if os.path.exists(memories_path):
-                    try:
-                        with open(memories_path, "r") as f:
-                            existing_memories = json.load(f)
-                    except json.JSONDecodeError:
-                        print(
-                            "[SPINE SERVER] [WARNING] | Existing memory file is invalid JSON"
-                        )
-
-                # Initialize guild array if it doesn't exist
-                if guild_id not in existing_memories:
-                    existing_memories[guild_id] = []
 
-                # For each new memory in the array
-                for new_memory in new_memories:
-                    memory_id = new_memory.get("memory_id")
-                    if not memory_id:
-                        continue  # Skip memories without memory_id
-
-                    # Find and update existing memory or append new one
-                    memory_updated = False
-                    for i, existing_memory in enumerate(existing_memories[guild_id]):
-                        if existing_memory.get("memory_id") == memory_id:
-                            existing_memories[guild_id][i] = new_memory
-                            memory_updated = True
-                            break
-
-                    if not memory_updated:
-                        existing_memories[guild_id].append(new_memory)
-
-                # Save updated memories
-                with open(memories_path, "w") as f:
-                    json.dump(existing_memories, f, indent=4)
+                # Memories with an existing memory_id are replaced, the rest are added
+                # (memories without a memory_id are skipped)
+                memory_store.upsert(guild_id, new_memories)
 
                 return {"status": "memory updated"}
 
@@ -153,24 +168,8 @@ def create_app(bot: commands.Bot):
                     return {"status": "error", "message": "Invalid memories format"}
 
                 print(f"[SPINE SERVER] [CRITICAL] | Guild ID: {guild_id}")
-                memories_path = f"data/{os.getenv('BOT_ID')}-memories.json"
 
-                # Read existing memories
-                existing_memories = {}
-                if os.path.exists(memories_path):
-                    try:
-                        with open(memories_path, "r") as f:
-                            existing_memories = json.load(f)
-                    except json.JSONDecodeError:
-                        print(
-                            "[SPINE SERVER] [WARNING] | Existing memory file is invalid JSON"
-                        )
-                        return {
-                            "status": "error",
-                            "message": "Failed to read memories file",
-                        }
-
-                if guild_id not in existing_memories:
+                if not memory_store.has_guild(guild_id):
                     print("[SPINE SERVER] [WARNING] | Guild ID is not registered.")
                     return {"status": "error", "message": "Guild not found in memories"}
 
@@ -184,20 +183,7 @@ def create_app(bot: commands.Bot):
                         "message": "No valid memory IDs provided",
                     }
 
-                # Filter out the memories that match the memory_ids
-                existing_memories[guild_id] = [
-                    mem
-                    for mem in existing_memories[guild_id]
-                    if mem.get("memory_id") not in memory_ids_to_delete
-                ]
-
-                # If the guild has no memories left, consider removing the guild entry
-                if not existing_memories[guild_id]:
-                    del existing_memories[guild_id]
-
-                # Save updated memories
-                with open(memories_path, "w") as f:
-                    json.dump(existing_memories, f, indent=4)
+                memory_store.delete(guild_id, memory_ids_to_delete)
 
                 return {"status": "memories deleted"}
 
@@ -206,17 +192,11 @@ def create_app(bot: commands.Bot):
 
     @app.get("/memories")
     def memory_ret():
-        memory_path = f"./data/{os.getenv('BOT_ID')}-memories.json"
-        with open(memory_path, "r") as memories:
-            loaded_memories = json.load(memories)
-            return JSONResponse(loaded_memories)
+        return JSONResponse(memory_store.dump())
 
     @app.post("/memories")
     def memory_set():
-        memory_path = f"./data/{os.getenv('BOT_ID')}-memories.json"
-        with open(memory_path, "r") as memories:
-            loaded_memories = json.load(memories)
-            return JSONResponse(loaded_memories)
+        return JSONResponse(memory_store.dump())
 
     @app.get("/guilds")
     def guilds_ret():
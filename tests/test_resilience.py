@@ -0,0 +1,84 @@
+import asyncio
+import unittest
+
+from google.genai import errors
+
+from modules.Resilience import CircuitBreaker, CircuitOpenError, ResilientCaller
+
+
+def _unavailable():
+    return errors.APIError(503, {"error": {"message": "unavailable"}})
+
+
+class HalfOpenTrialTest(unittest.IsolatedAsyncioTestCase):
+
+    def caller(self) -> ResilientCaller:
+        # Opens on the first failure, lets a trial through right away
+        return ResilientCaller(
+            "test",
+            attempts=1,
+            breaker=CircuitBreaker(threshold=1, cooldown=0.0),
+        )
+
+    async def open_circuit(self, caller: ResilientCaller) -> None:
+        async def down():
+            raise _unavailable()
+
+        with self.assertRaises(errors.APIError):
+            await caller.call(down)
+        self.assertEqual(caller.breaker.state, "open")
+
+    async def test_cancelled_trial_reopens_the_circuit(self):
+        caller = self.caller()
+        await self.open_circuit(caller)
+
+        started = asyncio.Event()
+
+        async def hangs():
+            started.set()
+            await asyncio.sleep(60)
+
+        trial = asyncio.create_task(caller.call(hangs))
+        await started.wait()
+        self.assertEqual(caller.breaker.state, "half_open")
+        trial.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await trial
+
+        self.assertEqual(caller.breaker.state, "open")
+
+        async def works():
+            return "ok"
+
+        # The next call is a fresh trial instead of CircuitOpenError forever
+        self.assertEqual(await caller.call(works), "ok")
+        self.assertEqual(caller.breaker.state, "closed")
+
+    async def test_unexpected_error_in_trial_reopens_the_circuit(self):
+        caller = self.caller()
+        await self.open_circuit(caller)
+
+        async def broken():
+            raise KeyError("not an upstream error")
+
+        with self.assertRaises(KeyError):
+            await caller.call(broken)
+        self.assertEqual(caller.breaker.state, "open")
+
+    async def test_stale_trial_expires(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+        breaker.failure()
+        await asyncio.sleep(0.06)
+        breaker.before_call()
+        self.assertEqual(breaker.state, "half_open")
+
+        # The trial never reports back
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        await asyncio.sleep(0.06)
+        breaker.before_call()
+        self.assertEqual(breaker.state, "half_open")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import asyncio
+import unittest
+
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from modules.Scheduler import Priority, PriorityScheduler
+
+
+def _settings(concurrency: int, max_depth: int):
+    return SimpleNamespace(
+        scheduler_concurrency=concurrency, scheduler_max_depth=max_depth
+    )
+
+
+class ShedThenCancelTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_cancelled_dropped_job_does_not_free_a_slot(self):
+        scheduler = PriorityScheduler()
+        release = asyncio.Event()
+
+        with patch(
+            "modules.Scheduler.CommonCalls.settings", return_value=_settings(1, 1)
+        ):
+            running = asyncio.create_task(scheduler.run(Priority.MENTION, release.wait))
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.running, 1)
+
+            dropped = asyncio.create_task(
+                scheduler.run(Priority.FREEWILL, release.wait)
+            )
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.stats()["depth"], 1)
+
+            # A mention pushes the queue past schedulerMaxDepth and sheds the waiting freewill job,
+            # which is cancelled before it resumes to see JobDropped
+            mention = asyncio.create_task(scheduler.run(Priority.MENTION, release.wait))
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.counters["freewill"]["dropped"], 1)
+            dropped.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await dropped
+            self.assertEqual(scheduler.running, 1)
+
+            release.set()
+            await asyncio.gather(running, mention)
+            self.assertEqual(scheduler.running, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()